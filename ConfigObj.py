@@ -1,8 +1,8 @@
 #---------------------------------------------------
 #--- ConfigObj
-#--- This class implements an object to hold the 
+#--- This class implements an object to hold the
 #--- configuration of the LED controller.  It will be
-#--- updated whenever the user make a change to an 
+#--- updated whenever the user make a change to an
 #--- attribute of the controlller like the name or
 #--- type of a controller.  When a phone app first connects
 #--- to the LED controller box, it will call for this
@@ -10,86 +10,161 @@
 #--- phone app made a change to the configuration.  This
 #--- object will package the attributes into a json string
 #--- and return it to the caller.
+#---
+#--- The configuration is held in small records rather
+#--- than nested dictionaries.  Each ConfigObj has its own
+#--- 4 ControllerRec records and up to MAX_SCENES SceneRec
+#--- records.  The channel values and brightness of a scene
+#--- are kept in 16 byte arrays in CHAN_KEYS order. Json is
+#--- only used to save the config to a file and to send it
+#--- to the phone app.
 #---------------------------------------------------
 import ujson as json
+from config_codec import CHAN_KEYS, CHAN_NAMES
+
+MAX_SCENES = 8
+
+
+#---------------------------------------------------
+#--- _clamp
+#--- Return value as an int between 0 and top so it
+#--- fits the byte arrays of a SceneRec.
+#---------------------------------------------------
+def _clamp(value, top) -> int:
+    return max(0, min(top, int(value)))
+
+
+#---------------------------------------------------
+#--- ControllerRec
+#--- The type, name and 4 channel names (in CHAN_NAMES
+#--- order) of one controller.
+#---------------------------------------------------
+class ControllerRec:
+    __slots__ = ("name", "type", "chan_names")
+
+    def __init__(self, name, ctrlType="RGBW"):
+        self.name = name
+        self.type = ctrlType
+        self.chan_names = ["R", "G", "B", "W"]
+
+
+#---------------------------------------------------
+#--- SceneRec
+#--- The name of a saved scene and the RGBW value and
+#--- brightness of all 16 channels in CHAN_KEYS order.
+#---------------------------------------------------
+class SceneRec:
+    __slots__ = ("name", "values", "brightness")
+
+    def __init__(self, name):
+        self.name = name
+        self.values = bytearray(16)
+        self.brightness = bytearray(16)
 
 
 class ConfigObj:
+    __slots__ = ("controllers", "scenes", "version", "_change_callback")
+
+    def __init__(self, load=True):
+        self.controllers = []
+        #--- Only saved scenes have a record. This is to prevent
+        #--- having the config data show scenes which are all zero.
+        self.scenes = [None] * MAX_SCENES
+
+        #--- Incremented on every mutation so that centrals can tell
+        #--- whether their cached copy of the config is current.
+        self.version = 0
 
-    controller1: dict = {"Name": "Ctrl1", "Type": "RGBW", "ChanNames": {"R": "", "G": "", "B": "", "W": ""}}
-    controller2: dict = {"Name": "Ctrl2", "Type": "RGBW", "ChanNames": {"R": "", "G": "", "B": "", "W": ""}}
-    controller3: dict = {"Name": "Ctrl3", "Type": "RGBW", "ChanNames": {"R": "", "G": "", "B": "", "W": ""}}
-    controller4: dict = {"Name": "Ctrl4", "Type": "RGBW", "ChanNames": {"R": "", "G": "", "B": "", "W": ""}}
-    
-    #--- Only saved scenes will be added to this dictionary. This is to
-    #--- prevent having the config data show scenes which are all zero.
-    config_dict: dict = {
-        "1": controller1,
-        "2": controller2,
-        "3": controller3,
-        "4": controller4,
-        "Scenes": {}
-    }
-
-
-    def __init__(self):
-        self.read_config()
+        #--- Called with a small change record whenever the config is
+        #--- mutated. See set_change_callback.
+        self._change_callback = None
+
+        if load:
+            self.read_config()
 #        print("Init Config Obj")
 
 
-    def __post_init__(self):
-        pass
-#        if not isinstance(self.age, int) or self.age < 0:
-#            raise ValueError("age must be a non-negative integer")
+    #----------------------------------------------
+    #--- snapshot
+    #--- Return a copy of the records at the current
+    #--- version that later changes don't touch, so a
+    #--- message can be encoded from it a piece at a
+    #--- time.  It is not loaded from or saved to the
+    #--- config file.
+    #----------------------------------------------
+    def snapshot(self):
+        snap = ConfigObj(False)
+        for ctrl in self.controllers:
+            ctrlCopy = ControllerRec(ctrl.name, ctrl.type)
+            ctrlCopy.chan_names = list(ctrl.chan_names)
+            snap.controllers.append(ctrlCopy)
+        for sceneNdx in range(MAX_SCENES):
+            scene = self.scenes[sceneNdx]
+            if scene is not None:
+                sceneCopy = SceneRec(scene.name)
+                sceneCopy.values[:] = scene.values
+                sceneCopy.brightness[:] = scene.brightness
+                snap.scenes[sceneNdx] = sceneCopy
+        snap.version = self.version
+        return snap
+
+
+    #----------------------------------------------
+    #--- controller
+    #--- Return the record of controller ctrlNum
+    #--- (1 to 4, as a string or integer).
+    #----------------------------------------------
+    def controller(self, ctrlNum) -> ControllerRec:
+        return self.controllers[int(ctrlNum) - 1]
+
+
+    #----------------------------------------------
+    #--- scene
+    #--- Return the record of scene sceneNum (1 to
+    #--- MAX_SCENES, as a string or integer) or None
+    #--- if that scene has not been saved.
+    #----------------------------------------------
+    def scene(self, sceneNum):
+        sceneNdx = int(sceneNum) - 1
+        if sceneNdx < 0 or sceneNdx >= MAX_SCENES:
+            return None
+        return self.scenes[sceneNdx]
+
+
+    #----------------------------------------------
+    #--- scene_numbers
+    #--- Return the numbers of the saved scenes.
+    #----------------------------------------------
+    def scene_numbers(self) -> list:
+        return [ndx + 1 for ndx in range(MAX_SCENES) if self.scenes[ndx] is not None]
+
 
     #----------------------------------------------
     #--- set_rgbw_values_and_brightness
-    #--- Copy the RGBW values for a scene into the 
-    #--- local config dict and write to file.
+    #--- Copy the RGBW values for a scene into the
+    #--- scene record and write to file.
     #--- Both sceneNum and aName must be strings.
+    #--- valueDict and brightnessDict are keyed by
+    #--- CHAN_KEYS ("1R" to "4W").  Values are
+    #--- clamped to 0-255 and brightness to 0-100.
+    #--- Raises ValueError if sceneID is not 1 to
+    #--- MAX_SCENES.
     #----------------------------------------------
     def set_rgbw_values_and_brightness(self, sceneID, sceneName, valueDict, brightnessDict):
-        if sceneID not in self.config_dict["Scenes"]:
-            self.config_dict["Scenes"][sceneID] = {}
-        self.config_dict["Scenes"][sceneID]["Name"] = sceneName
-        self.config_dict["Scenes"][sceneID]["RGBWValues"] = valueDict.copy()
-        self.config_dict["Scenes"][sceneID]["Brightness"] = brightnessDict.copy()
-
-        # self.cfg_rgbw_values["1R"] = valueDict["1R"]
-        # self.cfg_rgbw_values["1G"] = valueDict["1G"]
-        # self.cfg_rgbw_values["1B"] = valueDict["1B"]
-        # self.cfg_rgbw_values["1W"] = valueDict["1W"]
-        # self.cfg_rgbw_values["2R"] = valueDict["2R"]
-        # self.cfg_rgbw_values["2G"] = valueDict["2G"]
-        # self.cfg_rgbw_values["2B"] = valueDict["2B"]
-        # self.cfg_rgbw_values["2W"] = valueDict["2W"]
-        # self.cfg_rgbw_values["3R"] = valueDict["3R"]
-        # self.cfg_rgbw_values["3G"] = valueDict["3G"]
-        # self.cfg_rgbw_values["3B"] = valueDict["3B"]
-        # self.cfg_rgbw_values["3W"] = valueDict["3W"]
-        # self.cfg_rgbw_values["4R"] = valueDict["4R"]
-        # self.cfg_rgbw_values["4G"] = valueDict["4G"]
-        # self.cfg_rgbw_values["4B"] = valueDict["4B"]
-        # self.cfg_rgbw_values["4W"] = valueDict["4W"]
-
-        # self.cfg_brightness["1R"] = brightnessDict["1R"]
-        # self.cfg_brightness["1G"] = brightnessDict["1G"]
-        # self.cfg_brightness["1B"] = brightnessDict["1B"]
-        # self.cfg_brightness["1W"] = brightnessDict["1W"]
-        # self.cfg_brightness["2R"] = brightnessDict["2R"]
-        # self.cfg_brightness["2G"] = brightnessDict["2G"]
-        # self.cfg_brightness["2B"] = brightnessDict["2B"]
-        # self.cfg_brightness["2W"] = brightnessDict["2W"]
-        # self.cfg_brightness["3R"] = brightnessDict["3R"]
-        # self.cfg_brightness["3G"] = brightnessDict["3G"]
-        # self.cfg_brightness["3B"] = brightnessDict["3B"]
-        # self.cfg_brightness["3W"] = brightnessDict["3W"]
-        # self.cfg_brightness["4R"] = brightnessDict["4R"]
-        # self.cfg_brightness["4G"] = brightnessDict["4G"]
-        # self.cfg_brightness["4B"] = brightnessDict["4B"]
-        # self.cfg_brightness["4W"] = brightnessDict["4W"]
+        sceneNdx = int(sceneID) - 1
+        if sceneNdx < 0 or sceneNdx >= MAX_SCENES:
+            raise ValueError("Scene number out of range")
+        scene = self.scenes[sceneNdx]
+        if scene is None:
+            scene = SceneRec(sceneName)
+            self.scenes[sceneNdx] = scene
+        scene.name = sceneName
+        for ndx in range(16):
+            scene.values[ndx] = _clamp(valueDict[CHAN_KEYS[ndx]], 255)
+            scene.brightness[ndx] = _clamp(brightnessDict[CHAN_KEYS[ndx]], 100)
 
         self.write_to_file()
+        self._notify_change({"Scenes": {sceneID: self.scene_dict(scene)}})
 
 
     #----------------------------------------------
@@ -97,8 +172,9 @@ class ConfigObj:
     #--- Both sceneNum and aName must be strings.
     #----------------------------------------------
     def set_scene_name(self, sceneNum, aName):
-        self.config_dict["Scenes"][sceneNum]["Name"] = aName
+        self.scene(sceneNum).name = aName
         self.write_to_file()
+        self._notify_change({"Scenes": {sceneNum: {"Name": aName}}})
 
 
     #----------------------------------------------
@@ -106,8 +182,9 @@ class ConfigObj:
     #--- Both ctrlNum and aName must be strings.
     #----------------------------------------------
     def set_ctrl_name(self, ctrlNum, aName):
-        self.config_dict[ctrlNum]["Name"] = aName
+        self.controller(ctrlNum).name = aName
         self.write_to_file()
+        self._notify_change({ctrlNum: {"Name": aName}})
 
 
     #----------------------------------------------
@@ -115,20 +192,45 @@ class ConfigObj:
     #--- Both ctrlNum and aType must be strings.
     #----------------------------------------------
     def set_ctrl_type(self, ctrlNum, aType):
-        self.config_dict[ctrlNum]["Type"] = aType
+        self.controller(ctrlNum).type = aType
 #        print("Setting Ctrl Type: ", aType)
         self.write_to_file()
+        self._notify_change({ctrlNum: {"Type": aType}})
 
 
     #----------------------------------------------
     #--- set_channel_name
-    #--- All of ctrlNum, chanNum and aName must be 
+    #--- All of ctrlNum, chanNum and aName must be
     #--- strings. chanNUm must be one of "R", "G",
     #--- "B", or "W".
     #----------------------------------------------
     def set_channel_name(self, ctrlNum, chanNum, aName):
-        self.config_dict[ctrlNum]["ChanNames"][chanNum] = aName
+        self.controller(ctrlNum).chan_names[CHAN_NAMES.index(chanNum)] = aName
         self.write_to_file()
+        self._notify_change({ctrlNum: {"ChanNames": {chanNum: aName}}})
+
+
+    #----------------------------------------------
+    #--- set_change_callback
+    #--- Register a function to be called with a change
+    #--- record each time the config is mutated.  The
+    #--- record has the form {"Ver": version, "Set": patch}
+    #--- where patch has the same shape as the config
+    #--- json but only holds the keys that changed.
+    #----------------------------------------------
+    def set_change_callback(self, callback):
+        self._change_callback = callback
+
+
+    #----------------------------------------------
+    #--- _notify_change
+    #--- Bump the config version and pass the change
+    #--- record to the registered callback, if any.
+    #----------------------------------------------
+    def _notify_change(self, patch):
+        self.version += 1
+        if self._change_callback:
+            self._change_callback({"Ver": self.version, "Set": patch})
 
 
     #----------------------------------------------
@@ -137,21 +239,21 @@ class ConfigObj:
     #--- ctrlNum must be a value from 1 to 4
     #----------------------------------------------
     def get_ctrl_type(self, ctrlNum) -> str:
-        return self.config_dict[ctrlNum]["Type"]
+        return self.controller(ctrlNum).type
+
 
-    
     #----------------------------------------------
     #--- write_to_file
-    #--- Both ctrlNum and aType must be strings.
+    #--- Save the json form of the config to the
+    #--- config file.
     #----------------------------------------------
     def write_to_file(self):
 
         config_file_path = "config.json"
-        jsonStr = self.to_json()
 
         try:
             with open(config_file_path, "w") as file:
-                json.dump(self.config_dict, file)
+                json.dump(self.to_dict(), file)
 
         except OSError:
             #--- Failed to open file for write
@@ -164,81 +266,136 @@ class ConfigObj:
     #----------------------------------------------------------------
     #--- read_config
     #--- Read the names and config settings from the config file (if
-    #--- it exists) and load them into the main config dictionary of
-    #--- this object. If the file doesn't exist, load the dictionary 
-    #--- with default data.
+    #--- it exists) and load them into the records of this object.
+    #--- If the file doesn't exist, load the records with default data.
     #---
     #----------------------------------------------------------------
     def read_config(self):
 
         config_file_path = "config.json"
 
+        self.default_config_data()
+
         filePath = config_file_path
         try:
             with open(filePath, "r") as file:
-                self.config_dict = json.load(file)
+                self.from_dict(json.load(file))
 
         except OSError:
             #--- Failed to open file for read so no
-            #--- config data has been saved. Create
-            #--- default data to return.
+            #--- config data has been saved. Keep the
+            #--- default data.
     #        print("Failed to open config file for write")
-            self.default_config_data()
+            pass
         finally:
             if 'file' in locals():
                 file.close()
 
-    
+
 
     #----------------------------------------------------------------
     #--- default_config_data
-    #--- Set default values into the main config structure
-    #--- of this object.
+    #--- Set default values into the records of this object.
     #---
     #----------------------------------------------------------------
     def default_config_data(self):
 
-        self.controller1 = {"Name": "Ctrl1", "Type": "RGBW", "ChanNames": {"R": "", "G": "", "B": "", "W": ""}}
-        self.controller2 = {"Name": "Ctrl2", "Type": "RGBW", "ChanNames": {"R": "", "G": "", "B": "", "W": ""}}
-        self.controller3 = {"Name": "Ctrl3", "Type": "RGBW", "ChanNames": {"R": "", "G": "", "B": "", "W": ""}}
-        self.controller4 = {"Name": "Ctrl4", "Type": "RGBW", "ChanNames": {"R": "", "G": "", "B": "", "W": ""}}
-        self.controller1["Name"] = "Ctrl1"        
-        self.controller2["Name"] = "Ctrl2"        
-        self.controller3["Name"] = "Ctrl3"        
-        self.controller4["Name"] = "Ctrl4"        
-        self.controller1["Type"] = "RGBW"         
-        self.controller2["Type"] = "RGBW"         
-        self.controller3["Type"] = "RGBW"         
-        self.controller4["Type"] = "RGBW"
-        self.controller1["ChanNames"]["R"] = "R"
-        self.controller1["ChanNames"]["G"] = "G"
-        self.controller1["ChanNames"]["B"] = "B"
-        self.controller1["ChanNames"]["W"] = "W"
-        self.controller2["ChanNames"]["R"] = "R"
-        self.controller2["ChanNames"]["G"] = "G"
-        self.controller2["ChanNames"]["B"] = "B"
-        self.controller2["ChanNames"]["W"] = "W"
-        self.controller3["ChanNames"]["R"] = "R"
-        self.controller3["ChanNames"]["G"] = "G"
-        self.controller3["ChanNames"]["B"] = "B"
-        self.controller3["ChanNames"]["W"] = "W"
-        self.controller4["ChanNames"]["R"] = "R"
-        self.controller4["ChanNames"]["G"] = "G"
-        self.controller4["ChanNames"]["B"] = "B"
-        self.controller4["ChanNames"]["W"] = "W"
-        self.config_dict["Scenes"] = {}
-
-
- #       print("Default config data: ", self.config_dict)
+        self.controllers = [ControllerRec("Ctrl1"),
+                            ControllerRec("Ctrl2"),
+                            ControllerRec("Ctrl3"),
+                            ControllerRec("Ctrl4")]
+        self.scenes = [None] * MAX_SCENES
+
+
+ #       print("Default config data: ", self.to_dict())
+
+
+    #----------------------------------------------------------------
+    #--- from_dict
+    #--- Load the records from a dictionary in the json config format.
+    #--- Anything missing from the dictionary keeps its current value.
+    #----------------------------------------------------------------
+    def from_dict(self, cfgDict):
+        for ctrlNdx in range(4):
+            ctrlKey = str(ctrlNdx + 1)
+            if ctrlKey not in cfgDict:
+                continue
+            ctrl = self.controllers[ctrlNdx]
+            ctrlDict = cfgDict[ctrlKey]
+            ctrl.name = ctrlDict.get("Name", ctrl.name)
+            ctrl.type = ctrlDict.get("Type", ctrl.type)
+            chanNames = ctrlDict.get("ChanNames", {})
+            for chanNdx in range(4):
+                ctrl.chan_names[chanNdx] = chanNames.get(CHAN_NAMES[chanNdx], ctrl.chan_names[chanNdx])
+
+        scenes = cfgDict.get("Scenes", {})
+        for sceneKey in scenes:
+            sceneNdx = int(sceneKey) - 1
+            if sceneNdx < 0 or sceneNdx >= MAX_SCENES:
+                continue
+            sceneDict = scenes[sceneKey]
+            scene = SceneRec(sceneDict.get("Name", ""))
+            values = sceneDict.get("RGBWValues", {})
+            dims = sceneDict.get("Brightness", {})
+            for ndx in range(16):
+                scene.values[ndx] = _clamp(values.get(CHAN_KEYS[ndx], 0), 255)
+                scene.brightness[ndx] = _clamp(dims.get(CHAN_KEYS[ndx], 100), 100)
+            self.scenes[sceneNdx] = scene
 
 
     #----------------------------------------------
-    #--- to_json
-    #--- Dump the configuration dictionary to json
-    #--- and return the json string.
+    #--- ctrl_dict
+    #--- Return the json form of a controller record.
     #----------------------------------------------
-    def to_json(self) -> str:
-        return json.dumps(self.config_dict)
+    def ctrl_dict(self, ctrl) -> dict:
+        chanNames = {}
+        for chanNdx in range(4):
+            chanNames[CHAN_NAMES[chanNdx]] = ctrl.chan_names[chanNdx]
+        return {"Name": ctrl.name, "Type": ctrl.type, "ChanNames": chanNames}
+
+
+    #----------------------------------------------
+    #--- scene_dict
+    #--- Return the json form of a scene record.
+    #----------------------------------------------
+    def scene_dict(self, scene, withValues=True) -> dict:
+        sceneDict = {"Name": scene.name}
+        if withValues:
+            values = {}
+            dims = {}
+            for ndx in range(16):
+                values[CHAN_KEYS[ndx]] = scene.values[ndx]
+                dims[CHAN_KEYS[ndx]] = scene.brightness[ndx]
+            sceneDict["RGBWValues"] = values
+            sceneDict["Brightness"] = dims
+        return sceneDict
 
 
-    
\ No newline at end of file
+    #----------------------------------------------
+    #--- to_dict
+    #--- Build the json form of the configuration.
+    #--- withCtrls, sceneNums and withValues select
+    #--- which parts are included; by default it is
+    #--- the whole configuration.
+    #----------------------------------------------
+    def to_dict(self, withCtrls=True, sceneNums=None, withValues=True) -> dict:
+        cfgDict = {}
+        if withCtrls:
+            for ctrlNdx in range(4):
+                cfgDict[str(ctrlNdx + 1)] = self.ctrl_dict(self.controllers[ctrlNdx])
+        if sceneNums is None:
+            sceneNums = self.scene_numbers()
+        scenes = {}
+        for sceneNum in sceneNums:
+            scenes[str(sceneNum)] = self.scene_dict(self.scenes[sceneNum - 1], withValues)
+        cfgDict["Scenes"] = scenes
+        return cfgDict
+
+
+    #----------------------------------------------
+    #--- to_json
+    #--- Dump the configuration to json and return
+    #--- the json string.
+    #----------------------------------------------
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict())
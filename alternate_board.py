@@ -19,6 +19,8 @@ from bluetooth import UUID
 import aioble
 import asyncio
 import ujson as json
+import command_codec
+from config_codec import CHAN_KEYS
 
 # Define UUIDs for the service and characteristics
 SERVICE_UUID = UUID("b00d0c55-1111-2222-3333-0000b00d0c50")
@@ -55,6 +57,9 @@ config_char.write(char1_value, send_update=True)
 #--- Advertising interval in microseconds
 ADV_INTERVAL_MS = 30000  # 30 sec
 #--- Connection interval in milliseconds
+#--- The connection parameters are picked by the central when it 
+#--- connects; aioble has no way to ask it for others from here.
+#--- led_peripheral.py prints the ones the central picked.
 CONN_INTERVAL_MS = 100  # 100 ms
 #--- Slave latency
 SLAVE_LATENCY = 0
@@ -137,6 +142,9 @@ saved_rgbw_values = {
     "4W": 0
 }
 
+#--- Channel values read out of a setLED or setBright message.
+scanVals = bytearray(16)
+
 LEDSceneNames = {
     "LEDScene1": "Scene 1",
     "LEDScene2": "Scene 2",
@@ -386,6 +394,24 @@ async def select_scene_task():
         await asyncio.sleep_ms(200)
 
 
+#---------------------------------------------------------
+#--- set_chan_bright
+#--- Save the brightness index (0-3) of the channel with the
+#--- key (e.g. "1R") and set its LED.
+#---------------------------------------------------------
+def set_chan_bright(key, value):
+    print("Setting", key, "to", value)
+    if key in saved_rgbw_values:
+        ledValue = saved_rgbw_values[key]
+        rgbw_brightness[key] = value
+        #--- Apply brightness dimming
+        dimmer_index = rgbw_brightness[key]
+        dimmed_value = (ledValue * LED_Dimmer_multiply_Array[dimmer_index]) // LED_Dimmer_divide_Array[dimmer_index]
+        rgbw_pins[key].duty_u16(int(dimmed_value / 255 * 65535))
+    else:
+        print("Invalid key:", key)
+
+
 #---------------------------------------------------------
 #--- set_bright_task
 #--- This function will be called when data is written to the 
@@ -402,31 +428,28 @@ async def set_bright_task():
             connection, data = await set_bright_char.written()
             print("Data written to set_bright_char:", data)
 
-            dataStr = data.decode('utf-8')
-
-            dataDict = json.loads(dataStr)
-#            print("Parsed data:", dataDict)
-#            print("Length of data:", len(dataStr))
-
-            #--- Combine the controller number and channel to form the key
-            #--- into the saved RGBW values and brightness arrays.
-            dataDictKeys = dataDict.keys()
-            for ctrlNum in dataDictKeys:
-                chanDict = dataDict[ctrlNum]
-                chanKeys = chanDict.keys()
-                for chan in chanKeys:
-                    key = f"{ctrlNum}{chan}"
-                    value = chanDict[chan]
-                    print("Setting", key, "to", value)
-                    if key in saved_rgbw_values:
-                        ledValue = saved_rgbw_values[key]
-                        rgbw_brightness[key] = value
-                        #--- Apply brightness dimming
-                        dimmer_index = rgbw_brightness[key]
-                        dimmed_value = (ledValue * LED_Dimmer_multiply_Array[dimmer_index]) // LED_Dimmer_divide_Array[dimmer_index]
-                        rgbw_pins[key].duty_u16(int(dimmed_value / 255 * 65535))
-                    else:
-                        print("Invalid key:", key)
+            #--- The usual shape of message is read straight from the
+            #--- bytes; anything else goes through json.
+            chanMask = command_codec.scan_chan_json(data, scanVals)
+            if chanMask >= 0:
+                for chanNdx in range(16):
+                    if chanMask & (1 << chanNdx):
+                        set_chan_bright(CHAN_KEYS[chanNdx], scanVals[chanNdx])
+            else:
+                dataStr = data.decode('utf-8')
+
+                dataDict = json.loads(dataStr)
+#                print("Parsed data:", dataDict)
+#                print("Length of data:", len(dataStr))
+
+                #--- Combine the controller number and channel to form the key
+                #--- into the saved RGBW values and brightness arrays.
+                dataDictKeys = dataDict.keys()
+                for ctrlNum in dataDictKeys:
+                    chanDict = dataDict[ctrlNum]
+                    chanKeys = chanDict.keys()
+                    for chan in chanKeys:
+                        set_chan_bright(f"{ctrlNum}{chan}", chanDict[chan])
 
         except asyncio.CancelledError:
             print("set_bright_task cancelled")
@@ -435,6 +458,22 @@ async def set_bright_task():
         await asyncio.sleep_ms(200)
 
 
+#---------------------------------------------------------
+#--- set_chan_led
+#--- Save the value (0-255) of the channel with the key 
+#--- (e.g. "1R") and set its LED.
+#---------------------------------------------------------
+def set_chan_led(key, value):
+    if key in saved_rgbw_values:
+        saved_rgbw_values[key] = value
+        #--- Apply brightness dimming
+        dimmer_index = rgbw_brightness[key]
+        dimmed_value = (value * LED_Dimmer_multiply_Array[dimmer_index]) // LED_Dimmer_divide_Array[dimmer_index]
+        rgbw_pins[key].duty_u16(int(dimmed_value / 255 * 65535))
+    else:
+        print("Invalid key:", key)
+
+
 #---------------------------------------------------------
 #--- set_led_task
 #--- This function will be called when data is written to the 
@@ -451,30 +490,28 @@ async def set_led_task():
             connection, data = await set_led_char.written()
 #            print("Data written to set_led_char:", data)
 
-            dataStr = data.decode('utf-8')
-
-            dataDict = json.loads(dataStr)
-#            print("Parsed data:", dataDict)
-#            print("Length of data:", len(dataStr))
-
-            #--- Combine the controller number and channel to form the key
-            #--- into the saved RGBW values and brihtness arrays.
-            dataDictKeys = dataDict.keys()
-            for ctrlNum in dataDictKeys:
-                chanDict = dataDict[ctrlNum]
-                chanKeys = chanDict.keys()
-                for chan in chanKeys:
-                    key = f"{ctrlNum}{chan}"
-                    value = chanDict[chan]
-#                    print("Setting", key, "to", value)
-                    if key in saved_rgbw_values:
-                        saved_rgbw_values[key] = value
-                        #--- Apply brightness dimming
-                        dimmer_index = rgbw_brightness[key]
-                        dimmed_value = (value * LED_Dimmer_multiply_Array[dimmer_index]) // LED_Dimmer_divide_Array[dimmer_index]
-                        rgbw_pins[key].duty_u16(int(dimmed_value / 255 * 65535))
-                    else:
-                        print("Invalid key:", key)
+            #--- The usual shape of message is read straight from the
+            #--- bytes; anything else goes through json.
+            chanMask = command_codec.scan_chan_json(data, scanVals)
+            if chanMask >= 0:
+                for chanNdx in range(16):
+                    if chanMask & (1 << chanNdx):
+                        set_chan_led(CHAN_KEYS[chanNdx], scanVals[chanNdx])
+            else:
+                dataStr = data.decode('utf-8')
+
+                dataDict = json.loads(dataStr)
+#                print("Parsed data:", dataDict)
+#                print("Length of data:", len(dataStr))
+
+                #--- Combine the controller number and channel to form the key
+                #--- into the saved RGBW values and brihtness arrays.
+                dataDictKeys = dataDict.keys()
+                for ctrlNum in dataDictKeys:
+                    chanDict = dataDict[ctrlNum]
+                    chanKeys = chanDict.keys()
+                    for chan in chanKeys:
+                        set_chan_led(f"{ctrlNum}{chan}", chanDict[chan])
 
         except asyncio.CancelledError:
             print("set_led_task cancelled")
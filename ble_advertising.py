@@ -18,6 +18,7 @@ _ADV_TYPE_UUID16_MORE = const(0x2)
 _ADV_TYPE_UUID32_MORE = const(0x4)
 _ADV_TYPE_UUID128_MORE = const(0x6)
 _ADV_TYPE_APPEARANCE = const(0x19)
+_ADV_TYPE_MANUFACTURER = const(0xFF)
 
 
 # Generate a payload to be passed to gap_advertise(adv_data=...).
@@ -53,6 +54,20 @@ def advertising_payload(limited_disc=False, br_edr=False, name=None, services=No
     return payload
 
 
+# Generate a scan response to be passed to gap_advertise(resp_data=...).
+# A central doing an active scan gets it along with the advertising
+# payload, which is already full with our name and 128-bit service UUID.
+# manufacturer is the manufacturer specific data, starting with the
+# 16-bit company id.  A scan response has no flags.
+def scan_response_payload(name=None, manufacturer=None):
+    payload = bytearray()
+    if name:
+        payload += struct.pack("BB", len(name) + 1, _ADV_TYPE_NAME) + name
+    if manufacturer:
+        payload += struct.pack("BB", len(manufacturer) + 1, _ADV_TYPE_MANUFACTURER) + manufacturer
+    return payload
+
+
 def decode_field(payload, adv_type):
     i = 0
     result = []
@@ -68,6 +83,10 @@ def decode_name(payload):
     return str(n[0], "utf-8") if n else ""
 
 
+def decode_manufacturer(payload):
+    return decode_field(payload, _ADV_TYPE_MANUFACTURER)
+
+
 def decode_services(payload):
     services = []
     for u in decode_field(payload, _ADV_TYPE_UUID16_COMPLETE):
@@ -79,6 +98,61 @@ def decode_services(payload):
     return services
 
 
+# Return True if payload lists the 128-bit service UUID given as its 16
+# bytes (bytes(uuid)) in a complete 128-bit UUID field, as decode_all
+# would.  It walks the fields and compares the bytes where they are in
+# the payload, so it allocates nothing and is cheap enough to run in the
+# scan IRQ on every packet heard.
+def has_uuid128(payload, uuid_bytes):
+    i = 0
+    n = len(payload)
+    while i + 1 < n:
+        end = i + payload[i] + 1
+        if end > n:
+            break
+        if payload[i + 1] == _ADV_TYPE_UUID128_COMPLETE:
+            for j in range(i + 2, end - 15, 16):
+                k = 0
+                while k < 16 and payload[j + k] == uuid_bytes[k]:
+                    k += 1
+                if k == 16:
+                    return True
+        i = end
+    return False
+
+
+# Return (name, services, manufacturer) from one walk of the payload, as
+# decode_name, decode_services and decode_manufacturer would each give,
+# but with every UUID of a list field.  A field that runs past the end of
+# the payload ends the walk.
+def decode_all(payload):
+    name = ""
+    services = []
+    manufacturer = []
+    i = 0
+    n = len(payload)
+    while i + 1 < n:
+        end = i + payload[i] + 1
+        if end > n:
+            break
+        adv_type = payload[i + 1]
+        if adv_type == _ADV_TYPE_UUID128_COMPLETE:
+            for j in range(i + 2, end - 15, 16):
+                services.append(bluetooth.UUID(payload[j : j + 16]))
+        elif adv_type == _ADV_TYPE_UUID16_COMPLETE:
+            for j in range(i + 2, end - 1, 2):
+                services.append(bluetooth.UUID(struct.unpack_from("<H", payload, j)[0]))
+        elif adv_type == _ADV_TYPE_UUID32_COMPLETE:
+            for j in range(i + 2, end - 3, 4):
+                services.append(bluetooth.UUID(struct.unpack_from("<I", payload, j)[0]))
+        elif adv_type == _ADV_TYPE_NAME and not name:
+            name = str(payload[i + 2 : end], "utf-8")
+        elif adv_type == _ADV_TYPE_MANUFACTURER:
+            manufacturer.append(payload[i + 2 : end])
+        i = end
+    return name, services, manufacturer
+
+
 def demo():
     payload = advertising_payload(
         name="micropython",
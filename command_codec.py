@@ -0,0 +1,283 @@
+#-------------------------------------------------------------------------------
+#--- command_codec.py
+#--- Encoders and decoders for the packed binary commands that are written
+#--- to the binary command characteristic.  They do the same job as the
+#--- json messages written to the setLED and setBright characteristics
+#--- but are a few bytes long and need no parsing, so a phone app that
+#--- is dragging a color wheel can send many more of them.  The json
+#--- characteristics still work as before.
+#--- This file must reside on the pico of the peripheral and on any
+#--- central that wants to send binary commands.
+#---
+#---    Header:      opcode (u8), controller mask (u8), channel mask (u8)
+#---    Values:      one byte for each bit set in the channel mask, in
+#---                 CHAN_NAMES order (R, G, B, W)
+#---
+#--- Bit 0 of the controller mask is controller 1 and bit 0 of the channel
+#--- mask is the R channel.  The values are applied to the selected channels
+#--- of every controller in the controller mask, so setting all 4
+#--- controllers to one color is a single 7 byte write.
+#---
+#--- A write can hold several commands back to back, e.g. one value and one
+#--- brightness command for each controller.  The peripheral checks them
+#--- all and then applies them together, so the LEDs change at once and
+#--- a bad command leaves them untouched.  A write is limited to the MTU
+#--- less 3 bytes; pack_state sets all 16 channels in at most 56 bytes.
+#---
+#--- CMD_SET_VALUE  - Set the LED values (0 to 255) of the channels.
+#--- CMD_SET_BRIGHT - Set the brightness (0 to 100) of the channels.
+#---
+#--- scan_chan_json also lives here.  It reads the usual json setLED and
+#--- setBright messages without ujson, for the peripherals.
+#-------------------------------------------------------------------------------
+
+import struct
+
+import micropython
+from micropython import const
+
+from config_codec import CHAN_NAMES
+
+CMD_SET_VALUE = const(0x01)
+CMD_SET_BRIGHT = const(0x02)
+
+CMD_HEADER = "<BBB"
+CMD_HEADER_SIZE = const(3)
+
+CTRL_MASK_ALL = const(0x0F)
+CHAN_MASK_ALL = const(0x0F)
+
+#--- The number of bits set in each channel mask.
+_CHAN_COUNT = (0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4)
+
+_QUOTE = const(0x22)
+_COMMA = const(0x2C)
+_COLON = const(0x3A)
+_LBRACE = const(0x7B)
+_RBRACE = const(0x7D)
+
+
+#----------------------------------------------------------------
+#--- command_length
+#--- Return the length of the command at offset in data, from its
+#--- header.  data must hold at least the header.
+#----------------------------------------------------------------
+def command_length(data, offset=0) -> int:
+    return CMD_HEADER_SIZE + _CHAN_COUNT[data[offset + 2] & CHAN_MASK_ALL]
+
+
+#----------------------------------------------------------------
+#--- check_batch
+#--- Return True if data holds one or more whole commands with
+#--- known opcodes and nothing else.
+#----------------------------------------------------------------
+def check_batch(data) -> bool:
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < CMD_HEADER_SIZE:
+            return False
+        if data[offset] != CMD_SET_VALUE and data[offset] != CMD_SET_BRIGHT:
+            return False
+        offset += command_length(data, offset)
+    return offset == len(data) and offset > 0
+
+
+#----------------------------------------------------------------
+#--- pack_command
+#--- Build a command.  values holds one value for each bit set in
+#--- chanMask, in CHAN_NAMES order.
+#----------------------------------------------------------------
+def pack_command(opcode, ctrlMask, chanMask, values) -> bytes:
+    if len(values) != _CHAN_COUNT[chanMask & CHAN_MASK_ALL]:
+        raise ValueError("Need one value per channel in the mask")
+    return struct.pack(CMD_HEADER, opcode, ctrlMask, chanMask) + bytes(values)
+
+
+#----------------------------------------------------------------
+#--- pack_state
+#--- Build a batch that sets the value and brightness of all 16 
+#--- channels.  values and brightness hold 16 numbers each in 
+#--- CHAN_KEYS order.  Controllers with the same 4 values share a
+#--- command.
+#----------------------------------------------------------------
+def pack_state(values, brightness) -> bytes:
+    batch = b''
+    for opcode, chanVals in ((CMD_SET_VALUE, values), (CMD_SET_BRIGHT, brightness)):
+        ctrlMasks = {}
+        for ctrlNdx in range(4):
+            quad = tuple(chanVals[ctrlNdx * 4:ctrlNdx * 4 + 4])
+            ctrlMasks[quad] = ctrlMasks.get(quad, 0) | (1 << ctrlNdx)
+        for quad in ctrlMasks:
+            batch += pack_command(opcode, ctrlMasks[quad], CHAN_MASK_ALL, quad)
+    return batch
+
+
+#----------------------------------------------------------------
+#--- chan_mask
+#--- Return the channel mask of a list of channel names, e.g.
+#--- ['R', 'G', 'B'] is 0x07.
+#----------------------------------------------------------------
+def chan_mask(chanNames) -> int:
+    mask = 0
+    for chanName in chanNames:
+        mask |= 1 << CHAN_NAMES.index(chanName)
+    return mask
+
+
+#----------------------------------------------------------------
+#--- decode_command
+#--- Turn a command back into the json form written to the setLED
+#--- or setBright characteristic, e.g. {'1': {'R': 255}}, and
+#--- return it with its opcode.
+#----------------------------------------------------------------
+def decode_command(data):
+    opcode, ctrlMask, chanMask = struct.unpack_from(CMD_HEADER, data, 0)
+    if len(data) < command_length(data):
+        raise ValueError("Short command")
+    chanVals = {}
+    valNdx = CMD_HEADER_SIZE
+    for chanNdx in range(4):
+        if chanMask & (1 << chanNdx):
+            chanVals[CHAN_NAMES[chanNdx]] = data[valNdx]
+            valNdx += 1
+    cmdDict = {}
+    for ctrlNdx in range(4):
+        if ctrlMask & (1 << ctrlNdx):
+            cmdDict[str(ctrlNdx + 1)] = chanVals
+    return opcode, cmdDict
+
+
+#----------------------------------------------------------------
+#--- decode_batch
+#--- Return the list of (opcode, json form) of every command in a
+#--- batch.
+#----------------------------------------------------------------
+def decode_batch(data) -> list:
+    if not check_batch(data):
+        raise ValueError("Bad command batch")
+    cmds = []
+    offset = 0
+    while offset < len(data):
+        cmdLen = command_length(data, offset)
+        cmds.append(decode_command(data[offset:offset + cmdLen]))
+        offset += cmdLen
+    return cmds
+
+
+#----------------------------------------------------------------
+#--- _skip_space
+#--- Return the index of the first byte at or after pos that is
+#--- not white space.
+#----------------------------------------------------------------
+@micropython.native
+def _skip_space(data, pos, end) -> int:
+    while pos < end and (data[pos] == 0x20 or data[pos] == 0x0A or data[pos] == 0x0D or data[pos] == 0x09):
+        pos += 1
+    return pos
+
+
+#----------------------------------------------------------------
+#--- _chan_index
+#--- Return the index in CHAN_NAMES of a channel letter or -1.
+#----------------------------------------------------------------
+@micropython.native
+def _chan_index(letter) -> int:
+    if letter == 0x52:      # R
+        return 0
+    if letter == 0x47:      # G
+        return 1
+    if letter == 0x42:      # B
+        return 2
+    if letter == 0x57:      # W
+        return 3
+    return -1
+
+
+#----------------------------------------------------------------
+#--- scan_chan_json
+#--- Read a json setLED or setBright message of the usual shape,
+#--- e.g. b'{"1": {"R": "255", "G": "0"}, "2": {"W": 10}}', straight
+#--- from its bytes without building any dicts or strings.  The
+#--- value of each channel is put in chanVals (a bytearray(16)) at
+#--- its index in CHAN_KEYS.  Returns the mask of the channels set
+#--- (bit n is CHAN_KEYS[n]), or -1 for anything else (a batch,
+#--- a value over 255, bad json...) which should be handed to 
+#--- ujson.loads instead.  It is compiled to machine code so the
+#--- byte by byte scan is not left to the interpreter.
+#----------------------------------------------------------------
+@micropython.native
+def scan_chan_json(data, chanVals) -> int:
+    end = len(data)
+    pos = _skip_space(data, 0, end)
+    if pos >= end or data[pos] != _LBRACE:
+        return -1
+    chanMask = 0
+    while True:
+        #--- "ctrl#": {
+        pos = _skip_space(data, pos + 1, end)
+        if pos + 2 >= end or data[pos] != _QUOTE or data[pos + 2] != _QUOTE:
+            return -1
+        ctrlNdx = data[pos + 1] - 0x31
+        if ctrlNdx < 0 or ctrlNdx > 3:
+            return -1
+        pos = _skip_space(data, pos + 3, end)
+        if pos >= end or data[pos] != _COLON:
+            return -1
+        pos = _skip_space(data, pos + 1, end)
+        if pos >= end or data[pos] != _LBRACE:
+            return -1
+
+        while True:
+            #--- "chan": value or "chan": "value"
+            pos = _skip_space(data, pos + 1, end)
+            if pos + 2 >= end or data[pos] != _QUOTE or data[pos + 2] != _QUOTE:
+                return -1
+            chanNdx = _chan_index(data[pos + 1])
+            if chanNdx < 0:
+                return -1
+            pos = _skip_space(data, pos + 3, end)
+            if pos >= end or data[pos] != _COLON:
+                return -1
+            pos = _skip_space(data, pos + 1, end)
+            quoted = pos < end and data[pos] == _QUOTE
+            if quoted:
+                pos += 1
+            value = 0
+            numDigits = 0
+            firstDigit = pos
+            while pos < end and 0x30 <= data[pos] <= 0x39 and numDigits < 4:
+                value = value * 10 + data[pos] - 0x30
+                numDigits += 1
+                pos += 1
+            if numDigits == 0 or value > 255:
+                return -1
+            #--- json numbers can't have leading zeros (e.g. 05);
+            #--- leave ujson to reject them.
+            if not quoted and numDigits > 1 and data[firstDigit] == 0x30:
+                return -1
+            if quoted:
+                if pos >= end or data[pos] != _QUOTE:
+                    return -1
+                pos += 1
+            chanVals[ctrlNdx * 4 + chanNdx] = value
+            chanMask |= 1 << (ctrlNdx * 4 + chanNdx)
+
+            pos = _skip_space(data, pos, end)
+            if pos >= end:
+                return -1
+            if data[pos] == _RBRACE:
+                break
+            if data[pos] != _COMMA:
+                return -1
+
+        pos = _skip_space(data, pos + 1, end)
+        if pos >= end:
+            return -1
+        if data[pos] == _RBRACE:
+            break
+        if data[pos] != _COMMA:
+            return -1
+
+    if _skip_space(data, pos + 1, end) != end:
+        return -1
+    return chanMask
@@ -0,0 +1,802 @@
+#-------------------------------------------------------------------------------
+#--- config_codec.py
+#--- Encoders and decoders for the configuration message that is sent on
+#--- the config characteristic.  The central selects the encoding by
+#--- writing a format byte to the config characteristic before reading it.
+#--- It can also ask for a single section of the config by writing a 
+#--- request of [format, section, scene number] (see SECTION_xxx below).
+#--- This file must reside on the pico of the peripheral and on any 
+#--- central that wants to decode the binary format.
+#---
+#--- FMT_JSON   - The original '\n' terminated json string.
+#--- FMT_BINARY - A compact binary encoding of the same content:
+#---
+#---    Header:      magic (0xBC), version, total length (u16), parts (u8)
+#---    Controllers: (if parts has BIN_PART_CTRLS) 4 records of
+#---                    type code (u8)
+#---                    name (u8 length + utf-8 bytes)
+#---                    R, G, B, W channel names (u8 length + utf-8 bytes)
+#---    Scenes:      (if parts has BIN_PART_SCENES) scene count (u8) 
+#---                 followed by records of
+#---                    scene number (u8)
+#---                    name (u8 length + utf-8 bytes)
+#---                    (if parts has BIN_PART_BODIES)
+#---                    16 RGBW values (u8) in CHAN_KEYS order
+#---                    16 brightness values (u8) in CHAN_KEYS order
+#---
+#--- Either format can be or'ed with FMT_FLAG_DEFLATE to have it compressed
+#--- with the deflate module before it is sent:
+#---
+#---    Header:      magic (0xDF), compressed length (u16), raw length (u16)
+#---    Body:        raw deflate stream (wbits DEFLATE_WBITS) of the message
+#---
+#--- If the peripheral's firmware was built without deflate compression
+#--- the message is sent uncompressed. The central can always tell which
+#--- it got from the first byte: '{' for json, 0xBC for binary and 0xDF for
+#--- deflate.
+#---
+#--- Any format can also be or'ed with FMT_FLAG_FRAMED to have each notified
+#--- chunk carry a frame header so that lost chunks can be detected and 
+#--- resent:
+#---
+#---    Header:      transfer id (u8), offset (u16), total length (u16)
+#---    Body:        the bytes of the message at offset
+#---    CRC:         (last frame only) crc32 of the whole message (u32)
+#---
+#--- If a frame goes missing the central writes a resume request of 
+#--- [RESUME_REQUEST, transfer id, offset (u16)] to the config 
+#--- characteristic and the peripheral resends the message from that offset.
+#---
+#--- Or'ing a format with FMT_FLAG_LONG_READ instead has the config (or the 
+#--- section last requested) put in the value of the config characteristic
+#--- so that it can be fetched with ordinary (long) reads and no notifies.
+#--- A characteristic value is limited to ATT_MAX_VALUE_LEN bytes, so this
+#--- is only for the smaller binary and deflated messages.
+#---
+#--- All multi-byte numbers are little endian.
+#-------------------------------------------------------------------------------
+
+import binascii
+import io
+import json
+import struct
+import time
+
+from micropython import const
+
+try:
+    import deflate
+except ImportError:
+    deflate = None
+
+FMT_JSON = const(0)
+FMT_BINARY = const(1)
+FMT_FLAG_DEFLATE = const(0x10)
+FMT_FLAG_FRAMED = const(0x80)
+FMT_FLAG_LONG_READ = const(0x40)
+
+FRAME_HEADER = "<BHH"
+FRAME_HEADER_SIZE = const(5)
+FRAME_CRC = "<I"
+FRAME_CRC_SIZE = const(4)
+#--- The most a characteristic value can hold.
+ATT_MAX_VALUE_LEN = const(512)
+
+#--- Written to the config characteristic in place of a format byte.
+RESUME_REQUEST = const(0xFF)
+RESUME_HEADER = "<BBH"
+
+DEFLATE_MAGIC = const(0xDF)
+DEFLATE_HEADER = "<BHH"
+DEFLATE_HEADER_SIZE = const(5)
+#--- A 1k window keeps the decompressor small on the central and
+#--- still covers a whole scene worth of repeated keys.
+DEFLATE_WBITS = const(10)
+
+BIN_MAGIC = const(0xBC)
+BIN_VERSION = const(1)
+BIN_HEADER = "<BBHB"
+BIN_HEADER_SIZE = const(5)
+BIN_PART_CTRLS = const(0x01)
+BIN_PART_SCENES = const(0x02)
+BIN_PART_BODIES = const(0x04)
+
+#--- Sections of the config a central can ask for.
+SECTION_ALL = const(0)          # Everything (the default for a plain read)
+SECTION_CONTROLLERS = const(1)  # The 4 controllers only
+SECTION_SCENE_LIST = const(2)   # Scene numbers and names only
+SECTION_SCENE = const(3)        # One scene, including its values
+
+CTRL_KEYS = ("1", "2", "3", "4")
+CHAN_NAMES = ("R", "G", "B", "W")
+CTRL_TYPES = ("RGBW", "RGB+1", "4Chan")
+
+#--- The order of the 16 channels in a packed scene body.
+CHAN_KEYS = (
+    "1R", "1G", "1B", "1W",
+    "2R", "2G", "2B", "2W",
+    "3R", "3G", "3B", "3W",
+    "4R", "4G", "4B", "4W",
+)
+
+
+#----------------------------------------------------------------
+#--- _name_bytes
+#--- Names are sent as utf-8 with a single length byte in front.
+#----------------------------------------------------------------
+def _name_bytes(aName):
+    return aName.encode('utf-8')[:255]
+
+
+#----------------------------------------------------------------
+#--- _pack_name_into
+#--- Pack a length prefixed name into buf at offset and return
+#--- the offset just past the name.
+#----------------------------------------------------------------
+def _pack_name_into(buf, offset, aName):
+    nameBytes = _name_bytes(aName)
+    buf[offset] = len(nameBytes)
+    offset += 1
+    buf[offset:offset + len(nameBytes)] = nameBytes
+    return offset + len(nameBytes)
+
+
+#----------------------------------------------------------------
+#--- _unpack_name
+#--- Read a length prefixed name from data at offset. Returns the
+#--- name and the offset just past it.
+#----------------------------------------------------------------
+def _unpack_name(data, offset):
+    nameLen = data[offset]
+    offset += 1
+    return str(bytes(data[offset:offset + nameLen]), 'utf-8'), offset + nameLen
+
+
+#----------------------------------------------------------------
+#--- section_parts
+#--- Return the binary parts mask and the list of saved scene
+#--- numbers that make up the requested section of the config.
+#----------------------------------------------------------------
+def section_parts(cfgObj, section, sceneNum=0):
+    if section == SECTION_CONTROLLERS:
+        return BIN_PART_CTRLS, []
+    if section == SECTION_SCENE_LIST:
+        return BIN_PART_SCENES, cfgObj.scene_numbers()
+    if section == SECTION_SCENE:
+        sceneNums = [sceneNum] if cfgObj.scene(sceneNum) is not None else []
+        return BIN_PART_SCENES | BIN_PART_BODIES, sceneNums
+    return BIN_PART_CTRLS | BIN_PART_SCENES | BIN_PART_BODIES, cfgObj.scene_numbers()
+
+
+#----------------------------------------------------------------
+#--- section_dict
+#--- Return a dictionary with the same shape as the config json
+#--- that only holds the requested section of the ConfigObj.
+#----------------------------------------------------------------
+def section_dict(cfgObj, section, sceneNum=0) -> dict:
+    parts, sceneNums = section_parts(cfgObj, section, sceneNum)
+    sectDict = cfgObj.to_dict(parts & BIN_PART_CTRLS, sceneNums, parts & BIN_PART_BODIES)
+    if not parts & BIN_PART_SCENES:
+        del sectDict["Scenes"]
+    return sectDict
+
+
+#----------------------------------------------------------------
+#--- _ctrl_size / _scene_size
+#--- The number of bytes one controller or scene record takes in
+#--- the binary encoding.
+#----------------------------------------------------------------
+def _ctrl_size(ctrl) -> int:
+    size = 1 + 1 + len(_name_bytes(ctrl.name))
+    for chanName in ctrl.chan_names:
+        size += 1 + len(_name_bytes(chanName))
+    return size
+
+def _scene_size(scene, withValues) -> int:
+    size = 1 + 1 + len(_name_bytes(scene.name))
+    if withValues:
+        size += 32
+    return size
+
+
+#----------------------------------------------------------------
+#--- _pack_ctrl_into / _pack_scene_into
+#--- Pack one controller or scene record into buf at offset and
+#--- return the offset just past it.
+#----------------------------------------------------------------
+def _pack_ctrl_into(buf, offset, ctrl) -> int:
+    if ctrl.type in CTRL_TYPES:
+        buf[offset] = CTRL_TYPES.index(ctrl.type)
+    else:
+        buf[offset] = 0
+    offset = _pack_name_into(buf, offset + 1, ctrl.name)
+    for chanName in ctrl.chan_names:
+        offset = _pack_name_into(buf, offset, chanName)
+    return offset
+
+def _pack_scene_into(buf, offset, sceneNum, scene, withValues) -> int:
+    buf[offset] = sceneNum
+    offset = _pack_name_into(buf, offset + 1, scene.name)
+    if withValues:
+        buf[offset:offset + 16] = scene.values
+        buf[offset + 16:offset + 32] = scene.brightness
+        offset += 32
+    return offset
+
+
+#----------------------------------------------------------------
+#--- binary_size
+#--- Return the number of bytes the binary encoding of the passed
+#--- in ConfigObj (or a section of it) will take so that the
+#--- caller can make sure its buffer is big enough.
+#----------------------------------------------------------------
+def binary_size(cfgObj, section=SECTION_ALL, sceneNum=0) -> int:
+    parts, sceneNums = section_parts(cfgObj, section, sceneNum)
+    size = BIN_HEADER_SIZE
+    if parts & BIN_PART_CTRLS:
+        for ctrl in cfgObj.controllers:
+            size += _ctrl_size(ctrl)
+    if parts & BIN_PART_SCENES:
+        size += 1
+        for sceneNum in sceneNums:
+            size += _scene_size(cfgObj.scene(sceneNum), parts & BIN_PART_BODIES)
+    return size
+
+
+#----------------------------------------------------------------
+#--- pack_binary_into
+#--- Encode the ConfigObj (or a section of it) into the
+#--- preallocated buffer starting at offset 0. The buffer must be
+#--- at least binary_size() bytes. Returns the number of bytes used.
+#----------------------------------------------------------------
+def pack_binary_into(cfgObj, buf, section=SECTION_ALL, sceneNum=0) -> int:
+    parts, sceneNums = section_parts(cfgObj, section, sceneNum)
+    offset = BIN_HEADER_SIZE
+    if parts & BIN_PART_CTRLS:
+        for ctrl in cfgObj.controllers:
+            offset = _pack_ctrl_into(buf, offset, ctrl)
+
+    if parts & BIN_PART_SCENES:
+        buf[offset] = len(sceneNums)
+        offset += 1
+        for sceneNum in sceneNums:
+            offset = _pack_scene_into(buf, offset, sceneNum, cfgObj.scene(sceneNum), parts & BIN_PART_BODIES)
+
+    struct.pack_into(BIN_HEADER, buf, 0, BIN_MAGIC, BIN_VERSION, offset, parts)
+    return offset
+
+
+#----------------------------------------------------------------
+#--- iter_binary
+#--- Generate the binary encoding of the ConfigObj (or a section
+#--- of it) one record at a time so that the whole message never
+#--- has to be in memory.
+#----------------------------------------------------------------
+def iter_binary(cfgObj, section=SECTION_ALL, sceneNum=0):
+    parts, sceneNums = section_parts(cfgObj, section, sceneNum)
+    header = bytearray(BIN_HEADER_SIZE)
+    struct.pack_into(BIN_HEADER, header, 0, BIN_MAGIC, BIN_VERSION,
+                     binary_size(cfgObj, section, sceneNum), parts)
+    yield header
+    if parts & BIN_PART_CTRLS:
+        for ctrl in cfgObj.controllers:
+            record = bytearray(_ctrl_size(ctrl))
+            _pack_ctrl_into(record, 0, ctrl)
+            yield record
+
+    if parts & BIN_PART_SCENES:
+        yield bytes((len(sceneNums),))
+        for sceneNum in sceneNums:
+            scene = cfgObj.scene(sceneNum)
+            record = bytearray(_scene_size(scene, parts & BIN_PART_BODIES))
+            _pack_scene_into(record, 0, sceneNum, scene, parts & BIN_PART_BODIES)
+            yield record
+
+
+#----------------------------------------------------------------
+#--- iter_json
+#--- Generate the '\n' terminated json encoding of the ConfigObj
+#--- (or a section of it) one controller or scene at a time so
+#--- that the whole message never has to be in memory.
+#----------------------------------------------------------------
+def iter_json(cfgObj, section=SECTION_ALL, sceneNum=0):
+    parts, sceneNums = section_parts(cfgObj, section, sceneNum)
+    sep = b'{'
+    if parts & BIN_PART_CTRLS:
+        for ctrlNdx in range(4):
+            yield sep + json.dumps(CTRL_KEYS[ctrlNdx]).encode('utf-8') + b': '
+            yield json.dumps(cfgObj.ctrl_dict(cfgObj.controllers[ctrlNdx])).encode('utf-8')
+            sep = b', '
+    if parts & BIN_PART_SCENES:
+        yield sep + b'"Scenes": '
+        sep = b'{'
+        for sceneNum in sceneNums:
+            scene = cfgObj.scene(sceneNum)
+            yield sep + json.dumps(str(sceneNum)).encode('utf-8') + b': '
+            yield json.dumps(cfgObj.scene_dict(scene, parts & BIN_PART_BODIES)).encode('utf-8')
+            sep = b', '
+        if sep == b'{':
+            yield sep
+        yield b'}'
+    yield b'}\n'
+
+
+#----------------------------------------------------------------
+#--- binary_length
+#--- Return the total length of a binary config message from its
+#--- header, or 0 if not enough of the message has arrived yet
+#--- to tell.
+#----------------------------------------------------------------
+def binary_length(data) -> int:
+    if len(data) < BIN_HEADER_SIZE:
+        return 0
+    magic, version, total, parts = struct.unpack_from(BIN_HEADER, data, 0)
+    if magic != BIN_MAGIC:
+        raise ValueError("Not a binary config message")
+    return total
+
+
+#----------------------------------------------------------------
+#--- decode_binary
+#--- Decode a complete binary config message back into the same
+#--- dictionary shape as the json config message.  Only the parts
+#--- present in the message show up in the dictionary.
+#----------------------------------------------------------------
+def decode_binary(data) -> dict:
+    magic, version, total, parts = struct.unpack_from(BIN_HEADER, data, 0)
+    if magic != BIN_MAGIC or version != BIN_VERSION:
+        raise ValueError("Unsupported binary config message")
+
+    cfgDict = {}
+    offset = BIN_HEADER_SIZE
+    if parts & BIN_PART_CTRLS:
+        for ctrlKey in CTRL_KEYS:
+            typeCode = data[offset]
+            ctrlType = CTRL_TYPES[typeCode] if typeCode < len(CTRL_TYPES) else CTRL_TYPES[0]
+            ctrlName, offset = _unpack_name(data, offset + 1)
+            chanNames = {}
+            for chan in CHAN_NAMES:
+                chanNames[chan], offset = _unpack_name(data, offset)
+            cfgDict[ctrlKey] = {"Name": ctrlName, "Type": ctrlType, "ChanNames": chanNames}
+
+    if parts & BIN_PART_SCENES:
+        scenes = {}
+        sceneCount = data[offset]
+        offset += 1
+        for _ in range(sceneCount):
+            sceneKey = str(data[offset])
+            sceneName, offset = _unpack_name(data, offset + 1)
+            scenes[sceneKey] = {"Name": sceneName}
+            if parts & BIN_PART_BODIES:
+                values = {}
+                dims = {}
+                for i in range(16):
+                    values[CHAN_KEYS[i]] = data[offset + i]
+                    dims[CHAN_KEYS[i]] = data[offset + 16 + i]
+                offset += 32
+                scenes[sceneKey]["RGBWValues"] = values
+                scenes[sceneKey]["Brightness"] = dims
+        cfgDict["Scenes"] = scenes
+
+    return cfgDict
+
+
+#----------------------------------------------------------------
+#--- compress
+#--- Deflate the passed in message and put the deflate header in
+#--- front of it.  Returns None if this firmware can't compress.
+#----------------------------------------------------------------
+def compress(data):
+    if deflate is None:
+        return None
+    stream = io.BytesIO()
+    try:
+        stream.write(struct.pack(DEFLATE_HEADER, DEFLATE_MAGIC, 0, len(data)))
+        with deflate.DeflateIO(stream, deflate.RAW, DEFLATE_WBITS) as dstream:
+            dstream.write(data)
+    except (OSError, ValueError):
+        #--- Compression support is optional in the firmware.
+        return None
+    compData = bytearray(stream.getvalue())
+    struct.pack_into("<H", compData, 1, len(compData) - DEFLATE_HEADER_SIZE)
+    return compData
+
+
+#----------------------------------------------------------------
+#--- deflate_length
+#--- Return the total length of a deflated config message from its
+#--- header, or 0 if not enough of it has arrived yet to tell.
+#----------------------------------------------------------------
+def deflate_length(data) -> int:
+    if len(data) < DEFLATE_HEADER_SIZE:
+        return 0
+    magic, compLen, rawLen = struct.unpack_from(DEFLATE_HEADER, data, 0)
+    if magic != DEFLATE_MAGIC:
+        raise ValueError("Not a deflated config message")
+    return DEFLATE_HEADER_SIZE + compLen
+
+
+#----------------------------------------------------------------
+#--- decompress
+#--- Inflate a complete deflated config message into a buffer of
+#--- the raw length given in its header and return it.
+#----------------------------------------------------------------
+def decompress(data):
+    magic, compLen, rawLen = struct.unpack_from(DEFLATE_HEADER, data, 0)
+    body = io.BytesIO(bytes(data[DEFLATE_HEADER_SIZE:DEFLATE_HEADER_SIZE + compLen]))
+    rawData = bytearray(rawLen)
+    with deflate.DeflateIO(body, deflate.RAW, DEFLATE_WBITS) as dstream:
+        dstream.readinto(rawData)
+    return rawData
+
+
+#----------------------------------------------------------------
+#--- message_length
+#--- Return the total length of a config message of any format
+#--- from the first bytes received, or 0 if it can't tell yet.
+#--- JSON messages have no length and end with '\n' instead.
+#----------------------------------------------------------------
+def message_length(data) -> int:
+    if len(data) == 0:
+        return 0
+    if data[0] == DEFLATE_MAGIC:
+        return deflate_length(data)
+    if data[0] == BIN_MAGIC:
+        return binary_length(data)
+    return 0
+
+
+#----------------------------------------------------------------
+#--- is_complete
+#--- Returns true once a whole config message of any format has
+#--- been received.
+#----------------------------------------------------------------
+def is_complete(data) -> bool:
+    total = message_length(data)
+    if total:
+        return len(data) >= total
+    return len(data) > 0 and data[0] == ord('{') and data[-1] == ord('\n')
+
+
+#----------------------------------------------------------------
+#--- decode_message
+#--- Decode a complete config message of any format into the
+#--- config dictionary, inflating it first if needed.
+#----------------------------------------------------------------
+def decode_message(data) -> dict:
+    if data[0] == DEFLATE_MAGIC:
+        data = decompress(data)
+    if data[0] == BIN_MAGIC:
+        return decode_binary(data)
+    return json.loads(bytes(data).strip())
+
+
+#----------------------------------------------------------------
+#--- frame_crc
+#--- The crc sent in the last frame of a framed message.
+#----------------------------------------------------------------
+def frame_crc(data) -> int:
+    return binascii.crc32(data) & 0xFFFFFFFF
+
+
+#----------------------------------------------------------------
+#--- frame_data_len
+#--- Return how many bytes of a message of length total, starting
+#--- at offset, go in the next frame when a frame can hold room
+#--- bytes after its header. The last frame also has to hold the
+#--- crc, so when the rest of the message fits but the crc does
+#--- not, one byte is held back for a frame of its own.
+#----------------------------------------------------------------
+def frame_data_len(total, offset, room) -> int:
+    remaining = total - offset
+    if remaining + FRAME_CRC_SIZE <= room:
+        return remaining
+    if remaining > room:
+        return room
+    return remaining - 1
+
+
+#----------------------------------------------------------------
+#--- pack_frame_header
+#--- Put the header of the frame holding dataLen bytes from offset
+#--- in buf, and the crc of the whole message after the data if it
+#--- is the last frame, and return the length of the frame.  The
+#--- data itself must already be in buf after the header.
+#----------------------------------------------------------------
+def pack_frame_header(buf, tid, offset, dataLen, total, crc) -> int:
+    struct.pack_into(FRAME_HEADER, buf, 0, tid, offset, total)
+    frameLen = FRAME_HEADER_SIZE + dataLen
+    if offset + dataLen == total:
+        struct.pack_into(FRAME_CRC, buf, frameLen, crc)
+        frameLen += FRAME_CRC_SIZE
+    return frameLen
+
+
+#----------------------------------------------------------------
+#--- pack_frame_into
+#--- Build the frame holding dataLen bytes of data from offset in
+#--- the preallocated buffer and return the length of the frame.
+#--- The last frame gets the crc of the whole message.  data
+#--- should be a memoryview so that nothing is copied but the
+#--- chunk itself, or a ConfigStream at offset, in which case
+#--- the total length of the message must be passed in.
+#----------------------------------------------------------------
+def pack_frame_into(buf, tid, data, offset, dataLen, crc, total=None) -> int:
+    if total is None:
+        total = len(data)
+    frameLen = FRAME_HEADER_SIZE + dataLen
+    if isinstance(data, ConfigStream):
+        data.readinto(memoryview(buf)[FRAME_HEADER_SIZE:frameLen])
+    else:
+        buf[FRAME_HEADER_SIZE:frameLen] = data[offset:offset + dataLen]
+    return pack_frame_header(buf, tid, offset, dataLen, total, crc)
+
+
+#----------------------------------------------------------------
+#--- FrameAssembler
+#--- Collects the frames of a framed message on the central.  A
+#--- frame that is not the next one expected is dropped and
+#--- resume_needed is set so that the central can ask for the
+#--- rest with resume_request().  A frame of a new transfer id
+#--- starts collecting that transfer, and if its first frames
+#--- were lost the rest is asked for from offset 0.  Once the crc
+#--- checks out the message is in data and complete is set.
+#----------------------------------------------------------------
+class FrameAssembler:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.tid = -1
+        self.total = 0
+        self.received = 0
+        self.data = None
+        self.complete = False
+        self.resume_needed = False
+        self._resume_from = -1
+
+    #----------------------------------------------
+    #--- add
+    #--- Add a notified frame. Returns True when it
+    #--- completes the message.
+    #----------------------------------------------
+    def add(self, frame) -> bool:
+        tid, offset, total = struct.unpack_from(FRAME_HEADER, frame, 0)
+        if tid != self.tid:
+            #--- A new transfer, e.g. the peripheral starting over
+            #--- after the config changed.  If its first frames were
+            #--- lost the gap below asks for it from 0.
+            self.reset()
+            self.tid = tid
+            self.total = total
+            self.data = bytearray(total)
+        if self.complete:
+            return False
+        if offset != self.received:
+            #--- A frame went missing. Frames already in flight past
+            #--- the gap don't ask again for the same offset.
+            if offset > self.received and self._resume_from != self.received:
+                self.resume_needed = True
+            return False
+
+        dataLen = min(len(frame) - FRAME_HEADER_SIZE, total - offset)
+        self.data[offset:offset + dataLen] = frame[FRAME_HEADER_SIZE:FRAME_HEADER_SIZE + dataLen]
+        self.received += dataLen
+        if self.received < total:
+            return False
+
+        crc = struct.unpack_from(FRAME_CRC, frame, FRAME_HEADER_SIZE + dataLen)[0]
+        if crc != frame_crc(self.data):
+            print("Config crc mismatch, starting over")
+            self.received = 0
+            self._resume_from = -1
+            self.resume_needed = True
+            return False
+        self.complete = True
+        self.resume_needed = False
+        return True
+
+    #----------------------------------------------
+    #--- resume_request
+    #--- The bytes to write to the config
+    #--- characteristic to have the rest of the
+    #--- message resent.
+    #----------------------------------------------
+    def resume_request(self):
+        self._resume_from = self.received
+        self.resume_needed = False
+        return struct.pack(RESUME_HEADER, RESUME_REQUEST, self.tid & 0xFF, self.received)
+
+
+#----------------------------------------------------------------
+#--- ConfigStream
+#--- A config message in FMT_JSON or FMT_BINARY that is encoded as
+#--- it is read instead of being held in memory.  readinto() fills
+#--- the caller's (notify sized) buffer from the pieces made by
+#--- iter_json or iter_binary, so only one controller or scene is
+#--- encoded at a time however many scenes are saved.  The message
+#--- is of the config version when the stream was made; stale()
+#--- tells if the config has changed since.  With snapshot it is
+#--- encoded from a copy of the records (see ConfigObj.snapshot)
+#--- and never goes stale, for transfers that can't start over.
+#----------------------------------------------------------------
+class ConfigStream:
+
+    def __init__(self, cfgObj, fmt, section=SECTION_ALL, sceneNum=0, snapshot=False):
+        self._cfgObj = cfgObj.snapshot() if snapshot else cfgObj
+        self._fmt = fmt
+        self._section = section
+        self._sceneNum = sceneNum
+        self.version = self._cfgObj.version
+        self.rewind()
+
+    def stale(self) -> bool:
+        return self._cfgObj.version != self.version
+
+    #----------------------------------------------
+    #--- refresh
+    #--- Start over with the current config version.
+    #----------------------------------------------
+    def refresh(self):
+        self.version = self._cfgObj.version
+        self.rewind()
+
+    #----------------------------------------------
+    #--- rewind
+    #--- Start the message over from the first byte.
+    #----------------------------------------------
+    def rewind(self):
+        if self._fmt == FMT_BINARY:
+            self._pieces = iter_binary(self._cfgObj, self._section, self._sceneNum)
+        else:
+            self._pieces = iter_json(self._cfgObj, self._section, self._sceneNum)
+        self._piece = b''
+        self._pieceOffset = 0
+        self.offset = 0
+
+    #----------------------------------------------
+    #--- readinto
+    #--- Fill buf with the next bytes of the message
+    #--- (or skip them if buf is None and count is
+    #--- given).  Returns how many bytes were read,
+    #--- less than asked for only at the end.
+    #----------------------------------------------
+    def readinto(self, buf, count=None) -> int:
+        if count is None:
+            count = len(buf)
+        done = 0
+        while done < count:
+            if self._pieceOffset >= len(self._piece):
+                try:
+                    self._piece = next(self._pieces)
+                except StopIteration:
+                    break
+                self._pieceOffset = 0
+                continue
+            take = min(count - done, len(self._piece) - self._pieceOffset)
+            if buf is not None:
+                buf[done:done + take] = memoryview(self._piece)[self._pieceOffset:self._pieceOffset + take]
+            self._pieceOffset += take
+            done += take
+        self.offset += done
+        return done
+
+    #----------------------------------------------
+    #--- seek
+    #--- Move to offset by encoding the message up
+    #--- to there again.
+    #----------------------------------------------
+    def seek(self, offset):
+        if offset < self.offset:
+            self.rewind()
+        self.readinto(None, offset - self.offset)
+
+    #----------------------------------------------
+    #--- measure
+    #--- Encode the whole message once to get its
+    #--- length and frame_crc, then rewind.
+    #----------------------------------------------
+    def measure(self):
+        self.rewind()
+        length = 0
+        crc = 0
+        for piece in self._pieces:
+            length += len(piece)
+            crc = binascii.crc32(piece, crc)
+        self.rewind()
+        return length, crc & 0xFFFFFFFF
+
+
+#----------------------------------------------------------------
+#--- ConfigCache
+#--- Holds the encoded config messages for the current version of
+#--- a ConfigObj.  Each format and section is encoded (and 
+#--- compressed) on its own the first time it is asked for after
+#--- the config changes.  Notified transfers of the uncompressed
+#--- formats are streamed instead (see source()).
+#----------------------------------------------------------------
+class ConfigCache:
+
+    def __init__(self, cfgObj):
+        self._cfgObj = cfgObj
+        self._version = -1
+        self._payloads = {}
+
+    #----------------------------------------------
+    #--- get
+    #--- Return the config message in the requested
+    #--- format byte for the requested section of the
+    #--- current config version.
+    #----------------------------------------------
+    def get(self, fmt, section=SECTION_ALL, sceneNum=0):
+        if self._version != self._cfgObj.version:
+            self._payloads = {}
+            self._version = self._cfgObj.version
+        if section != SECTION_SCENE:
+            sceneNum = 0
+        key = (fmt, section, sceneNum)
+        if key not in self._payloads:
+            self._payloads[key] = self._encode(key)
+        return self._payloads[key]
+
+    #----------------------------------------------
+    #--- cached
+    #--- Return the message like get() if it is
+    #--- already encoded for the current config
+    #--- version, otherwise None.  It never encodes,
+    #--- so it can be called from the BLE IRQ.
+    #----------------------------------------------
+    def cached(self, fmt, section=SECTION_ALL, sceneNum=0):
+        if self._version != self._cfgObj.version:
+            return None
+        if section != SECTION_SCENE:
+            sceneNum = 0
+        return self._payloads.get((fmt, section, sceneNum))
+
+    #----------------------------------------------
+    #--- source
+    #--- Return what the peripheral should send for
+    #--- the requested format byte (with its framed
+    #--- flag) and section: a ConfigStream that
+    #--- encodes it as it is sent, or the cached
+    #--- message for a deflated one, which has to
+    #--- be compressed whole.  A framed transfer can
+    #--- start over if the config changes while it
+    #--- is sent, but a plain one can't (the central
+    #--- would not know) so it streams a snapshot of
+    #--- the version it started with.
+    #----------------------------------------------
+    def source(self, fmt, section=SECTION_ALL, sceneNum=0):
+        if fmt & FMT_FLAG_DEFLATE:
+            return self.get(fmt & ~FMT_FLAG_FRAMED, section, sceneNum)
+        framed = fmt & FMT_FLAG_FRAMED
+        return ConfigStream(self._cfgObj, fmt & ~FMT_FLAG_FRAMED, section, sceneNum, not framed)
+
+    def _encode(self, key):
+        fmt, section, sceneNum = key
+        if fmt & FMT_FLAG_DEFLATE:
+            #--- The uncompressed message is not kept.
+            rawData = self._encode((fmt & ~FMT_FLAG_DEFLATE, section, sceneNum))
+            startTime = time.ticks_ms()
+            compData = compress(rawData)
+            if compData is None:
+                return rawData
+            print("Config deflated from {} to {} bytes in {} ms".format(
+                len(rawData), len(compData), time.ticks_diff(time.ticks_ms(), startTime)))
+            return compData
+
+        cfgObj = self._cfgObj
+        if fmt == FMT_BINARY:
+            #--- A new buffer for each config version since the old one
+            #--- may still be in the peripheral's transmit queue.
+            binBuf = bytearray(binary_size(cfgObj, section, sceneNum))
+            pack_binary_into(cfgObj, binBuf, section, sceneNum)
+            return binBuf
+
+        if section == SECTION_ALL:
+            cfgBytes = cfgObj.to_json().encode('utf-8')
+        else:
+            cfgBytes = json.dumps(section_dict(cfgObj, section, sceneNum)).encode('utf-8')
+        cfgBytes += b'\n'
+        return cfgBytes
@@ -14,6 +14,12 @@ import json
 
 import random
 import struct
+import time
+
+import config_codec
+import command_codec
+import led_stream
+import led_state
 
 # org.bluetooth.service.environmental_sensing
 _ENV_SENSE_UUID = bluetooth.UUID(0x181A)
@@ -30,10 +36,19 @@ SELECT_SCENE_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c55")
 SAVE_SCENE_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c56")
 SET_CTRL_TYPE_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c57")
 BOX_ID_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c58")
+BIN_CMD_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c5A")
+SET_LED_NO_RSP_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c5B")
+SET_BRIGHT_NO_RSP_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c5C")
+STREAM_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c5D")
+STATE_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c5E")
 
 SCAN_DURATION_MS = const(5000)
 SCAN_INTERVAL_US = const(30000)
 SCAN_WINDOW_US = const(30000)
+#--- Connection interval to ask for.  Only the central can choose it,
+#--- when it connects; a short one keeps the commands snappy.
+MIN_CONN_INTERVAL_US = const(15000)
+MAX_CONN_INTERVAL_US = const(30000)
 
 # MAX_MTU = const(100)
 # MAX_CHUNK = const(MAX_MTU - 3)
@@ -43,6 +58,13 @@ SCAN_WINDOW_US = const(30000)
 # Chunked data receiver configuration
 CHUNK_TIMEOUT_MS = 500  # Timeout to wait for next chunk before considering transfer complete
 MAX_WAIT_MS = 5000      # Maximum time to wait for chunks to arrive
+MAX_RESUMES = 3         # Times to ask for the rest of a framed config
+LONG_READ_TRIES = 3     # Reads of a long read config before giving up
+LONG_READ_RETRY_MS = 50 # Wait between them
+BENCH_UPDATES = 50      # Color updates sent by each half of the command benchmark
+WHEEL_STEPS = 120       # Colors sent by one turn of the color wheel
+STREAM_SECS = 10        # Length of a streamed show
+WATCH_SECS = 30         # How long to follow the live state
 
 
 #----------------------------------------------------------------
@@ -366,35 +388,310 @@ async def read_chunked_config(config_char, receiver):
         return b''
 
 
+#-------------------------------------------------------
+#--- read_config_notified
+#--- Select the config format by writing its format byte to
+#--- the config characteristic, trigger the transfer with a
+#--- read and collect the notified chunks until the message is
+#--- complete. JSON messages end with a '\n' and binary and
+#--- deflated messages carry their length in the header.
+#--- If a section is given, the request for just that section
+#--- is written instead and the peripheral answers it without
+#--- a read.
+#--- If the format is framed, a lost chunk (or a timeout before
+#--- the last one) is answered with a resume request so only the
+#--- missing part is sent again.
+#---
+#--- Args:
+#---     config_char: The config characteristic object
+#---     fmt: One of the config_codec.FMT_xxx format bytes
+#---     section: None for a plain read or config_codec.SECTION_xxx
+#---     sceneNum: The scene number for SECTION_SCENE
+#---
+#--- Returns:
+#---     The decoded config dictionary or None on timeout
+#-------------------------------------------------------
+async def read_config_notified(config_char, fmt, section=None, sceneNum=0):
+
+    await config_char.subscribe(notify=True)
+    if section is None:
+        await config_char.write(bytes([fmt]), response=True)
+
+        #--- The data returned by the read itself is ignored, the
+        #--- config arrives as notifications.
+        await config_char.read()
+    else:
+        await config_char.write(bytes([fmt, section, sceneNum]), response=True)
+
+    if fmt & config_codec.FMT_FLAG_FRAMED:
+        return await _read_config_frames(config_char)
+
+    chunks = b''
+    while True:
+        try:
+            data = await config_char.notified(timeout_ms=MAX_WAIT_MS)
+        except asyncio.TimeoutError:
+            print("Timeout waiting for config chunk")
+            return None
+        chunks += bytes(data)
+
+        #--- Deflated messages are inflated in one go once the
+        #--- last chunk is in since the deflate module can only
+        #--- pull from a stream that already holds all of the data.
+        if config_codec.is_complete(chunks):
+            print(f"Config received ({len(chunks)} bytes)")
+            return config_codec.decode_message(chunks)
+
+
+#-------------------------------------------------------
+#--- read_config_long
+#--- Put a section of the config in the config characteristic's
+#--- value by writing the request with the long read flag, then
+#--- read it.  aioble only does a single read, so this is only
+#--- whole if the message fits in the MTU; a phone reading blobs
+#--- can get up to 512 bytes.
+#-------------------------------------------------------
+async def read_config_long(config_char, fmt, section, sceneNum=0):
+    await config_char.write(bytes([fmt | config_codec.FMT_FLAG_LONG_READ, section, sceneNum]), response=True)
+    for attempt in range(LONG_READ_TRIES):
+        try:
+            data = await config_char.read()
+            break
+        except aioble.GattError:
+            #--- The peripheral refuses the read until it has encoded
+            #--- the message, e.g. just after the config changed.
+            await asyncio.sleep_ms(LONG_READ_RETRY_MS)
+    else:
+        print("The config could not be read")
+        return None
+    if not config_codec.is_complete(data):
+        print(f"Only got the first {len(data)} bytes of the config")
+        return None
+    return config_codec.decode_message(data)
+
+
+#-------------------------------------------------------
+#--- _read_config_frames
+#--- Collect the frames of a framed config message, asking
+#--- for the rest of it up to MAX_RESUMES times when frames
+#--- go missing.
+#-------------------------------------------------------
+async def _read_config_frames(config_char):
+    frames = config_codec.FrameAssembler()
+    resumes = 0
+    while True:
+        try:
+            data = await config_char.notified(timeout_ms=MAX_WAIT_MS)
+        except asyncio.TimeoutError:
+            if frames.tid < 0 or resumes >= MAX_RESUMES:
+                print("Timeout waiting for config chunk")
+                return None
+            frames.resume_needed = True
+            data = None
+
+        if data is not None and frames.add(data):
+            print(f"Config received ({frames.total} bytes, {resumes} resumes)")
+            return config_codec.decode_message(frames.data)
+
+        if frames.resume_needed:
+            if resumes >= MAX_RESUMES:
+                print("Too many lost config chunks")
+                return None
+            resumes += 1
+            print(f"Resuming config at {frames.received}")
+            await config_char.write(frames.resume_request(), response=True)
+
+
+#-------------------------------------------------------
+#--- state_messages
+#--- Build the messages that set the value and brightness
+#--- of all 16 channels in one of three ways:
+#---     "json":   a setLED and a setBright message per controller
+#---     "batch":  one json batch message to setLED
+#---     "binary": one binary command batch
+#--- Returns a list of (characteristic name, message).
+#-------------------------------------------------------
+def state_messages(mode, values, brightness):
+    if "binary" == mode:
+        return [("binCmd", command_codec.pack_state(values, brightness))]
+    if "batch" == mode:
+        batch = {"V": {}, "B": {}}
+        for ctrlNdx in range(4):
+            batch["V"][str(ctrlNdx + 1)] = values[ctrlNdx * 4:ctrlNdx * 4 + 4]
+            batch["B"][str(ctrlNdx + 1)] = brightness[ctrlNdx * 4:ctrlNdx * 4 + 4]
+        return [("setLED", json.dumps(batch).encode('utf-8'))]
+    msgs = []
+    for ctrlNdx in range(4):
+        chanVals = {}
+        chanDims = {}
+        for chanNdx in range(4):
+            chanVals[config_codec.CHAN_NAMES[chanNdx]] = str(values[ctrlNdx * 4 + chanNdx])
+            chanDims[config_codec.CHAN_NAMES[chanNdx]] = str(brightness[ctrlNdx * 4 + chanNdx])
+        msgs.append(("setLED", json.dumps({ctrlNdx + 1: chanVals}).encode('utf-8')))
+        msgs.append(("setBright", json.dumps({ctrlNdx + 1: chanDims}).encode('utf-8')))
+    return msgs
+
+
+#-------------------------------------------------------
+#--- compare_commands
+#--- Set the value and brightness of all 16 channels
+#--- BENCH_UPDATES times with each kind of message and
+#--- print the messages/s, bytes/message and updates/s 
+#--- of each.  chars maps the characteristic names used
+#--- by state_messages to the characteristics.
+#-------------------------------------------------------
+async def compare_commands(chars):
+    results = []
+    for mode in ("json", "batch", "binary"):
+        numMsgs = 0
+        numBytes = 0
+        startMs = time.ticks_ms()
+        for update in range(BENCH_UPDATES):
+            values = [(update * 5 + chanNdx * 16) % 256 for chanNdx in range(16)]
+            brightness = [100 - (update + chanNdx) % 50 for chanNdx in range(16)]
+            for charName, msg in state_messages(mode, values, brightness):
+                await chars[charName].write(msg, response=True)
+                numMsgs += 1
+                numBytes += len(msg)
+        elapsedMs = max(1, time.ticks_diff(time.ticks_ms(), startMs))
+        results.append((mode, numMsgs, numBytes, elapsedMs))
+
+    for mode, numMsgs, numBytes, elapsedMs in results:
+        print(f"{mode}: {numMsgs // BENCH_UPDATES} writes/update, {numBytes // numMsgs} bytes/message, "
+              f"{numMsgs * 1000 // elapsedMs} messages/s, {BENCH_UPDATES * 1000 // elapsedMs} updates/s")
+
+
+#-------------------------------------------------------
+#--- color_wheel
+#--- Turn controller 1 once around the color wheel as fast
+#--- as the characteristic takes it, like a finger dragging
+#--- across the wheel in the app, and print the updates/s.
+#--- Writes to a no response characteristic don't wait for
+#--- the peripheral so they can go several per connection
+#--- interval.
+#-------------------------------------------------------
+async def color_wheel(led_char, response):
+    startMs = time.ticks_ms()
+    for step in range(WHEEL_STEPS):
+        sector, frac = divmod(step * 6 * 255 // WHEEL_STEPS, 255)
+        rgb = ((255, frac, 0), (255 - frac, 255, 0), (0, 255, frac),
+               (0, 255 - frac, 255), (frac, 0, 255), (255, 0, 255 - frac))[sector]
+        msg = json.dumps({1: {"R": str(rgb[0]), "G": str(rgb[1]), "B": str(rgb[2])}}).encode('utf-8')
+        await led_char.write(msg, response=response)
+    elapsedMs = max(1, time.ticks_diff(time.ticks_ms(), startMs))
+    print(f"{'with' if response else 'without'} response: {WHEEL_STEPS} updates in {elapsedMs} ms, "
+          f"{WHEEL_STEPS * 1000 // elapsedMs} updates/s")
+
+
+#-------------------------------------------------------
+#--- stream_show
+#--- Stream STREAM_SECS of frames at fps frames a second,
+#--- each controller chasing the next around the color
+#--- wheel.  To try out the jitter buffer, lossPct percent
+#--- of the frames are left out, dupPct percent are sent
+#--- twice and every burstEvery frames the next few are
+#--- held back and sent in a clump.  The peripheral prints
+#--- its stream stats when the central disconnects.
+#-------------------------------------------------------
+async def stream_show(stream_char, fps, lossPct=0, dupPct=0, burstEvery=0):
+    periodMs = 1000 // fps
+    startMs = time.ticks_ms()
+    held = []
+    sent = 0
+    for seq in range(STREAM_SECS * fps):
+        sendMs = time.ticks_diff(time.ticks_ms(), startMs)
+        values = []
+        for ctrlNdx in range(4):
+            hue = (seq * 4 + ctrlNdx * 64) % 256
+            values += [hue, (hue + 85) % 256, (hue + 170) % 256, 0]
+        frame = led_stream.pack_stream_frame(seq, sendMs, values)
+        if random.randrange(100) >= lossPct:
+            held.append(frame)
+            if random.randrange(100) < dupPct:
+                held.append(frame)
+        if not burstEvery or (seq % burstEvery) >= 3:
+            for aFrame in held:
+                await stream_char.write(aFrame, response=False)
+                sent += 1
+            held = []
+        #--- Keep to the frame rate however long the writes took.
+        nextMs = time.ticks_add(startMs, (seq + 1) * periodMs)
+        await asyncio.sleep_ms(max(0, time.ticks_diff(nextMs, time.ticks_ms())))
+    print(f"Streamed {sent} frames at {fps} fps in {time.ticks_diff(time.ticks_ms(), startMs)} ms")
+
+
+#-------------------------------------------------------
+#--- watch_state
+#--- Follow the live state of the LEDs for WATCH_SECS, 
+#--- e.g. while a phone changes them, and print it each 
+#--- time it changes.  The whole state is read first and
+#--- again whenever a notify goes missing.
+#-------------------------------------------------------
+async def watch_state(state_char):
+    values = bytearray(16)
+    brightness = bytearray(16)
+    await state_char.subscribe(notify=True)
+    seq = led_state.apply_state(await state_char.read(), values, brightness)
+    print(f"State {seq}: {list(values)} {list(brightness)}")
+    numDeltas = 0
+    numBytes = 0
+    endMs = time.ticks_add(time.ticks_ms(), WATCH_SECS * 1000)
+    while time.ticks_diff(endMs, time.ticks_ms()) > 0:
+        try:
+            data = await state_char.notified(timeout_ms=max(1, time.ticks_diff(endMs, time.ticks_ms())))
+        except asyncio.TimeoutError:
+            break
+        numDeltas += 1
+        numBytes += len(data)
+        deltaSeq = data[0]
+        if deltaSeq != (seq + 1) & 0xFF:
+            #--- A notify was lost or this one is older than the 
+            #--- whole state already read.
+            if ((deltaSeq - seq) & 0xFF) > 0x80:
+                continue
+            print(f"Missed deltas {seq + 1} to {deltaSeq - 1}, reading the whole state")
+            seq = led_state.apply_state(await state_char.read(), values, brightness)
+            continue
+        seq = led_state.apply_state(data, values, brightness)
+        print(f"State {seq}: {list(values)} {list(brightness)}")
+    await state_char.subscribe(notify=False)
+    print(f"{numDeltas} deltas, {numBytes} bytes in {WATCH_SECS} s")
+
+
 #-------------------------------------------------------
 #--- find_other_board
-#--- This function will scan for the pico board with the
-#--- correct service UUID and return the device if found.
-#--- If not found, it will return None.
+#--- This function will scan for the pico boards with the
+#--- correct service UUID, list every box found with the
+#--- summary from its scan response (ID, config version,
+#--- on/off, scene) and return the device of the first one.
+#--- If none is found, it will return None.
 #-------------------------------------------------------
 #async def find_other_board() -> aioble.Device:
 async def find_other_board():
-    # Scan for 7 seconds, in active mode, with very low interval/window (to
-    # maximise detection rate).
-    async with aioble.scan(7000, interval_us=SCAN_INTERVAL_US, window_us=SCAN_WINDOW_US, active=True) as scanner:
+    boxes = {}
+    firstDev = None
+    # Scan for SCAN_DURATION_MS, in active mode so the boxes send their
+    # scan response, with very low interval/window (to maximise 
+    # detection rate).
+    async with aioble.scan(SCAN_DURATION_MS, interval_us=SCAN_INTERVAL_US, window_us=SCAN_WINDOW_US, active=True) as scanner:
         async for result in scanner:
-            # See if it matches our name and the environmental sensing service.
-            #--- REMOVE BEFORE FLIGHT - To handle the possibility that multiple
-            #--- LED Controller boxes are in the same vecinity, each controller 
-            #--- will be given a unique number in the center part of the UUID.
-            #--- Collect all of the devices with the name "BoonLED", and then
-            #--- make sure the SERVICE_UUID ends in 0000b00d0c50. Get the 
-            #--- characteristics for each box and handle each box separately.
+            # See if it matches our name and the LED service.
             if result.name() == "BoonLED" and SERVICE_UUID in result.services():
- #           for aService in result.services():
- #               print("Service: ", aService)
- #           if SERVICE_UUID in result.services():
-                print("Found device:", result)
-                print("Name:", result.name())
-                for aService in result.services():
-                    print("Service:", aService)
-                return result.device
-    return None
+                if firstDev is None:
+                    print("Found device:", result)
+                    firstDev = result.device
+                #--- The summary comes in the scan response, which may
+                #--- arrive after the advertisement itself.
+                for companyID, data in result.manufacturer(led_state.ADV_COMPANY_ID):
+                    summary = led_state.unpack_adv_summary(struct.pack("<H", companyID) + bytes(data))
+                    if summary:
+                        boxes[result.device.addr_hex()] = (summary, result.rssi)
+
+    for addr, (summary, rssi) in boxes.items():
+        boxID, cfgVersion, isOn, sceneNum, stateHash = summary
+        print(f"Box {boxID:04d} at {addr} ({rssi} dBm): config version {cfgVersion}, "
+              f"{'on' if isOn else 'off'}, scene {sceneNum or '-'}, state {stateHash:04x}")
+    return firstDev
 
 
 #-------------------------------------------------------
@@ -414,7 +711,8 @@ async def main():
         if aDev is not None:
             
             try:            
-                connection = await aDev.connect()
+                connection = await aDev.connect(min_conn_interval_us=MIN_CONN_INTERVAL_US,
+                                                max_conn_interval_us=MAX_CONN_INTERVAL_US)
     #            print("The connection is: ", connection)
                 # Initiate MTU exchange after connecting
                 # This starts the negotiation process.
@@ -453,6 +751,11 @@ async def main():
                 save_scene_char = await led_service.characteristic(SAVE_SCENE_CHAR_UUID)
                 set_ctrl_type_char = await led_service.characteristic(SET_CTRL_TYPE_CHAR_UUID)
                 box_id_char = await led_service.characteristic(BOX_ID_CHAR_UUID)
+                bin_cmd_char = await led_service.characteristic(BIN_CMD_CHAR_UUID)
+                set_led_no_rsp_char = await led_service.characteristic(SET_LED_NO_RSP_CHAR_UUID)
+                brightness_no_rsp_char = await led_service.characteristic(SET_BRIGHT_NO_RSP_CHAR_UUID)
+                stream_char = await led_service.characteristic(STREAM_CHAR_UUID)
+                state_char = await led_service.characteristic(STATE_CHAR_UUID)
             except asyncio.TimeoutError:
                 print("Timeout discovering services/characteristics")
                 await asyncio.sleep_ms(5000)
@@ -481,7 +784,27 @@ async def main():
                                 "11: Rotate Brightness 4Chan\n" +
                                 "12: Select Scene 2\n" +
                                 "13: Save Scene 2\n" +
-                                "14: Read ID\n" ))
+                                "14: Read ID\n" +
+                                "15: Read Config (JSON)\n" +
+                                "16: Read Config (binary)\n" +
+                                "17: Read Config (deflated JSON)\n" +
+                                "18: Read Config (deflated binary)\n" +
+                                "19: Read Controllers (binary)\n" +
+                                "20: Read Scene List (binary)\n" +
+                                "21: Read Scene 1 (binary)\n" +
+                                "22: Read Config (framed binary)\n" +
+                                "23: Read Controllers (binary long read)\n" +
+                                "24: Set All Controllers (binary command)\n" +
+                                "25: Compare json and binary commands\n" +
+                                "26: Set Everything (json batch)\n" +
+                                "27: Set Everything (binary batch)\n" +
+                                "28: Color Wheel (with response)\n" +
+                                "29: Color Wheel (no response)\n" +
+                                "30: Rotate Brightness (no response)\n" +
+                                "31: Stream Show (30 fps)\n" +
+                                "32: Stream Show (60 fps)\n" +
+                                "33: Stream Show (60 fps, 5% lost, 5% duplicated, clumped)\n" +
+                                "34: Watch Live State\n" ))
 
                 if 1 == idx:
                     #--- Write json byte string to peripheral
@@ -597,6 +920,87 @@ async def main():
                         await asyncio.sleep_ms(500)
                         continue
 
+                elif (15 <= idx) and (idx <= 18):
+                    fmt = config_codec.FMT_JSON if (idx % 2) else config_codec.FMT_BINARY
+                    if idx >= 17:
+                        fmt |= config_codec.FMT_FLAG_DEFLATE
+                    try:
+                        cfgDict = await read_config_notified(config_char, fmt)
+                        print("Config: ", cfgDict)
+                    except Exception as e:
+                        print(f"Exception reading config: {e}")
+
+                elif (19 <= idx) and (idx <= 21):
+                    try:
+                        cfgDict = await read_config_notified(config_char, config_codec.FMT_BINARY, idx - 18, 1)
+                        print("Config section: ", cfgDict)
+                    except Exception as e:
+                        print(f"Exception reading config section: {e}")
+
+                elif 22 == idx:
+                    try:
+                        cfgDict = await read_config_notified(config_char, config_codec.FMT_BINARY | config_codec.FMT_FLAG_FRAMED)
+                        print("Config: ", cfgDict)
+                    except Exception as e:
+                        print(f"Exception reading config: {e}")
+
+                elif 23 == idx:
+                    try:
+                        cfgDict = await read_config_long(config_char, config_codec.FMT_BINARY, config_codec.SECTION_CONTROLLERS)
+                        print("Config section: ", cfgDict)
+                    except Exception as e:
+                        print(f"Exception reading config section: {e}")
+
+                elif 24 == idx:
+                    cmd = command_codec.pack_command(command_codec.CMD_SET_VALUE, command_codec.CTRL_MASK_ALL,
+                                                     command_codec.CHAN_MASK_ALL, (255, 0, 67, 0))
+                    await bin_cmd_char.write(cmd)
+
+                elif 25 == idx:
+                    try:
+                        await compare_commands({"setLED": set_led_char, "setBright": brightness_char,
+                                                "binCmd": bin_cmd_char})
+                    except Exception as e:
+                        print(f"Exception comparing commands: {e}")
+
+                elif (26 == idx) or (27 == idx):
+                    values = [255, 0, 67, 0, 255, 0, 38, 0, 255, 0, 0, 0, 255, 0, 41, 0]
+                    brightness = [dimIndex] * 16
+                    chars = {"setLED": set_led_char, "binCmd": bin_cmd_char}
+                    for charName, msg in state_messages("batch" if 26 == idx else "binary", values, brightness):
+                        print(f"{charName}: {len(msg)} bytes")
+                        await chars[charName].write(msg)
+
+                elif 28 == idx:
+                    await color_wheel(set_led_char, True)
+
+                elif 29 == idx:
+                    await color_wheel(set_led_no_rsp_char, False)
+
+                elif 30 == idx:
+                    if dimIndex >= 100:
+                        dimIndex = 1
+                    else:
+                        dimIndex = dimIndex + 5
+                    
+                    json_str = rgbw_brightness_string(1, dimIndex)
+                    await brightness_no_rsp_char.write(json_str, response=False)
+
+                elif 31 == idx:
+                    await stream_show(stream_char, 30)
+
+                elif 32 == idx:
+                    await stream_show(stream_char, 60)
+
+                elif 33 == idx:
+                    await stream_show(stream_char, 60, lossPct=5, dupPct=5, burstEvery=30)
+
+                elif 34 == idx:
+                    try:
+                        await watch_state(state_char)
+                    except Exception as e:
+                        print(f"Exception watching state: {e}")
+
                 else:
                     print("Unexpected input: ", idx)
 
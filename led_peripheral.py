@@ -2,14 +2,22 @@
 #--- led_peripheral.py
 #--- This implements a low level bluetooth low energy (BLE) periperhal.
 #--- This peripheral implements the Boondocks LED Controller.  It contains a 
-#--- single service with 8 characteristics:
+#--- single service with 14 characteristics:
 #--------------------------------------------------------------------------------
 
 import bluetooth
+import errno
+import gc
+import io
 import random
 import struct
 import time
-from ble_advertising import advertising_payload
+import micropython
+from ble_advertising import advertising_payload, scan_response_payload
+from config_codec import (FMT_JSON, FMT_FLAG_FRAMED, FMT_FLAG_LONG_READ, SECTION_ALL,
+                          FRAME_HEADER_SIZE, ATT_MAX_VALUE_LEN,
+                          RESUME_REQUEST, RESUME_HEADER, ConfigStream, frame_crc, 
+                          frame_data_len, pack_frame_header, pack_frame_into)
 
 from micropython import const
 
@@ -17,12 +25,48 @@ _IRQ_CENTRAL_CONNECT = const(1)
 _IRQ_CENTRAL_DISCONNECT = const(2)
 _IRQ_GATTS_WRITE = const(3)
 _IRQ_GATTS_READ_REQUEST = const(4)
+_IRQ_MTU_EXCHANGED = const(21)
+_IRQ_CONNECTION_UPDATE = const(27)
 
 _FLAG_READ = const(0x0002)
 _FLAG_WRITE_NO_RESPONSE = const(0x0004)
 _FLAG_WRITE = const(0x0008)
 _FLAG_NOTIFY = const(0x0010)
 
+_GATTS_NO_ERROR = const(0x00)
+_GATTS_ERROR_READ_NOT_PERMITTED = const(0x02)
+
+#--- Connection interval to pace chunks by until the stack reports the
+#--- real one, and the most chunks that will be sent in one interval.
+_DEFAULT_CONN_INTERVAL_MS = const(30)
+_TX_MAX_CHUNKS_PER_INTERVAL = const(8)
+
+#--- The MTU we offer and the one a connection has until it is exchanged.
+#--- A notify carries the MTU less 3 bytes of ATT header.
+_MTU = const(244)
+_DEFAULT_MTU = const(23)
+_ATT_HEADER_SIZE = const(3)
+
+#--- Views of the frame buffer kept for the chunk lengths last sent.
+_CHUNK_VIEWS = const(4)
+
+#--- Writes from each central that can wait to be handled.
+_RX_RING_SLOTS = const(8)
+
+#--- The peripheral is active while writes are coming in or long strings
+#--- are going out, and idle once there has been neither for this long.
+_IDLE_AFTER_MS = const(3000)
+_ACTIVE = const(0)
+_IDLE = const(1)
+
+#--- Shortest time between two changes of the scan response, since each
+#--- one restarts advertising.
+_ADV_UPDATE_MS = const(1000)
+
+#--- Centrals that can be connected at once.  The box keeps advertising
+#--- until this many are connected.  Each one has its own receive ring.
+_MAX_CONNECTIONS = const(3)
+
 #--- Every BLE peripheral by default implements a UART service and two
 #--- characteristics for TX and RX.  However, the use of the UART sercie
 #--- is mutually exclusive with the custom service and characteristics
@@ -55,12 +99,27 @@ CHAR_UUIDS = [
     bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c56"),
     bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c57"),
     bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c58"),
+    bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c59"),
+    bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c5A"),
+    bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c5B"),
+    bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c5C"),
+    bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c5D"),
+    bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c5E"),
 ]
 
 
-#--- Create 8 characteristics; one readable with notify,
-#--- one simply readable, and the rest writable
-config_char = (CHAR_UUIDS[0], _FLAG_READ | _FLAG_NOTIFY)
+#--- Create 14 characteristics; three readable with notify,
+#--- one simply readable, and the rest writable. The config
+#--- characteristic is also writable so the central can select
+#--- the encoding of the config message.  The binary command
+#--- characteristic takes the packed commands of command_codec.
+#--- The last two take the same messages as setLED and setBright
+#--- but are written without response, so a central can send
+#--- them as fast as the link allows (e.g. from a color wheel).
+#--- The stream characteristic takes the frames of led_stream.
+#--- The state characteristic notifies the live channel values
+#--- (see led_state.py) to every central.
+config_char = (CHAR_UUIDS[0], _FLAG_READ | _FLAG_NOTIFY | _FLAG_WRITE)
 set_led_char = (CHAR_UUIDS[1], _FLAG_WRITE)
 setBright_char = (CHAR_UUIDS[2], _FLAG_WRITE)
 allOff_char = (CHAR_UUIDS[3], _FLAG_WRITE)
@@ -68,21 +127,342 @@ sceneSelect_char = (CHAR_UUIDS[4], _FLAG_WRITE)
 sceneSave_char = (CHAR_UUIDS[5], _FLAG_WRITE)
 ctrlType_char = (CHAR_UUIDS[6], _FLAG_WRITE)
 readID_char = (CHAR_UUIDS[7], _FLAG_READ)
+configChange_char = (CHAR_UUIDS[8], _FLAG_READ | _FLAG_NOTIFY)
+binCmd_char = (CHAR_UUIDS[9], _FLAG_WRITE)
+setLEDNoRsp_char = (CHAR_UUIDS[10], _FLAG_WRITE_NO_RESPONSE)
+setBrightNoRsp_char = (CHAR_UUIDS[11], _FLAG_WRITE_NO_RESPONSE)
+stream_char = (CHAR_UUIDS[12], _FLAG_WRITE_NO_RESPONSE)
+state_char = (CHAR_UUIDS[13], _FLAG_READ | _FLAG_NOTIFY)
 
 #--- Create the BLE service and assign it's characteristics.  
 #--- The service is a tuple of the form (service_uuid, (char1, char2, ...)) 
 #--- where each char is a tuple of the form (char_uuid, flags).  
 #--- The service is then registered with the BLE stack.
-charSet = (config_char, set_led_char, setBright_char, allOff_char, sceneSelect_char, sceneSave_char, ctrlType_char, readID_char)
+charSet = (config_char, set_led_char, setBright_char, allOff_char, sceneSelect_char, sceneSave_char, ctrlType_char, readID_char,
+           configChange_char, binCmd_char, setLEDNoRsp_char, setBrightNoRsp_char,
+           stream_char, state_char)
 service2 = (SERVICE_UUID, charSet)
 SERVICES = (service2,)
 
 
+#----------------------------------------
+#--- _TxJob
+#--- A long string waiting in the transmit
+#--- queue of one connection and how far it
+#--- has been sent.  The string is either
+#--- held in memory or is a ConfigStream that
+#--- is encoded a chunk at a time.
+#----------------------------------------
+class _TxJob:
+    __slots__ = ("handle", "data", "reader", "stream", "total", "offset", "chunk_size",
+                 "chunk_len", "data_len", "buf", "buf_len", "tid", "crc",
+                 "chunks_sent", "stalls", "start_ms", "writes", "max_write_us",
+                 "alloc_bytes")
+
+    def __init__(self, handle, data, chunk_size, tid=None):
+        self.handle = handle
+        self.offset = 0
+        #--- Transfer id if the chunks are sent as frames (see 
+        #--- config_codec.FMT_FLAG_FRAMED), otherwise None.
+        self.tid = tid
+        if isinstance(data, ConfigStream):
+            #--- A stream is encoded once before its first chunk to
+            #--- get its length and crc (total is -1 until then), and
+            #--- then each chunk is encoded into buf as it is started
+            #--- so that a stalled chunk can be resent.
+            self.stream = data
+            self.data = None
+            self.reader = None
+            self.total = -1
+            self.crc = 0
+            self.buf = bytearray(_MTU)
+        else:
+            #--- Each chunk is read out of the data into the
+            #--- peripheral's frame buffer; a BytesIO reads straight
+            #--- from the data and readinto() makes no new objects.
+            self.stream = None
+            self.data = data
+            self.reader = io.BytesIO(data)
+            self.total = len(data)
+            self.crc = frame_crc(data) if tid is not None else 0
+            self.buf = None
+        #--- Bytes of the message in the chunk being sent and the
+        #--- length of the chunk in buf.
+        self.data_len = 0
+        self.buf_len = 0
+        #--- Largest chunk the caller asked for (None for no limit) and
+        #--- the length of the chunk being sent (0 until it is started).
+        self.chunk_size = chunk_size
+        self.chunk_len = 0
+        self.chunks_sent = 0
+        self.stalls = 0
+        self.start_ms = time.ticks_ms()
+        #--- Writes handled while this job was being sent and the 
+        #--- longest one of them took from arriving to being handled.
+        self.writes = 0
+        self.max_write_us = 0
+        #--- Heap allocated while sending the chunks.
+        self.alloc_bytes = 0
+
+
+#----------------------------------------
+#--- _RxRing
+#--- Writes from a central waiting to be
+#--- handled outside of the IRQ.  The slots
+#--- are memoryviews into one buffer that is
+#--- allocated once, so the IRQ only has to
+#--- copy into them and the handlers parse
+#--- straight out of them.  The IRQ still
+#--- gets each write as a new bytes object
+#--- from gatts_read, since MicroPython can't
+#--- read a value into a buffer.  The view
+#--- of a slot handed to a handler is kept
+#--- for the next write of the same length,
+#--- so it doesn't make a new one either;
+#--- tools/rx_alloc.py measures what a
+#--- write allocates.  Only the IRQ moves 
+#--- put_count and only process() moves
+#--- get_count, so neither has to lock.
+#----------------------------------------
+class _RxRing:
+    __slots__ = ("buf", "slots", "lens", "views", "view_lens", "value_handles", "arrive_us",
+                 "put_count", "get_count", "max_depth", "drops", "handled", "errors",
+                 "max_handler_us", "max_latency_us", "alloc_bytes", "max_alloc_bytes")
+
+    def __init__(self, slots, size):
+        self.buf = bytearray(slots * size)
+        bufView = memoryview(self.buf)
+        self.slots = [bufView[ndx * size:(ndx + 1) * size] for ndx in range(slots)]
+        self.lens = [0] * slots
+        self.views = list(self.slots)
+        self.view_lens = [size] * slots
+        self.value_handles = [0] * slots
+        self.arrive_us = [0] * slots
+        self.reset()
+
+    #----------------------------------------------
+    #--- reset
+    #--- Empty the ring and clear its stats for a
+    #--- new connection.
+    #----------------------------------------------
+    def reset(self):
+        self.put_count = 0
+        self.get_count = 0
+        #--- Deepest the ring has been, writes dropped because it was
+        #--- full, writes handled and those whose handler failed, the
+        #--- longest a handler took and the longest from a write
+        #--- arriving to it being handled.
+        self.max_depth = 0
+        self.drops = 0
+        self.handled = 0
+        self.errors = 0
+        self.max_handler_us = 0
+        self.max_latency_us = 0
+        #--- Heap allocated by the handlers, in total and the most by
+        #--- one write.
+        self.alloc_bytes = 0
+        self.max_alloc_bytes = 0
+
+    def depth(self) -> int:
+        return self.put_count - self.get_count
+
+    #----------------------------------------------
+    #--- put
+    #--- Copy a write into the next free slot.
+    #--- Returns False if it had to be dropped.
+    #----------------------------------------------
+    def put(self, value_handle, value) -> bool:
+        depth = self.put_count - self.get_count
+        if depth >= len(self.slots) or len(value) > len(self.slots[0]):
+            self.drops += 1
+            return False
+        ndx = self.put_count % len(self.slots)
+        self.slots[ndx][:len(value)] = value
+        self.lens[ndx] = len(value)
+        self.value_handles[ndx] = value_handle
+        self.arrive_us[ndx] = time.ticks_us()
+        self.put_count += 1
+        self.max_depth = max(self.max_depth, depth + 1)
+        return True
+
+    #----------------------------------------------
+    #--- value
+    #--- The write in slot ndx, as a view that is
+    #--- only made again when the length changes.
+    #----------------------------------------------
+    def value(self, ndx):
+        if self.view_lens[ndx] != self.lens[ndx]:
+            self.view_lens[ndx] = self.lens[ndx]
+            self.views[ndx] = self.slots[ndx][:self.lens[ndx]]
+        return self.views[ndx]
+
+    def stats(self) -> str:
+        return "{} writes handled ({} failed), max depth {}, {} dropped, longest handler {} us, longest wait {} us, {} bytes allocated per write (max {})".format(
+            self.handled, self.errors, self.max_depth, self.drops, self.max_handler_us, self.max_latency_us,
+            self.alloc_bytes // max(1, self.handled), self.max_alloc_bytes)
+
+
+#----------------------------------------
+#--- _Connection
+#--- Everything the peripheral keeps about
+#--- one connected central.  The records
+#--- (and their receive rings) are made once
+#--- and reused, so a connection allocates
+#--- nothing.  handle is -1 while a record
+#--- is free.
+#----------------------------------------
+class _Connection:
+    __slots__ = ("handle", "mtu", "interval_ms", "latency", "timeout_ms", "config_format", "config_request",
+                 "config_read", "config_prepare", "tx_queue", "tx_framed", "rx_ring", "start_ms", "writes", "write_bytes",
+                 "chunks_sent", "transfers")
+
+    def __init__(self):
+        self.rx_ring = _RxRing(_RX_RING_SLOTS, _MTU)
+        #--- Long strings waiting to be sent to this central.
+        self.tx_queue = []
+        self.free()
+
+    def open(self, conn_handle):
+        self.handle = conn_handle
+        self.rx_ring.reset()
+        self.start_ms = time.ticks_ms()
+
+    def free(self):
+        self.handle = -1
+        #--- MTU it has exchanged and its connection interval, slave
+        #--- latency and supervision timeout, from the stack (0 until
+        #--- they are reported).
+        self.mtu = _DEFAULT_MTU
+        self.interval_ms = 0
+        self.latency = 0
+        self.timeout_ms = 0
+        #--- The config format byte it selected and the [section, 
+        #--- scene#] it asked for.
+        self.config_format = FMT_JSON
+        self.config_request = (SECTION_ALL, 0)
+        #--- True once it has read the config characteristic, until
+        #--- the config is queued for it, and once a long read was
+        #--- refused, until its message is encoded.
+        self.config_read = False
+        self.config_prepare = False
+        self.tx_queue.clear()
+        #--- Its last framed transfer, kept so that it can be resumed.
+        self.tx_framed = None
+        #--- Writes and bytes it sent, and chunks and long strings
+        #--- sent to it.
+        self.writes = 0
+        self.write_bytes = 0
+        self.chunks_sent = 0
+        self.transfers = 0
+
+    #----------------------------------------------
+    #--- events_per_s
+    #--- Connection events a second the radio has to
+    #--- wake up for with the central's parameters.
+    #--- With slave latency the peripheral may skip
+    #--- that many events when it has nothing to send.
+    #----------------------------------------------
+    def events_per_s(self) -> int:
+        return 1000 // (max(1, self.interval_ms) * (self.latency + 1))
+
+    def stats(self) -> str:
+        return "connected {} s, {} writes ({} bytes), {} long strings in {} chunks, mtu {}, interval {} ms, latency {}, {} events/s".format(
+            time.ticks_diff(time.ticks_ms(), self.start_ms) // 1000, self.writes, self.write_bytes,
+            self.transfers, self.chunks_sent, self.mtu, self.interval_ms, self.latency, self.events_per_s())
+
+
+#----------------------------------------
+#--- _Activity
+#--- Whether the peripheral is active or
+#--- idle (see _IDLE_AFTER_MS), and for
+#--- each state the time spent in it, the
+#--- writes handled and how long they took
+#--- from arriving, and the times process()
+#--- ran and how long it was busy.  The main
+#--- loop polls slower while idle.
+#----------------------------------------
+class _Activity:
+    __slots__ = ("state", "last_ms", "since_ms", "state_ms", "writes", "latency_us",
+                 "wakeups", "busy_us", "switches")
+
+    def __init__(self):
+        self.state = _IDLE
+        self.last_ms = time.ticks_ms()
+        self.since_ms = self.last_ms
+        self.state_ms = [0, 0]
+        self.writes = [0, 0]
+        self.latency_us = [0, 0]
+        self.wakeups = [0, 0]
+        self.busy_us = [0, 0]
+        self.switches = 0
+
+    #----------------------------------------------
+    #--- active
+    #--- Note that something was received or sent.
+    #----------------------------------------------
+    def active(self, nowMs):
+        self.last_ms = nowMs
+        if self.state != _ACTIVE:
+            self._switch(_ACTIVE, nowMs)
+
+    #----------------------------------------------
+    #--- update
+    #--- Go idle once nothing has happened for
+    #--- _IDLE_AFTER_MS.
+    #----------------------------------------------
+    def update(self, nowMs):
+        if self.state == _ACTIVE and time.ticks_diff(nowMs, self.last_ms) >= _IDLE_AFTER_MS:
+            self._switch(_IDLE, nowMs)
+
+    def _switch(self, state, nowMs):
+        self.state_ms[self.state] += time.ticks_diff(nowMs, self.since_ms)
+        self.state = state
+        self.since_ms = nowMs
+        self.switches += 1
+
+    def stats(self) -> str:
+        nowMs = time.ticks_ms()
+        lines = []
+        for state, name in ((_ACTIVE, "Active"), (_IDLE, "Idle")):
+            stateMs = self.state_ms[state]
+            if state == self.state:
+                stateMs += time.ticks_diff(nowMs, self.since_ms)
+            busyPerMille = self.busy_us[state] // max(1, stateMs)
+            lines.append("{}: {} ms, {} writes, {} us average wait, {} wakeups/s, busy {}.{}%".format(
+                name, stateMs, self.writes[state], self.latency_us[state] // max(1, self.writes[state]),
+                self.wakeups[state] * 1000 // max(1, stateMs), busyPerMille // 10, busyPerMille % 10))
+        return "\n".join(lines)
+
+
+#----------------------------------------
+#--- _TxPacer
+#--- Decides how many chunks are sent each
+#--- connection interval.  The budget grows
+#--- by one chunk every interval that all of
+#--- it was accepted by the stack, and is
+#--- halved when a notify fails because the
+#--- stack's buffers are full.
+#----------------------------------------
+class _TxPacer:
+    __slots__ = ("budget", "interval_ms")
+
+    def __init__(self):
+        self.budget = 1
+        self.interval_ms = _DEFAULT_CONN_INTERVAL_MS
+
+    def accepted(self):
+        if self.budget < _TX_MAX_CHUNKS_PER_INTERVAL:
+            self.budget += 1
+
+    def stalled(self):
+        self.budget = max(1, self.budget // 2)
+
+
 #----------------------------------------
 #--- The LEDPerpherial object definition.
 #----------------------------------------
 class LEDPeripheral:
-    def __init__(self, ble, name="BoonLED"):
+    def __init__(self, ble, name="BoonLED", max_connections=_MAX_CONNECTIONS):
         self._ble = ble
         self._ble.active(True)
         self._ble.irq(self._irq)
@@ -93,8 +473,23 @@ class LEDPeripheral:
           self._handle_sceneSelect, 
           self._handle_sceneSave,
           self._handle_setCtrlType,
-          self._handle_readID),) = self._ble.gatts_register_services(SERVICES)
-        self._connections = set()
+          self._handle_readID,
+          self._handle_configChange,
+          self._handle_binCmd,
+          self._handle_setLEDNoRsp,
+          self._handle_setBrightNoRsp,
+          self._handle_stream,
+          self._handle_state),) = self._ble.gatts_register_services(SERVICES)
+        #--- The record of each connected central by its handle, and
+        #--- all of the records, which are what the loops go over
+        #--- since the IRQ can change the dictionary at any time.
+        self._connections = {}
+        self._conn_pool = [_Connection() for _ in range(max_connections)]
+        #--- The record whose write is handled first next time, and the
+        #--- one that is sent a chunk first next time.
+        self._rx_turn = 0
+        self._tx_turn = 0
+        self._activity = _Activity()
 #        self._config_callback = None
         self._setLED_callback = None
         self._setBright_callback = None
@@ -103,18 +498,67 @@ class LEDPeripheral:
         self._sceneSave_callback = None
         self._setCtrlType_callback = None
         self._setID_callback = None
+        self._binCmd_callback = None
+        self._setLEDNoRsp_callback = None
+        self._setBrightNoRsp_callback = None
+        self._stream_callback = None
+        #--- The handler of the writes to each characteristic and 
+        #--- whether it also wants the connection handle.  The
+        #--- callbacks are added by their set_xxx_callback.
+        self._write_handlers = {}
+        #--- Name, writes, bytes, handler time and heap allocated of each
+        #--- characteristic so the json and binary commands can be compared.
+        self._write_stats = {}
+        self._set_write_handler(self._handle_config, "config", self._on_config_write, True)
         self._long_string_data = None
+        #--- Source of the encoded config messages (a ConfigCache) and 
+        #--- the message now in the config characteristic's value.
+        self._config_cache = None
+        self._config_value = None
         self._local_ID_string_data = None
+        #--- The IRQ only queues long strings on the connection's record;
+        #--- process() sends the chunks outside of the IRQ.
+        self._tx_next_ms = time.ticks_ms()
+        #--- The last transfer id used.
+        self._tx_tid = 0
+        #--- Chunks and frames are built in this one buffer; gatts_notify
+        #--- copies the data so it can be reused for every chunk.  It is
+        #--- notified through views of the chunk lengths last sent (see
+        #--- _chunk_view) so that a chunk doesn't make a new one.
+        self._frame_buf = bytearray(_MTU)
+        self._frame_mv = memoryview(self._frame_buf)
+        self._frame_body = self._frame_mv[FRAME_HEADER_SIZE:]
+        self._view_lens = [-1] * _CHUNK_VIEWS
+        self._views = [self._frame_mv] * _CHUNK_VIEWS
+        self._view_next = 0
+        self._process_scheduled = False
+        self._processing = False
+        self._process_ref = self._scheduled_process
+        self._tx_pacer = _TxPacer()
         self._payload = advertising_payload(name=name, services=[SERVICE_UUID])
-        self._ble.config(mtu=244)
-        self._ble.gatts_set_buffer(self._handle_config, 244)
-        self._ble.gatts_set_buffer(self._handle_setLED, 244)
-        self._ble.gatts_set_buffer(self._handle_setBright, 244)
-        self._ble.gatts_set_buffer(self._handle_allOff, 244)
-        self._ble.gatts_set_buffer(self._handle_sceneSelect, 244)
-        self._ble.gatts_set_buffer(self._handle_sceneSave, 244)
-        self._ble.gatts_set_buffer(self._handle_setCtrlType, 244)
-        self._ble.gatts_set_buffer(self._handle_readID, 244)
+        #--- The advertising payload is full, so the summary of the box
+        #--- goes in the scan response (see set_adv_summary).  A new one
+        #--- waits until advertising was last started _ADV_UPDATE_MS ago.
+        self._resp_payload = None
+        self._resp_pending = False
+        self._advertising = False
+        self._adv_ms = time.ticks_ms()
+        self._ble.config(mtu=_MTU)
+        #--- The config value holds whole messages for long reads.
+        self._ble.gatts_set_buffer(self._handle_config, ATT_MAX_VALUE_LEN)
+        self._ble.gatts_set_buffer(self._handle_setLED, _MTU)
+        self._ble.gatts_set_buffer(self._handle_setBright, _MTU)
+        self._ble.gatts_set_buffer(self._handle_allOff, _MTU)
+        self._ble.gatts_set_buffer(self._handle_sceneSelect, _MTU)
+        self._ble.gatts_set_buffer(self._handle_sceneSave, _MTU)
+        self._ble.gatts_set_buffer(self._handle_setCtrlType, _MTU)
+        self._ble.gatts_set_buffer(self._handle_readID, _MTU)
+        self._ble.gatts_set_buffer(self._handle_configChange, _MTU)
+        self._ble.gatts_set_buffer(self._handle_binCmd, _MTU)
+        self._ble.gatts_set_buffer(self._handle_setLEDNoRsp, _MTU)
+        self._ble.gatts_set_buffer(self._handle_setBrightNoRsp, _MTU)
+        self._ble.gatts_set_buffer(self._handle_stream, _MTU)
+        self._ble.gatts_set_buffer(self._handle_state, _MTU)
 #        print("payload:", self._payload)
 #        print("Length:", len(self._payload))
         self._advertise()
@@ -127,42 +571,61 @@ class LEDPeripheral:
         if event == _IRQ_CENTRAL_CONNECT:
             conn_handle, _, _ = data
             print("New connection", conn_handle)
-            self._connections.add(conn_handle)
+            conn = self._free_connection()
+            if conn is None:
+                print("Too many connections, dropping", conn_handle)
+                self._ble.gap_disconnect(conn_handle)
+                return
+            conn.open(conn_handle)
+            self._connections[conn_handle] = conn
+            self._advertising = False
+            #--- Advertising stops when a central connects. Keep the
+            #--- box discoverable to other centrals until it is full.
+            if len(self._connections) < len(self._conn_pool):
+                self._advertise()
         elif event == _IRQ_CENTRAL_DISCONNECT:
             conn_handle, _, _ = data
             print("Disconnected", conn_handle)
-            self._connections.remove(conn_handle)
+            conn = self._connections.pop(conn_handle, None)
+            if conn is None:
+                #--- A central that was over the limit. The box is
+                #--- still full.
+                return
+            print(conn.stats())
+            print(conn.rx_ring.stats())
+            conn.free()
+            self._update_tx_interval()
+            self.print_write_stats()
+            if not self._connections:
+                print(self._activity.stats())
             # Start advertising again to allow a new connection.
-            self._advertise()
+            if len(self._connections) < len(self._conn_pool):
+                self._advertise()
         elif event == _IRQ_GATTS_WRITE:
+            #--- Only copy the write into the central's ring here. 
+            #--- process() hands it to the characteristic's handler.
             conn_handle, value_handle = data
-            value = self._ble.gatts_read(value_handle)
-#            print("Write request on handle:", value_handle, "with value:", value)
-#            print("setType handle:", self._handle_setCtrlType)
-#            print("Callback:", self._setCtrlType_callback)
-            if value_handle == self._handle_setLED and self._setLED_callback:
-                self._setLED_callback(value)
-            elif value_handle == self._handle_setBright and self._setBright_callback:
-                self._setBright_callback(value)
-            elif value_handle == self._handle_allOff and self._allOff_callback:
-                self._allOff_callback(value)
-            elif value_handle == self._handle_sceneSelect and self._sceneSelect_callback:
-                self._sceneSelect_callback(value)
-            elif value_handle == self._handle_sceneSave and self._sceneSave_callback:
-                self._sceneSave_callback(value)
-            elif value_handle == self._handle_setCtrlType and self._setCtrlType_callback:
-                self._setCtrlType_callback(value)
-            else:
-                print("Handle without a callback: ", value_handle)
+            conn = self._connections.get(conn_handle)
+            if conn is not None:
+                conn.rx_ring.put(value_handle, self._ble.gatts_read(value_handle))
+                self._schedule_process()
+            if value_handle == self._handle_config:
+                #--- The write replaced the config the characteristic
+                #--- held, so the next long read has to put it back.
+                self._config_value = None
         elif event == _IRQ_GATTS_READ_REQUEST:
             conn_handle, value_handle = data
 
             if value_handle == self._handle_config:
-                # Send long string if config characteristic is being read
-                if self._long_string_data:
-                    self.send_long_string(self._long_string_data, self._handle_config)
-                else:
-                    self.send(b'Missing config')
+                conn = self._connections.get(conn_handle)
+                fmt = conn.config_format if conn else FMT_JSON
+                if fmt & FMT_FLAG_LONG_READ:
+                    return self._set_config_value(conn_handle, fmt)
+                #--- Send the config as a long string.  Encoding it
+                #--- (and deflating it) is left to process().
+                if conn is not None:
+                    conn.config_read = True
+                    self._schedule_process()
             elif value_handle == self._handle_readID:
                 if self._local_ID_string_data:
                     #--- Only need one write to the characteristic because it will
@@ -174,14 +637,40 @@ class LEDPeripheral:
                     self._ble.gatts_write(self._handle_readID, b'Missing ID')
             else:
                 print("Read request on unexpected handle: ", value_handle)
+        elif event == _IRQ_MTU_EXCHANGED:
+            conn_handle, mtu = data
+            print("MTU exchanged", conn_handle, mtu)
+            conn = self._connections.get(conn_handle)
+            if conn is not None:
+                conn.mtu = mtu
+        elif event == _IRQ_CONNECTION_UPDATE:
+            #--- The interval is in units of 1.25 ms.
+            #--- The supervision timeout is in units of 10 ms. 
+            #--- The central picks these; MicroPython can't ask it
+            #--- for others from the peripheral.
+            conn_handle, conn_interval, conn_latency, supervision_timeout, status = data
+            conn = self._connections.get(conn_handle)
+            if conn is not None:
+                conn.interval_ms = conn_interval * 5 // 4
+                conn.latency = conn_latency
+                conn.timeout_ms = supervision_timeout * 10
+                print("Connection {} updated: interval {} ms, latency {}, timeout {} ms, {} events/s (status {})".format(
+                    conn_handle, conn.interval_ms, conn.latency, conn.timeout_ms, conn.events_per_s(), status))
+                self._update_tx_interval()
 
     #---------------------------------------------------------
     #--- send
     #--- Helper function for when send long string has an error
-    #--- because the config is not set.
+    #--- because the config is not set.  Only the central that 
+    #--- asked for the config is told, or all of them if 
+    #--- conn_handle is None.
     #---------------------------------------------------------
-    def send(self, data):
-        for conn_handle in self._connections:
+    def send(self, data, conn_handle=None):
+        if conn_handle is None:
+            for conn in self._conn_pool:
+                if conn.handle >= 0:
+                    self._ble.gatts_notify(conn.handle, self._handle_config, data)
+        else:
             self._ble.gatts_notify(conn_handle, self._handle_config, data)
 
     #---------------------------------------------------------
@@ -190,9 +679,56 @@ class LEDPeripheral:
     def is_connected(self):
         return len(self._connections) > 0
 
+    #---------------------------------------------------------
+    #--- is_idle
+    #--- True once nothing has been received or sent for
+    #--- _IDLE_AFTER_MS, so the main loop can poll less often.
+    #--- Writes still schedule process() straight away.
+    #---------------------------------------------------------
+    def is_idle(self):
+        return self._activity.state == _IDLE
+
     def _advertise(self, interval_us=500000):
         print("Starting advertising")
-        self._ble.gap_advertise(interval_us, adv_data=self._payload)
+        self._resp_pending = False
+        self._adv_ms = time.ticks_ms()
+        try:
+            self._ble.gap_advertise(interval_us, adv_data=self._payload, resp_data=self._resp_payload)
+            self._advertising = True
+        except OSError as e:
+            #--- The stack can't advertise while this many centrals
+            #--- are connected.  It is tried again on a disconnect.
+            print("Can't advertise:", e)
+            self._advertising = False
+
+    #---------------------------------------------------------
+    #--- set_adv_summary
+    #--- Put the manufacturer specific data (see led_state.py)
+    #--- that sums up the box in the scan response.  Advertising
+    #--- is restarted with it by process(), at most once every 
+    #--- _ADV_UPDATE_MS, or when it next starts anyway.
+    #---------------------------------------------------------
+    def set_adv_summary(self, data):
+        respPayload = scan_response_payload(manufacturer=data)
+        if respPayload == self._resp_payload:
+            return
+        self._resp_payload = respPayload
+        self._resp_pending = True
+
+    def _update_advertising(self):
+        if (self._resp_pending and self._advertising
+                and time.ticks_diff(time.ticks_ms(), self._adv_ms) >= _ADV_UPDATE_MS):
+            self._advertise()
+
+    #---------------------------------------------------------
+    #--- _free_connection
+    #--- Return a record that is not in use or None.
+    #---------------------------------------------------------
+    def _free_connection(self):
+        for conn in self._conn_pool:
+            if conn.handle < 0:
+                return conn
+        return None
 
 
     #--------------------------------------------------------------
@@ -203,21 +739,90 @@ class LEDPeripheral:
     #--------------------------------------------------------------
     def set_setLED_callback(self, callback):
         self._setLED_callback = callback
+        self._set_write_handler(self._handle_setLED, "setLED", callback)
 
     def set_setBright_callback(self, callback):
         self._setBright_callback = callback
+        self._set_write_handler(self._handle_setBright, "setBright", callback)
 
     def set_allOff_callback(self, callback):
         self._allOff_callback = callback
+        self._set_write_handler(self._handle_allOff, "allOff", callback)
 
     def set_sceneSelect_callback(self, callback):
         self._sceneSelect_callback = callback
+        self._set_write_handler(self._handle_sceneSelect, "sceneSelect", callback)
 
     def set_sceneSave_callback(self, callback):
         self._sceneSave_callback = callback
+        self._set_write_handler(self._handle_sceneSave, "sceneSave", callback)
 
     def set_setCtrlType_callback(self, callback):
         self._setCtrlType_callback = callback
+        self._set_write_handler(self._handle_setCtrlType, "setCtrlType", callback)
+
+    def set_binCmd_callback(self, callback):
+        self._binCmd_callback = callback
+        self._set_write_handler(self._handle_binCmd, "binCmd", callback)
+
+    def set_setLEDNoRsp_callback(self, callback):
+        self._setLEDNoRsp_callback = callback
+        self._set_write_handler(self._handle_setLEDNoRsp, "setLEDNoRsp", callback)
+
+    def set_setBrightNoRsp_callback(self, callback):
+        self._setBrightNoRsp_callback = callback
+        self._set_write_handler(self._handle_setBrightNoRsp, "setBrightNoRsp", callback)
+
+    def set_stream_callback(self, callback):
+        self._stream_callback = callback
+        self._set_write_handler(self._handle_stream, "stream", callback)
+
+    def _set_write_handler(self, value_handle, name, callback, withConn=False):
+        self._write_handlers[value_handle] = (callback, withConn)
+        if value_handle not in self._write_stats:
+            self._write_stats[value_handle] = [name, 0, 0, 0, 0]
+
+    #--------------------------------------------------------------
+    #--- print_write_stats
+    #--- Print the writes each characteristic has handled, their
+    #--- average size, how many its handler could keep up with
+    #--- per second and what it allocated per write.
+    #--------------------------------------------------------------
+    def print_write_stats(self):
+        for name, writes, numBytes, handlerUs, allocBytes in self._write_stats.values():
+            if writes:
+                print("{}: {} writes, {} bytes/write, {} us/write, {} writes/s, {} bytes allocated/write".format(
+                    name, writes, numBytes // writes, handlerUs // writes,
+                    writes * 1000000 // max(1, handlerUs), allocBytes // writes))
+
+
+    #--------------------------------------------------------------
+    #--- _on_config_write
+    #--- The first byte selects the config format for this central.
+    #--- A longer write is a request for one section of the config
+    #--- of the form [format, section, scene#] which is answered
+    #--- right away with notifies, without the central having
+    #--- to read the characteristic.  A resume request asks
+    #--- for the rest of a framed transfer.  With the long
+    #--- read flag, the section is what the next reads get.
+    #--------------------------------------------------------------
+    def _on_config_write(self, conn_handle, value):
+        if len(value) >= 4 and value[0] == RESUME_REQUEST:
+            _, tid, offset = struct.unpack_from(RESUME_HEADER, value, 0)
+            self.resume_config(conn_handle, tid, offset)
+        elif len(value) > 0:
+            section = value[1] if len(value) > 1 else SECTION_ALL
+            sceneNum = value[2] if len(value) > 2 else 0
+            conn = self._connections.get(conn_handle)
+            if conn is None:
+                return
+            conn.config_format = value[0]
+            conn.config_request = (section, sceneNum)
+            if value[0] & FMT_FLAG_LONG_READ:
+                #--- Have the message ready for the reads that follow.
+                self._set_config_value(conn_handle, value[0], True)
+            elif len(value) > 1:
+                self.send_config_section(conn_handle, value[0], section, sceneNum)
 
 
     #--------------------------------------------------------------
@@ -243,45 +848,546 @@ class LEDPeripheral:
 #        print("Long string: ", self._long_string_data)
 
 
+    #--------------------------------------------------------------
+    #--- set_config_cache
+    #--- Use a config_codec.ConfigCache to get the config message
+    #--- in the format each central selected instead of the fixed
+    #--- long string data.  The cache re-encodes the config only
+    #--- after it changes.
+    #--------------------------------------------------------------
+    def set_config_cache(self, cache):
+        self._config_cache = cache
+
+
+    #--------------------------------------------------------------
+    #--- send_config_section
+    #--- Answer a central's request for one section of the config
+    #--- (see config_codec.SECTION_xxx) in the requested format.
+    #--------------------------------------------------------------
+    def send_config_section(self, conn_handle, fmt, section, sceneNum):
+        if self._config_cache is None:
+            self.send(b'Missing config', conn_handle)
+            return False
+        return self.send_long_string(self._config_cache.source(fmt, section, sceneNum),
+                                     self._handle_config, conn_handle, framed=fmt & FMT_FLAG_FRAMED)
+
+
+    #--------------------------------------------------------------
+    #--- _set_config_value
+    #--- Answer a (long) read of the config characteristic from a
+    #--- central that selected FMT_FLAG_LONG_READ by putting its
+    #--- message in the characteristic's value for the stack to
+    #--- serve.  Every read and read blob comes through here, so
+    #--- centrals reading different messages at the same time each
+    #--- get their own.  A message too big for a characteristic
+    #--- value is refused.
+    #--- From the IRQ (build False) only a message the cache already
+    #--- holds is served.  Otherwise the read is refused and 
+    #--- process() encodes the message for the central's next read.
+    #--- process() builds it as soon as the central writes its 
+    #--- request, so this is only seen if the config changes between
+    #--- the request and the read.
+    #--------------------------------------------------------------
+    def _set_config_value(self, conn_handle, fmt, build=False):
+        conn = self._connections.get(conn_handle)
+        section, sceneNum = conn.config_request if conn else (SECTION_ALL, 0)
+        if self._config_cache:
+            fmt &= ~(FMT_FLAG_LONG_READ | FMT_FLAG_FRAMED)
+            if build:
+                configData = self._config_cache.get(fmt, section, sceneNum)
+            else:
+                configData = self._config_cache.cached(fmt, section, sceneNum)
+                if configData is None:
+                    print("Config not encoded yet, refusing the read")
+                    if conn is not None:
+                        conn.config_prepare = True
+                        self._schedule_process()
+                    return _GATTS_ERROR_READ_NOT_PERMITTED
+        else:
+            configData = self._long_string_data
+        if not configData:
+            configData = b'Missing config'
+        if len(configData) > ATT_MAX_VALUE_LEN:
+            print("Config is {} bytes, too long to read".format(len(configData)))
+            return _GATTS_ERROR_READ_NOT_PERMITTED
+        if configData is not self._config_value:
+            self._ble.gatts_write(self._handle_config, configData)
+            self._config_value = configData
+        return _GATTS_NO_ERROR
+
+
+    #--------------------------------------------------------------
+    #--- resume_config
+    #--- Resend the last framed transfer to a central from offset.
+    #--- If the transfer is still being sent it is just rewound,
+    #--- otherwise it is queued again.  If the config changed since
+    #--- it was streamed, _fill_stream_chunk starts it over from 0
+    #--- with a new transfer id, which the central's FrameAssembler
+    #--- takes as a new transfer.  A transfer id that is not the
+    #--- last one is ignored and the central has to ask for the
+    #--- whole config again.
+    #--------------------------------------------------------------
+    def resume_config(self, conn_handle, tid, offset):
+        conn = self._connections.get(conn_handle)
+        job = conn.tx_framed if conn else None
+        if job is None or job.tid != tid or offset > job.total:
+            print("Can't resume transfer", tid, "at", offset)
+            return False
+        print("Resuming transfer", tid, "at", offset)
+        if job not in conn.tx_queue:
+            job = _TxJob(job.handle, job.stream or job.data, job.chunk_size, tid)
+            conn.tx_queue.append(job)
+            conn.tx_framed = job
+        job.offset = offset
+        job.chunk_len = 0
+        self._schedule_process()
+        return True
+
+
+    #--------------------------------------------------------------
+    #--- send_config_change
+    #--- Push a config change record to every connected central on
+    #--- the config change characteristic so that they can patch 
+    #--- their cached copy of the config instead of re-reading it.
+    #--- The record is a '\n' terminated json string and is chunked
+    #--- the same way as the full config.
+    #--------------------------------------------------------------
+    def send_config_change(self, record):
+        if not self._connections:
+            return True
+        return self.send_long_string(record, self._handle_configChange)
+
+
+    #--------------------------------------------------------------
+    #--- send_state
+    #--- Notify every connected central of the channels that changed
+    #--- since the last call, from a led_state.StatePublisher, and 
+    #--- put the whole state in the characteristic's value for the
+    #--- centrals that read it.  Each delta fits the smallest MTU of
+    #--- the centrals; a bigger change is split over a few of them.
+    #--- A delta the stack has no room for is dropped and the 
+    #--- central catches up by reading the value.
+    #--------------------------------------------------------------
+    def send_state(self, publisher, nowMs):
+        maxLen = _MTU
+        for conn in self._conn_pool:
+            if conn.handle >= 0:
+                maxLen = min(maxLen, self._tx_chunk_size(conn))
+        sent = False
+        while True:
+            delta = publisher.pack_delta(maxLen)
+            if delta is None:
+                break
+            sent = True
+            for conn in self._conn_pool:
+                if conn.handle < 0:
+                    continue
+                try:
+                    self._ble.gatts_notify(conn.handle, self._handle_state, delta)
+                except OSError:
+                    publisher.drops += 1
+        if sent:
+            self._ble.gatts_write(self._handle_state, publisher.pack_full())
+            publisher.sent(nowMs)
+
+
     #--------------------------------------------------------------
     #--- send_long_string
-    #--- Send a long config message string by chunking it into pieces 
-    #--- that fit within the BLE MTU and sending each chunk separately.
+    #--- Queue a long config message string to be sent by chunking it
+    #--- into pieces that fit within the BLE MTU and sending each chunk
+    #--- separately.  This only queues the string and returns right
+    #--- away so that it can be called from the IRQ. The chunks are
+    #--- sent by process().  Each connection has its own queue so 
+    #--- that a central only gets the strings meant for it.
     #---
     #---    Args:
     #---        long_string: The string to send (will be encoded to bytes)
     #---        characteristic_handle: The characteristic handle to write to
-    #---        chunk_size: Maximum bytes per chunk (default 240, leaving room for BLE overhead)
+    #---        conn_handle: The central to send to (default None, all of them)
+    #---        framed: Send the chunks as frames (see config_codec.FMT_FLAG_FRAMED)
+    #---    A config_codec.ConfigStream can be passed in place of the string
+    #---    to encode it as it is sent.  A stream can only go to one central.
+    #---        chunk_size: Maximum bytes per chunk (default None, as much
+    #---            as the smallest MTU of the connected centrals allows)
     #---    Returns:
-    #---        True if all chunks sent successfully, False otherwise
+    #---        True if the string was queued
     #---------------------------------------------------------------
-    def send_long_string(self, long_string, characteristic_handle, chunk_size=240):
+    def send_long_string(self, long_string, characteristic_handle, conn_handle=None, chunk_size=None, framed=False):
 
         if isinstance(long_string, str):
             data = long_string.encode('utf-8')
         else:
             data = long_string
         
-        total_length = len(data)
-        print("Peripheral thinks length is {} bytes".format(total_length))
-        chunks_sent = 0
-        
+        if not isinstance(data, ConfigStream):
+            print("Peripheral thinks length is {} bytes".format(len(data)))
+        for conn in self._conn_pool:
+            if conn.handle < 0 or (conn_handle is not None and conn.handle != conn_handle):
+                continue
+            if framed:
+                self._tx_tid = (self._tx_tid + 1) & 0xFF
+                job = _TxJob(characteristic_handle, data, chunk_size, self._tx_tid)
+                conn.tx_framed = job
+            else:
+                job = _TxJob(characteristic_handle, data, chunk_size)
+            conn.tx_queue.append(job)
+        self._schedule_process()
+        return True
+
+
+    #--------------------------------------------------------------
+    #--- process
+    #--- Do the work that is kept out of the IRQ.  This must be
+    #--- called often (every few ms) from the main loop. It is also
+    #--- scheduled by the IRQ so that new work starts right away.
+    #--- A scheduled call can land in the middle of the main loop's
+    #--- call, so it returns straight away if one is running.
+    #--------------------------------------------------------------
+    def process(self):
+        self._process_scheduled = False
+        if self._processing:
+            return
+        self._processing = True
+        activity = self._activity
+        startUs = time.ticks_us()
         try:
-            for i in range(0, total_length, chunk_size):
-                chunk = data[i:i + chunk_size]
-#                print("Chunk to send: ", chunk)
-                self._ble.gatts_write(characteristic_handle, chunk)
-                
-                # Notify all connected centrals of the data
-                for conn_handle in self._connections:
-                    self._ble.gatts_notify(conn_handle, characteristic_handle, chunk)
-                
-                chunks_sent += 1
-                time.sleep(0.02)  # Small delay between chunks to avoid overwhelming the central
-            
-            print(f"Long string sent successfully in {chunks_sent} chunks ({total_length} bytes)")
-            return True
-            
+            activity.update(time.ticks_ms())
+            self._service_rx()
+            self._service_config()
+            self._service_tx()
+            self._update_advertising()
+        finally:
+            self._processing = False
+            activity.wakeups[activity.state] += 1
+            activity.busy_us[activity.state] += time.ticks_diff(time.ticks_us(), startUs)
+
+    def _scheduled_process(self, _):
+        self.process()
+
+    def _schedule_process(self):
+        if self._process_scheduled:
+            return
+        try:
+            micropython.schedule(self._process_ref, None)
+            self._process_scheduled = True
+        except RuntimeError:
+            #--- The schedule queue is full. The main loop will call
+            #--- process() shortly anyway.
+            pass
+
+
+    #--------------------------------------------------------------
+    #--- _service_rx
+    #--- Hand the writes waiting in the centrals' rings to their
+    #--- handlers, one write from each central in turn, so a central
+    #--- that writes a lot can't hold up the others.  The central 
+    #--- that goes first moves round each call.
+    #--------------------------------------------------------------
+    def _service_rx(self):
+        numConns = len(self._conn_pool)
+        handled = True
+        while handled:
+            handled = False
+            for turn in range(numConns):
+                conn = self._conn_pool[(self._rx_turn + turn) % numConns]
+                if conn.handle >= 0 and conn.rx_ring.depth() > 0:
+                    self._handle_write(conn)
+                    handled = True
+        self._rx_turn = (self._rx_turn + 1) % numConns
+
+
+    #--------------------------------------------------------------
+    #--- _service_config
+    #--- Queue the config for each central that read the config
+    #--- characteristic since the last call, in the format it
+    #--- selected, and encode the message of each central using
+    #--- long reads that had one refused.
+    #--------------------------------------------------------------
+    def _service_config(self):
+        for conn in self._conn_pool:
+            if conn.handle < 0:
+                continue
+            if conn.config_prepare:
+                conn.config_prepare = False
+                self._set_config_value(conn.handle, conn.config_format, True)
+            if not conn.config_read:
+                continue
+            conn.config_read = False
+            fmt = conn.config_format
+            if self._config_cache:
+                configData = self._config_cache.source(fmt, SECTION_ALL)
+            else:
+                configData = self._long_string_data
+            if configData:
+                self.send_long_string(configData, self._handle_config, conn.handle,
+                                      framed=fmt & FMT_FLAG_FRAMED)
+            else:
+                self.send(b'Missing config', conn.handle)
+
+
+    #--------------------------------------------------------------
+    #--- _handle_write
+    #--- Hand the oldest write in a central's ring to the handler of
+    #--- its characteristic and keep the ring's stats.  The handler
+    #--- gets a memoryview of the ring slot, which is only good until
+    #--- it returns; ujson.loads can parse it as is.
+    #--------------------------------------------------------------
+    def _handle_write(self, conn):
+        ring = conn.rx_ring
+        ndx = ring.get_count % len(ring.slots)
+        conn_handle = conn.handle
+        value_handle = ring.value_handles[ndx]
+        arriveUs = ring.arrive_us[ndx]
+
+#        print("Write request on handle:", value_handle)
+        entry = self._write_handlers.get(value_handle)
+        if entry is None or entry[0] is None:
+            print("Handle without a callback: ", value_handle)
+            ring.get_count += 1
+            return
+        handler, withConn = entry
+        allocStart = gc.mem_alloc()
+        startUs = time.ticks_us()
+        value = ring.value(ndx)
+        try:
+            if withConn:
+                handler(conn_handle, value)
+            else:
+                handler(value)
         except Exception as e:
+            #--- A bad write (e.g. json that doesn't parse) must not
+            #--- stop the main loop, or stay in the ring and fail
+            #--- again on every call.
+            print("Error handling write on handle {}: {}".format(value_handle, e))
+            ring.errors += 1
+        finally:
+            #--- The slot is only given back once the handler is done
+            #--- with it.
+            ring.get_count += 1
+        endUs = time.ticks_us()
+
+        #--- A garbage collection during the handler makes this negative.
+        allocBytes = max(0, gc.mem_alloc() - allocStart)
+        ring.alloc_bytes += allocBytes
+        ring.max_alloc_bytes = max(ring.max_alloc_bytes, allocBytes)
+        latencyUs = time.ticks_diff(endUs, arriveUs)
+        ring.handled += 1
+        handlerUs = time.ticks_diff(endUs, startUs)
+        ring.max_handler_us = max(ring.max_handler_us, handlerUs)
+        stats = self._write_stats[value_handle]
+        stats[1] += 1
+        stats[2] += len(value)
+        stats[3] += handlerUs
+        stats[4] += allocBytes
+        ring.max_latency_us = max(ring.max_latency_us, latencyUs)
+        #--- The wait counts against the state the write arrived in.
+        self._activity.writes[self._activity.state] += 1
+        self._activity.latency_us[self._activity.state] += latencyUs
+        self._activity.active(time.ticks_ms())
+        conn.writes += 1
+        conn.write_bytes += len(value)
+        #--- Measure how long writes wait while a long string is
+        #--- being sent to this central.
+        if conn.tx_queue:
+            job = conn.tx_queue[0]
+            job.writes += 1
+            job.max_write_us = max(job.max_write_us, latencyUs)
+
+
+    #--------------------------------------------------------------
+    #--- _tx_chunk_size
+    #--- The largest chunk that fits in a notify to a central.  A
+    #--- central that has not exchanged its MTU gets the default 
+    #--- ATT MTU.
+    #--------------------------------------------------------------
+    def _tx_chunk_size(self, conn):
+        return min(_MTU, conn.mtu) - _ATT_HEADER_SIZE
+
+
+    #--------------------------------------------------------------
+    #--- _update_tx_interval
+    #--- Pace the chunks by the slowest connection interval.
+    #--------------------------------------------------------------
+    def _update_tx_interval(self):
+        intervalMs = 0
+        for conn in self._conn_pool:
+            if conn.handle >= 0:
+                intervalMs = max(intervalMs, conn.interval_ms)
+        self._tx_pacer.interval_ms = intervalMs or _DEFAULT_CONN_INTERVAL_MS
+
+
+    #--------------------------------------------------------------
+    #--- _service_tx
+    #--- Once per connection interval, send as many chunks as the 
+    #--- pacer's budget allows, taking one chunk in turn from the 
+    #--- front of each connection's queue.  The connection that goes
+    #--- first is the one after the last one sent a chunk, so a 
+    #--- budget cut down to one chunk still goes round all of them.
+    #--- A connection whose chunk the stack had no buffer for
+    #--- (EAGAIN/ENOMEM) waits for the next interval; the others 
+    #--- are still tried.
+    #--------------------------------------------------------------
+    def _service_tx(self):
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self._tx_next_ms) < 0:
+            return
+
+        pacer = self._tx_pacer
+        numConns = len(self._conn_pool)
+        sent = 0
+        #--- Bit n is set once the record at _conn_pool[n] stalled.
+        stalledMask = 0
+        pending = True
+        while pending and sent < pacer.budget:
+            pending = False
+            for turn in range(numConns):
+                if sent >= pacer.budget:
+                    break
+                connNdx = (self._tx_turn + turn) % numConns
+                conn = self._conn_pool[connNdx]
+                if conn.handle < 0 or not conn.tx_queue or stalledMask & (1 << connNdx):
+                    continue
+                if self._send_chunk(conn, now):
+                    sent += 1
+                    pending = True
+                    nextTurn = connNdx + 1
+                else:
+                    stalledMask |= 1 << connNdx
+            if sent:
+                self._tx_turn = nextTurn % numConns
+        stalled = stalledMask != 0
+        if sent == 0 and not stalled:
+            return
+
+        self._activity.active(now)
+        if stalled:
+            pacer.stalled()
+        elif sent == pacer.budget:
+            pacer.accepted()
+        self._tx_next_ms = time.ticks_add(now, pacer.interval_ms)
+
+
+    #--------------------------------------------------------------
+    #--- _send_chunk
+    #--- Notify the next chunk of the job at the front of a
+    #--- connection's queue.  Returns True if a chunk was sent
+    #--- (or the job was dropped) and False if the stack had no
+    #--- room for it.
+    #--------------------------------------------------------------
+    def _send_chunk(self, conn, now):
+        conn_handle = conn.handle
+        queue = conn.tx_queue
+        job = queue[0]
+
+        allocStart = gc.mem_alloc()
+        #--- Size each chunk when it is started so that an MTU
+        #--- exchange during the transfer is used right away.
+        if job.chunk_len == 0:
+            job.chunk_len = self._tx_chunk_size(conn)
+            if job.chunk_size:
+                job.chunk_len = min(job.chunk_len, job.chunk_size)
+            if job.stream and not self._fill_stream_chunk(job):
+                queue.pop(0)
+                return True
+        if job.stream:
+            chunk = memoryview(job.buf)[:job.buf_len]
+            dataLen = job.data_len
+        else:
+            #--- The chunk is read again if it was stalled, since the
+            #--- buffer is shared by every job.
+            job.reader.seek(job.offset)
+            if job.tid is None:
+                dataLen = job.reader.readinto(self._frame_buf, job.chunk_len)
+                chunk = self._chunk_view(dataLen)
+            else:
+                dataLen = frame_data_len(job.total, job.offset, job.chunk_len - FRAME_HEADER_SIZE)
+                job.reader.readinto(self._frame_body, dataLen)
+                chunk = self._chunk_view(pack_frame_header(self._frame_buf, job.tid, job.offset,
+                                                           dataLen, job.total, job.crc))
+        try:
+#            print("Chunk to send: ", chunk)
+            self._ble.gatts_notify(conn_handle, job.handle, chunk)
+        except OSError as e:
+            if e.args[0] in (errno.EAGAIN, errno.ENOMEM):
+                job.stalls += 1
+                return False
             print(f"Error sending long string: {e}")
-            return False
\ No newline at end of file
+            queue.pop(0)
+            return True
+
+        job.offset += dataLen
+        job.chunk_len = 0
+        job.chunks_sent += 1
+        conn.chunks_sent += 1
+        #--- A garbage collection during the chunk makes this negative.
+        job.alloc_bytes += max(0, gc.mem_alloc() - allocStart)
+
+        if job.offset >= job.total:
+            elapsed = time.ticks_diff(now, job.start_ms)
+            print(f"Long string sent to {conn_handle} in {job.chunks_sent} chunks ({job.total} bytes, {elapsed} ms)")
+            if elapsed:
+                print(f"  {job.total * 1000 // elapsed} bytes/s, {job.stalls} stalls, {self._tx_pacer.budget} chunks per {self._tx_pacer.interval_ms} ms")
+            print(f"  {job.alloc_bytes} bytes allocated, {job.alloc_bytes // job.chunks_sent} per chunk")
+            if job.writes:
+                print(f"Serviced {job.writes} writes during the send, longest took {job.max_write_us} us")
+            conn.transfers += 1
+            queue.pop(0)
+        return True
+
+
+    #--------------------------------------------------------------
+    #--- _chunk_view
+    #--- A memoryview of the first length bytes of the frame buffer.
+    #--- The views of the last _CHUNK_VIEWS lengths are kept, which
+    #--- covers the full chunks of every central, so only a short 
+    #--- last chunk makes a new one.
+    #--------------------------------------------------------------
+    def _chunk_view(self, length):
+        for ndx in range(_CHUNK_VIEWS):
+            if self._view_lens[ndx] == length:
+                return self._views[ndx]
+        ndx = self._view_next
+        self._view_next = (ndx + 1) % _CHUNK_VIEWS
+        self._view_lens[ndx] = length
+        self._views[ndx] = self._frame_mv[:length]
+        return self._views[ndx]
+
+
+    #--------------------------------------------------------------
+    #--- _fill_stream_chunk
+    #--- Encode the next chunk of a streamed job into its buffer.
+    #--- The first chunk also measures the stream, which is kept 
+    #--- out of the IRQ with the rest of the encoding.
+    #--- If the config changed since the stream was started, a
+    #--- framed transfer starts over with a new transfer id (the
+    #--- central's FrameAssembler follows it).  A plain one can't,
+    #--- since the central could not tell, so the config cache 
+    #--- streams those from a snapshot that never goes stale; one
+    #--- that does anyway is dropped.  Returns False if the job was
+    #--- dropped.
+    #--------------------------------------------------------------
+    def _fill_stream_chunk(self, job):
+        if job.stream.stale():
+            if job.tid is None:
+                print("Config changed during the transfer, dropping it")
+                return False
+            print("Config changed during transfer", job.tid, "starting over")
+            job.stream.refresh()
+            job.total = -1
+            self._tx_tid = (self._tx_tid + 1) & 0xFF
+            job.tid = self._tx_tid
+            job.offset = 0
+        if job.total < 0:
+            job.total, job.crc = job.stream.measure()
+            print("Streaming {} bytes".format(job.total))
+        if job.stream.offset != job.offset:
+            job.stream.seek(job.offset)
+
+        if job.tid is None:
+            job.data_len = job.stream.readinto(memoryview(job.buf)[:job.chunk_len])
+            job.buf_len = job.data_len
+        else:
+            job.data_len = frame_data_len(job.total, job.offset, job.chunk_len - FRAME_HEADER_SIZE)
+            job.buf_len = pack_frame_into(job.buf, job.tid, job.stream, job.offset,
+                                          job.data_len, job.crc, job.total)
+        return True
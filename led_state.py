@@ -0,0 +1,271 @@
+#-------------------------------------------------------------------------------
+#--- led_state.py
+#--- The live value and brightness of the 16 channels, published by the
+#--- peripheral on the state characteristic so that every connected
+#--- central (e.g. a second phone) sees what the LEDs are showing, however
+#--- they were set.
+#--- This file must reside on the pico of the peripheral and on any
+#--- central that wants to follow the state.
+#---
+#---    Header:      sequence number (u8), value mask (u16),
+#---                 brightness mask (u16)
+#---    Values:      one value (0 to 255) for each bit set in the value
+#---                 mask, then one brightness (0 to 100) for each bit set
+#---                 in the brightness mask, both in CHAN_KEYS order
+#---
+#--- Bit n of a mask is CHAN_KEYS[n].  A notify only holds the channels
+#--- that changed since the last one (a delta).  Changes are gathered for
+#--- at least STATE_PERIOD_MS between notifies, so a burst of writes
+#--- (e.g. a color wheel) is sent as a few deltas of the newest values
+#--- and a channel that changes and changes back is not sent at all.
+#--- The sequence number goes up by one for every delta.  The value of
+#--- the characteristic always holds the whole state (both masks 0xFFFF)
+#--- with the sequence number of the last delta; a central reads it when
+#--- it subscribes, or when it sees a sequence number missing, and then
+#--- applies the deltas that follow it.
+#---
+#--- A summary of the state also goes in the manufacturer specific data of
+#--- the scan response, so a central can tell the boxes around it apart
+#--- with one scan instead of connecting to each to read its ID:
+#---
+#---    company id (u16, 0xFFFF), magic (u8, 0xB0), box ID (u16),
+#---    config version (u16), flags (u8, bit 0 set if any LED is on),
+#---    selected scene (u8, 0 if none), state hash (u16)
+#---
+#--- The state hash is a Fletcher-16 of the values and brightness, so a
+#--- central that remembers a box's state can tell it has not changed.
+#--- The peripheral changes the scan response at most once a second.
+#---
+#--- All multi-byte numbers are little endian.
+#-------------------------------------------------------------------------------
+
+import struct
+import time
+
+from micropython import const
+
+STATE_HEADER = "<BHH"
+STATE_HEADER_SIZE = const(5)
+STATE_SIZE = const(37)
+
+#--- Shortest time between two deltas.
+STATE_PERIOD_MS = const(100)
+
+#--- 0xFFFF is the company id set aside for unregistered use; the magic
+#--- byte tells our boxes from anything else that uses it.
+ADV_FORMAT = "<HBHHBBH"
+ADV_COMPANY_ID = const(0xFFFF)
+ADV_MAGIC = const(0xB0)
+ADV_FLAG_ON = const(0x01)
+
+
+#----------------------------------------------------------------
+#--- apply_state
+#--- Apply a delta or whole state to values and brightness (16
+#--- numbers each in CHAN_KEYS order) and return its sequence
+#--- number.
+#----------------------------------------------------------------
+def apply_state(data, values, brightness) -> int:
+    seq, valueMask, brightMask = struct.unpack_from(STATE_HEADER, data, 0)
+    pos = STATE_HEADER_SIZE
+    for chanVals, chanMask in ((values, valueMask), (brightness, brightMask)):
+        for chanNdx in range(16):
+            if chanMask & (1 << chanNdx):
+                if pos >= len(data):
+                    raise ValueError("Short state message")
+                chanVals[chanNdx] = data[pos]
+                pos += 1
+    return seq
+
+
+#----------------------------------------------------------------
+#--- pack_adv_summary
+#--- Build the manufacturer specific data of the scan response.
+#----------------------------------------------------------------
+def pack_adv_summary(boxID, cfgVersion, isOn, sceneNum, stateHash) -> bytes:
+    return struct.pack(ADV_FORMAT, ADV_COMPANY_ID, ADV_MAGIC, boxID, cfgVersion & 0xFFFF,
+                       ADV_FLAG_ON if isOn else 0, sceneNum, stateHash)
+
+
+#----------------------------------------------------------------
+#--- unpack_adv_summary
+#--- Return (box ID, config version, on, scene#, state hash) from
+#--- manufacturer specific data, or None if it is not one of ours.
+#----------------------------------------------------------------
+def unpack_adv_summary(data):
+    if len(data) < struct.calcsize(ADV_FORMAT):
+        return None
+    companyID, magic, boxID, cfgVersion, flags, sceneNum, stateHash = struct.unpack_from(ADV_FORMAT, data, 0)
+    if companyID != ADV_COMPANY_ID or magic != ADV_MAGIC:
+        return None
+    return boxID, cfgVersion, bool(flags & ADV_FLAG_ON), sceneNum, stateHash
+
+
+#----------------------------------------
+#--- StatePublisher
+#--- Keeps the state last sent to the
+#--- centrals and builds the deltas from
+#--- it.  The board marks the channels it
+#--- sets with mark(), hands their new
+#--- value and brightness to set() once
+#--- due() says it is time, and the
+#--- peripheral sends what pack_delta()
+#--- builds.  Nothing here allocates but the
+#--- memoryview pack_delta() and pack_full()
+#--- return.
+#----------------------------------------
+class StatePublisher:
+    __slots__ = ("values", "brightness", "sent_values", "sent_brightness", "dirty",
+                 "value_mask", "bright_mask", "seq", "next_ms", "buf", "buf_mv",
+                 "marks", "deltas", "delta_bytes", "drops")
+
+    def __init__(self):
+        self.values = bytearray(16)
+        self.brightness = bytearray(16)
+        self.sent_values = bytearray(16)
+        self.sent_brightness = bytearray(16)
+        #--- Channels set since they were last handed to set().
+        self.dirty = 0
+        #--- Channels whose value or brightness differs from the one
+        #--- last sent.
+        self.value_mask = 0
+        self.bright_mask = 0
+        self.seq = 0
+        self.next_ms = time.ticks_ms()
+        self.buf = bytearray(STATE_SIZE)
+        self.buf_mv = memoryview(self.buf)
+        #--- Channel sets marked, deltas built and their bytes, and
+        #--- deltas the stack had no room for.
+        self.clear_stats()
+
+    #----------------------------------------------
+    #--- mark
+    #--- Note the channels (bit n is CHAN_KEYS[n])
+    #--- that were just set.
+    #----------------------------------------------
+    def mark(self, chanMask):
+        self.dirty |= chanMask
+        self.marks += 1
+
+    #----------------------------------------------
+    #--- due
+    #--- True if channels were marked and the last
+    #--- delta went out STATE_PERIOD_MS ago.
+    #----------------------------------------------
+    def due(self, nowMs) -> bool:
+        return self.dirty != 0 and time.ticks_diff(nowMs, self.next_ms) >= 0
+
+    #----------------------------------------------
+    #--- set
+    #--- Give the value and brightness of a marked
+    #--- channel.  It is only sent if it differs
+    #--- from what was last sent.
+    #----------------------------------------------
+    def set(self, chanNdx, value, brightValue):
+        bit = 1 << chanNdx
+        self.dirty &= ~bit
+        self.values[chanNdx] = value & 0xFF
+        self.brightness[chanNdx] = max(0, min(brightValue, 100))
+        if self.values[chanNdx] != self.sent_values[chanNdx]:
+            self.value_mask |= bit
+        else:
+            self.value_mask &= ~bit
+        if self.brightness[chanNdx] != self.sent_brightness[chanNdx]:
+            self.bright_mask |= bit
+        else:
+            self.bright_mask &= ~bit
+
+    #----------------------------------------------
+    #--- pack_delta
+    #--- Build the next delta, at most maxLen bytes
+    #--- long, and count it as sent.  Returns a
+    #--- memoryview of it (good until the next call)
+    #--- or None if nothing has changed.  Call it
+    #--- until it returns None to send them all.
+    #----------------------------------------------
+    def pack_delta(self, maxLen):
+        if not (self.value_mask | self.bright_mask):
+            return None
+        room = min(maxLen, STATE_SIZE) - STATE_HEADER_SIZE
+        valueMask = 0
+        brightMask = 0
+        for chanNdx in range(16):
+            bit = 1 << chanNdx
+            need = (1 if self.value_mask & bit else 0) + (1 if self.bright_mask & bit else 0)
+            if need > room:
+                break
+            room -= need
+            valueMask |= self.value_mask & bit
+            brightMask |= self.bright_mask & bit
+        self.value_mask &= ~valueMask
+        self.bright_mask &= ~brightMask
+        for chanNdx in range(16):
+            if valueMask & (1 << chanNdx):
+                self.sent_values[chanNdx] = self.values[chanNdx]
+            if brightMask & (1 << chanNdx):
+                self.sent_brightness[chanNdx] = self.brightness[chanNdx]
+        self.seq = (self.seq + 1) & 0xFF
+        dataLen = self._pack(valueMask, brightMask)
+        self.deltas += 1
+        self.delta_bytes += dataLen
+        return self.buf_mv[:dataLen]
+
+    #----------------------------------------------
+    #--- pack_full
+    #--- Build the whole state as last sent, for
+    #--- the value of the characteristic.  Returns
+    #--- a memoryview like pack_delta.
+    #----------------------------------------------
+    def pack_full(self):
+        return self.buf_mv[:self._pack(0xFFFF, 0xFFFF)]
+
+    def _pack(self, valueMask, brightMask) -> int:
+        struct.pack_into(STATE_HEADER, self.buf, 0, self.seq, valueMask, brightMask)
+        pos = STATE_HEADER_SIZE
+        for chanVals, chanMask in ((self.sent_values, valueMask), (self.sent_brightness, brightMask)):
+            for chanNdx in range(16):
+                if chanMask & (1 << chanNdx):
+                    self.buf[pos] = chanVals[chanNdx]
+                    pos += 1
+        return pos
+
+    #----------------------------------------------
+    #--- sent
+    #--- Start the wait for the next delta.
+    #----------------------------------------------
+    def sent(self, nowMs):
+        self.next_ms = time.ticks_add(nowMs, STATE_PERIOD_MS)
+
+    #----------------------------------------------
+    #--- is_on
+    #--- True if any LED was sent as on.
+    #----------------------------------------------
+    def is_on(self) -> bool:
+        for chanNdx in range(16):
+            if self.sent_values[chanNdx] and self.sent_brightness[chanNdx]:
+                return True
+        return False
+
+    #----------------------------------------------
+    #--- state_hash
+    #--- Fletcher-16 of the values and brightness
+    #--- that were sent.
+    #----------------------------------------------
+    def state_hash(self) -> int:
+        sum1 = 0
+        sum2 = 0
+        for chanVals in (self.sent_values, self.sent_brightness):
+            for chanValue in chanVals:
+                sum1 = (sum1 + chanValue) % 255
+                sum2 = (sum2 + sum1) % 255
+        return (sum2 << 8) | sum1
+
+    def clear_stats(self):
+        self.marks = 0
+        self.deltas = 0
+        self.delta_bytes = 0
+        self.drops = 0
+
+    def stats(self) -> str:
+        return "{} updates sent as {} deltas ({} bytes), {} dropped".format(
+            self.marks, self.deltas, self.delta_bytes, self.drops)
@@ -0,0 +1,271 @@
+#-------------------------------------------------------------------------------
+#--- led_stream.py
+#--- Frames of all 16 channel values streamed by a central (e.g. a phone or
+#--- laptop playing a music synced show) to the stream characteristic, and
+#--- the jitter buffer that plays them out on the peripheral at the rate
+#--- they were sent, however bunched up they arrive.
+#--- This file must reside on the pico of the peripheral and on any
+#--- central that wants to stream frames.
+#---
+#---    Header:      sequence number (u16), send time in ms (u16)
+#---    Values:      16 RGBW values (u8) in CHAN_KEYS order
+#---
+#--- A frame is 20 bytes so it fits a write even with the default MTU.
+#--- Both numbers wrap around at 65536.  The sequence number goes up by
+#--- one for every frame; the send time is the sender's clock, so frames
+#--- can be sent at any rate (30 to 60 fps is typical).  The peripheral
+#--- plays each frame STREAM_DELAY_MS after it would have arrived on a
+#--- perfect link.  A stream that stops for STREAM_TIMEOUT_MS is over; the
+#--- next frame starts a new one with any sequence number and time.
+#--- Brightness is not part of a frame; the saved brightness is used.
+#---
+#--- All multi-byte numbers are little endian.
+#-------------------------------------------------------------------------------
+
+import struct
+import time
+
+from micropython import const
+
+STREAM_HEADER = "<HH"
+STREAM_HEADER_SIZE = const(4)
+STREAM_FRAME_SIZE = const(20)
+
+#--- Frames the jitter buffer holds, how long a frame is held before it is
+#--- played and how long without a frame before the stream is over.
+STREAM_SLOTS = const(8)
+STREAM_DELAY_MS = const(60)
+STREAM_TIMEOUT_MS = const(1000)
+
+
+#----------------------------------------------------------------
+#--- pack_stream_frame
+#--- Build a frame.  values holds the 16 values in CHAN_KEYS order.
+#----------------------------------------------------------------
+def pack_stream_frame(seq, sendMs, values) -> bytes:
+    return struct.pack(STREAM_HEADER, seq & 0xFFFF, sendMs & 0xFFFF) + bytes(values)
+
+
+#----------------------------------------------------------------
+#--- _diff16
+#--- The signed difference a - b of two numbers that wrap at 65536.
+#----------------------------------------------------------------
+def _diff16(a, b) -> int:
+    return ((a - b + 0x8000) & 0xFFFF) - 0x8000
+
+
+#----------------------------------------
+#--- JitterBuffer
+#--- Holds the frames that have arrived
+#--- until they are due.  A frame is kept in
+#--- the slot of its sequence number so they
+#--- come out in order however they arrived.
+#--- push() and pop() allocate nothing.
+#---
+#--- A frame is due STREAM_DELAY_MS after
+#--- the sender's time of the first frame,
+#--- mapped to the local clock, plus how
+#--- much later than it it was sent.  Frames
+#--- that are missing when a later one is
+#--- due are skipped and the last frame
+#--- stays on the LEDs until the next.
+#----------------------------------------
+class JitterBuffer:
+    __slots__ = ("buf", "frames", "seqs", "send_ms", "valid", "active", "play_seq",
+                 "base_ms", "base_send", "period_ms", "last_arrive_ms", "last_send", "late_run",
+                 "underrun", "received", "played", "skipped", "duplicates", "late", "lost",
+                 "overruns", "underruns", "jitter_x16", "max_jitter_ms")
+
+    def __init__(self):
+        self.buf = bytearray(STREAM_SLOTS * 16)
+        bufView = memoryview(self.buf)
+        self.frames = [bufView[ndx * 16:(ndx + 1) * 16] for ndx in range(STREAM_SLOTS)]
+        self.seqs = [0] * STREAM_SLOTS
+        self.send_ms = [0] * STREAM_SLOTS
+        self.valid = bytearray(STREAM_SLOTS)
+        self.active = False
+        self.play_seq = 0
+        #--- Local time and send time of the last frame played, the
+        #--- base the due time of the following frames is worked out
+        #--- from.
+        self.base_ms = 0
+        self.base_send = 0
+        #--- How far apart the last two frames played were sent.
+        self.period_ms = 0
+        self.last_arrive_ms = 0
+        self.last_send = 0
+        #--- Late frames in a row; that many means the sender restarted.
+        self.late_run = 0
+        #--- True while the next frame is overdue.
+        self.underrun = False
+        #--- Frames received and played, frames not played because a
+        #--- newer one was due too, duplicates and late frames thrown
+        #--- away, missing frames, frames thrown away because the buffer
+        #--- was full, times the buffer ran dry, and the interarrival 
+        #--- jitter (x16, as in RFC 3550).
+        self.clear_stats()
+
+    #----------------------------------------------
+    #--- _start
+    #--- Start a new stream with this frame.
+    #----------------------------------------------
+    def _start(self, seq, sendMs, nowMs):
+        for ndx in range(STREAM_SLOTS):
+            self.valid[ndx] = 0
+        self.active = True
+        self.play_seq = seq
+        self.base_ms = time.ticks_add(nowMs, STREAM_DELAY_MS)
+        self.base_send = sendMs
+        self.period_ms = 0
+        self.last_arrive_ms = nowMs
+        self.last_send = sendMs
+        self.late_run = 0
+        self.underrun = False
+
+    #----------------------------------------------
+    #--- push
+    #--- Put a received frame in its slot.  Returns
+    #--- False if it was thrown away.
+    #----------------------------------------------
+    def push(self, frame, nowMs) -> bool:
+        if len(frame) < STREAM_FRAME_SIZE:
+            return False
+        seq = frame[0] | (frame[1] << 8)
+        sendMs = frame[2] | (frame[3] << 8)
+        self.received += 1
+        if not self.active or time.ticks_diff(nowMs, self.last_arrive_ms) > STREAM_TIMEOUT_MS:
+            self._start(seq, sendMs, nowMs)
+        else:
+            #--- The difference between how far apart two frames
+            #--- arrived and how far apart they were sent.
+            transit = abs(time.ticks_diff(nowMs, self.last_arrive_ms) - _diff16(sendMs, self.last_send))
+            self.jitter_x16 += transit - (self.jitter_x16 + 8) // 16
+            self.max_jitter_ms = max(self.max_jitter_ms, self.jitter_x16 // 16)
+            self.last_arrive_ms = nowMs
+            self.last_send = sendMs
+
+        ahead = _diff16(seq, self.play_seq)
+        if ahead < 0:
+            self.late += 1
+            self.late_run += 1
+            if self.late_run >= STREAM_SLOTS:
+                #--- The sender must have started over.
+                self._start(seq, sendMs, nowMs)
+                ahead = 0
+            else:
+                return False
+        self.late_run = 0
+
+        #--- Too far ahead to fit; give up on the oldest frames.
+        if ahead >= STREAM_SLOTS:
+            skip = ahead - STREAM_SLOTS + 1
+            self.play_seq = (self.play_seq + skip) & 0xFFFF
+            dropped = 0
+            for ndx in range(STREAM_SLOTS):
+                if self.valid[ndx] and _diff16(self.seqs[ndx], self.play_seq) < 0:
+                    self.valid[ndx] = 0
+                    dropped += 1
+            self.overruns += dropped
+            self.lost += skip - dropped
+
+        ndx = seq % STREAM_SLOTS
+        if self.valid[ndx] and self.seqs[ndx] == seq:
+            self.duplicates += 1
+            return False
+        values = self.frames[ndx]
+        for chanNdx in range(16):
+            values[chanNdx] = frame[STREAM_HEADER_SIZE + chanNdx]
+        self.seqs[ndx] = seq
+        self.send_ms[ndx] = sendMs
+        self.valid[ndx] = 1
+        return True
+
+    #----------------------------------------------
+    #--- _due
+    #--- True if a frame sent at sendMs is due.
+    #----------------------------------------------
+    def _due(self, sendMs, nowMs) -> bool:
+        return time.ticks_diff(nowMs, time.ticks_add(self.base_ms, _diff16(sendMs, self.base_send))) >= 0
+
+    #----------------------------------------------
+    #--- pop
+    #--- Return the index of the newest frame that
+    #--- is due (see frame()) or -1 if none is.
+    #--- Older due frames are skipped, as are
+    #--- missing frames once a later one is due.
+    #----------------------------------------------
+    def pop(self, nowMs) -> int:
+        if not self.active:
+            return -1
+        if time.ticks_diff(nowMs, self.last_arrive_ms) > STREAM_TIMEOUT_MS:
+            self.active = False
+            return -1
+
+        playNdx = -1
+        for _ in range(STREAM_SLOTS):
+            ndx = self.play_seq % STREAM_SLOTS
+            if self.valid[ndx] and self.seqs[ndx] == self.play_seq:
+                if not self._due(self.send_ms[ndx], nowMs):
+                    break
+                if playNdx >= 0:
+                    self.skipped += 1
+                playNdx = ndx
+                self.valid[ndx] = 0
+                gapMs = _diff16(self.send_ms[ndx], self.base_send)
+                if gapMs > 0:
+                    self.period_ms = gapMs
+                self.base_ms = time.ticks_add(self.base_ms, gapMs)
+                self.base_send = self.send_ms[ndx]
+                self.play_seq = (self.play_seq + 1) & 0xFFFF
+            elif self._later_due(nowMs):
+                self.lost += 1
+                self.play_seq = (self.play_seq + 1) & 0xFFFF
+            else:
+                break
+
+        if playNdx >= 0:
+            self.played += 1
+            self.underrun = False
+        elif (not self.underrun and self.period_ms and self.depth() == 0
+              and time.ticks_diff(nowMs, self.base_ms) > self.period_ms):
+            #--- The next frame should have been played by now.  Count
+            #--- each time the buffer runs dry, not each call.
+            self.underrun = True
+            self.underruns += 1
+        return playNdx
+
+    #----------------------------------------------
+    #--- _later_due
+    #--- True if a frame after play_seq is due.
+    #----------------------------------------------
+    def _later_due(self, nowMs) -> bool:
+        for ndx in range(STREAM_SLOTS):
+            if self.valid[ndx] and _diff16(self.seqs[ndx], self.play_seq) > 0 and self._due(self.send_ms[ndx], nowMs):
+                return True
+        return False
+
+    def clear_stats(self):
+        self.received = 0
+        self.played = 0
+        self.skipped = 0
+        self.duplicates = 0
+        self.late = 0
+        self.lost = 0
+        self.overruns = 0
+        self.underruns = 0
+        self.jitter_x16 = 0
+        self.max_jitter_ms = 0
+
+    def depth(self) -> int:
+        numFrames = 0
+        for ndx in range(STREAM_SLOTS):
+            numFrames += self.valid[ndx]
+        return numFrames
+
+    def frame(self, ndx):
+        return self.frames[ndx]
+
+    def stats(self) -> str:
+        return "{} frames received, {} played, {} skipped, {} duplicate, {} late, {} lost, {} overrun, {} underruns, jitter {} ms (max {})".format(
+            self.received, self.played, self.skipped, self.duplicates, self.late, self.lost, self.overruns,
+            self.underruns, self.jitter_x16 // 16, self.max_jitter_ms)
@@ -9,13 +9,18 @@
 #--- set the colors on the specified channel(s) of the controller.
 #-----------------------------------------------------------------
 from machine import Pin,PWM,unique_id
-from utime import sleep, ticks_ms
+from utime import sleep, sleep_ms, ticks_ms, ticks_add, ticks_diff
 import ubluetooth as bluetooth
 from led_peripheral import LEDPeripheral
 import ujson
 import neopixel
 import math
 import ConfigObj
+import config_codec
+import command_codec
+import led_stream
+import led_state
+from config_codec import CHAN_KEYS, CHAN_NAMES
 import random
 
 #--- Create a Bluetooth Low Energy (BLE) object
@@ -33,6 +38,15 @@ Max_RGB_Array_Index = const(7)
 Max_W_Array_Index = const(1)
 Max_Dimmer_Index = const(3)
 
+#--- How often the main loop lets the peripheral do its work, and how
+#--- often once the centrals have gone quiet.  A write still gets
+#--- handled straight away since the peripheral schedules its work.
+MAIN_LOOP_MS = const(5)
+IDLE_LOOP_MS = const(50)
+
+#--- How often the channels written without response are set.
+RENDER_MS = const(20)
+
 #--- PWM Setup for RGBW ===
 PWM_FREQ = 1000  # Hz
 rgbw_pins = {
@@ -103,6 +117,35 @@ saved_rgbw_values = {
 global cfgObj
 cfgObj = ConfigObj.ConfigObj()
 
+#--- The channels (bit n is CHAN_KEYS[n]) written without response
+#--- since they were last rendered.  Their newest value and brightness
+#--- are already saved, so a burst of writes to one channel only sets
+#--- the LED once.  renderStats holds the writes, renders and channel
+#--- updates that were skipped because a newer one came in.
+pendingChans = 0
+nextRenderMs = ticks_ms()
+renderStats = [0, 0, 0]
+
+#--- Channel values read out of a setLED or setBright message.
+scanVals = bytearray(16)
+
+#--- Frames streamed by a central wait here until they are due.
+streamBuf = led_stream.JitterBuffer()
+
+#--- The channels that were set wait here until the live state is 
+#--- next sent to the centrals.
+statePub = led_state.StatePublisher()
+
+#--- The 4 digit ID of this box and the scene showing on the LEDs (0
+#--- once any channel is changed after the scene was selected), for the
+#--- summary of the box in its scan response.
+boxID = 0
+activeScene = 0
+
+#--- Encoded copies of the config in each format a central can
+#--- ask for. They are rebuilt only after the config changes.
+cfgCache = config_codec.ConfigCache(cfgObj)
+
 #------------------------------------------------
 #--- set_channel_names 
 #--- This function is used to set the names of the
@@ -205,50 +248,78 @@ def set_rgbw(ctrlNum, r, g, b, w, rb, gb, bb, wb):
 
 
 #------------------------------------------------
-#--- set_one_value
-#--- The interrupt routine will have parsed out the
-#--- controller number, the channel key, and the 
-#--- value.  Save the value and then set the LED
-#--- value and brightness.
+#--- stage_value
+#--- Save the value (0 to 255) of channel chanNdx,
+#--- its index in CHAN_KEYS, without setting the
+#--- LED.  Every channel of a message is staged
+#--- first and then commit_chans sets the LEDs so
+#--- that they all change together.  A value out
+#--- of range (only json can send one) is clamped
+#--- so that it can't fail later in the batch.
 #------------------------------------------------
-def set_one_value(ctrlNum, chanKey, chanValue):
-
-#    print("Controller: " + ctrlNum + " Chan key: " + chanKey + " Chan value: " + str(chanValue))
+def stage_value(chanNdx, chanValue):
+    saved_rgbw_values[CHAN_KEYS[chanNdx]] = max(0, min(chanValue, 255))
 
-    saved_rgbw_values[ctrlNum + chanKey] = int(chanValue)
-    brightValue = rgbw_brightness[ctrlNum + chanKey]
-    finalBright = brightValue / 100
-    scaledValue = int(chanValue) / 255 * 65535
-    finalValue = int(scaledValue * finalBright)
-#    print("Bright: ", finalBright, " RGBW Value: ", chanValue, " Scaled Value: ", scaledValue, " Final Value: ", finalValue)
 
-    # Convert 0–255 to 0–65535 duty cycle and set the actual LED.
-    # Brightness ratio is a scale of 1 to 100
-#    rgbw_pins[ctrlNum + chanKey].duty_u16(int(saved_rgbw_values[ctrlNum + chanKey] / 255 * 65535 * brightValue / 100))
-    rgbw_pins[ctrlNum + chanKey].duty_u16(int(scaledValue * finalBright))
+#------------------------------------------------
+#--- stage_brightness
+#--- Save the brightness (0 to 100) of channel
+#--- chanNdx, its index in CHAN_KEYS, without 
+#--- setting the LED.  It is clamped like the 
+#--- value.
+#------------------------------------------------
+def stage_brightness(chanNdx, brightValue):
+    rgbw_brightness[CHAN_KEYS[chanNdx]] = max(0, min(brightValue, 100))
 
 
 #------------------------------------------------
-#--- set_one_brightness
-#--- The interrupt routine will have parsed out the
-#--- controller number, the channel key, and the 
-#--- brightness value.  Save the value and then set
-#--- the LED value and brightness.
+#--- commit_chans
+#--- Set the LED of every channel whose bit is set
+#--- in chanMask (bit n is CHAN_KEYS[n]) from its
+#--- saved value and brightness.  This sticks to 
+#--- integer math; value * 257 is the 0 to 65535 
+#--- duty cycle.
 #------------------------------------------------
-def set_one_brightness(ctrlNum, chanKey, brightValue):
+def commit_chans(chanMask):
+    global activeScene
+
+    for chanNdx in range(16):
+        if chanMask & (1 << chanNdx):
+            chanKey = CHAN_KEYS[chanNdx]
+            rgbw_pins[chanKey].duty_u16(saved_rgbw_values[chanKey] * 257 * rgbw_brightness[chanKey] // 100)
+    statePub.mark(chanMask)
+    if chanMask:
+        activeScene = 0
 
-#    print("Controller: " + ctrlNum + " Chan key: " + chanKey + " bright value: " + str(brightValue))
-    rgbw_brightness[ctrlNum + chanKey] = int(brightValue)
-    rgbw_value = saved_rgbw_values[ctrlNum + chanKey]
-    finalBright = int(brightValue) / 100
-    scaledValue = int(rgbw_value) / 255 * 65535
-    finalValue = int(scaledValue * finalBright)
-#    print("Bright: ", finalBright, " RGBW Value: ", rgbw_value, " Scaled Value: ", scaledValue, " Final Value: ", finalValue)
 
-    # Convert 0–255 to 0–65535 duty cycle and set the actual LED.
-    # Brightness ratio is a scale of 1 to 100
-#    rgbw_pins[ctrlNum + chanKey].duty_u16(int(rgbw_value / 255 * 65535 * int(brightValue) / 100))
-    rgbw_pins[ctrlNum + chanKey].duty_u16(int(scaledValue * finalBright))
+#------------------------------------------------
+#--- stage_json
+#--- Stage the channels of a json message keyed by
+#--- controller number with stage_value or 
+#--- stage_brightness.  Each controller has either
+#--- a dictionary of channel name to value, e.g.
+#--- {'1': {'R': '255'}}, or a list of its R, G, B
+#--- and W values with null for a channel to leave
+#--- alone, e.g. {'1': [255, 0, null, null]}.
+#--- Returns the mask of the channels staged.
+#------------------------------------------------
+def stage_json(ctrlDict, stage):
+    chanMask = 0
+    for ctrlNum in ctrlDict:
+        ctrlNdx = int(ctrlNum) - 1
+        if ctrlNdx < 0 or ctrlNdx > 3:
+            print("Invalid controller number: ", ctrlNum)
+            continue
+        chanVals = ctrlDict[ctrlNum]
+        for chanNdx in range(4):
+            if isinstance(chanVals, list):
+                chanValue = chanVals[chanNdx] if chanNdx < len(chanVals) else None
+            else:
+                chanValue = chanVals.get(CHAN_NAMES[chanNdx])
+            if chanValue is not None:
+                stage(ctrlNdx * 4 + chanNdx, int(chanValue))
+                chanMask |= 1 << (ctrlNdx * 4 + chanNdx)
+    return chanMask
 
 
 
@@ -322,16 +393,16 @@ def save_scene_config(sceneID, sceneName, filePath):
 
 
 #----------------------------------------------------------------
-#--- refresh_config_bytes
-#--- Recompute the config JSON from cfgObj and push the updated
-#--- bytes into ledPeripheral so reconnecting centrals get
-#--- the current config rather than the startup snapshot.
+#--- on_config_change
+#--- Called by cfgObj with a small change record each time the
+#--- config is mutated.  Encode the record and push it to all
+#--- connected centrals so they can patch their cached config.
 #----------------------------------------------------------------
-def refresh_config_bytes():
-    cfgStr = cfgObj.to_json()
-    cfgBytes = cfgStr.encode('utf-8')
-    cfgBytes += b'\n'
-    ledPeripheral.set_long_string_data(cfgBytes)
+def on_config_change(record):
+    changeBytes = ujson.dumps(record).encode('utf-8')
+    changeBytes += b'\n'
+    ledPeripheral.send_config_change(changeBytes)
+    update_adv_summary()
 
 
 #----------------------------------------------------------------
@@ -384,8 +455,6 @@ def save_scene(data):
         aName = data["8"]
         save_scene_config("8", aName, config_file_path)
 
-    refresh_config_bytes()
-
 
 #----------------------------------------------------------------
 #--- set_a_scene
@@ -476,6 +545,7 @@ def set_a_scene(data):
                 rgbw_brightness["4B"],
                 rgbw_brightness["4W"]
             )
+    statePub.mark(0xFFFF)
 
 
 
@@ -486,6 +556,7 @@ def set_a_scene(data):
 #---
 #----------------------------------------------------------------
 def load_scene(oneSceneNum):
+    global activeScene
 
     sceneNum = int(oneSceneNum)
     config_file_path = ""
@@ -535,6 +606,7 @@ def load_scene(oneSceneNum):
         with open(filePath, "r") as file:
             sceneData = ujson.load(file)
             set_a_scene(sceneData[sceneKey])
+            activeScene = sceneNum
 
     except OSError:
         #--- Failed to open file for read so no
@@ -553,6 +625,9 @@ def load_scene(oneSceneNum):
 #---
 #----------------------------------------------------------------
 def all_off():
+    global activeScene
+
+    activeScene = 0
     saved_rgbw_values["1R"] = 0
     saved_rgbw_values["1G"] = 0
     saved_rgbw_values["1B"] = 0
@@ -589,9 +664,18 @@ def all_off():
     set_rgbw(2, 0, 0, 0, 0, 100, 100, 100, 100)
     set_rgbw(3, 0, 0, 0, 0, 100, 100, 100, 100)
     set_rgbw(4, 0, 0, 0, 0, 100, 100, 100, 100)
+    statePub.mark(0xFFFF)
 
 
 
+#----------------------------------------------------------------
+#--- The on_xxx_rx callbacks are called by ledPeripheral.process()
+#--- with a memoryview of the received message in the peripheral's
+#--- receive ring.  ujson.loads (or command_codec.scan_chan_json)
+#--- parses it without a copy.  The view is reused once the 
+#--- callback returns so it must not be kept.
+#----------------------------------------------------------------
+
 #----------------------------------------------------------------
 #--- on_sceneSelect_rx
 #--- Define a callback function to handle a received command
@@ -599,12 +683,10 @@ def all_off():
 #---
 #----------------------------------------------------------------
 def on_sceneSelect_rx(data):
-    print("sceneSelect Data received: ", data)  # Print the received data
+    print("sceneSelect Data received: ", bytes(data))  # Print the received data
 
     #--- The only data is the scene number.
-    localDict = {}
-    dataStr = data.decode('utf-8')
-    localDict = ujson.loads(dataStr)
+    localDict = ujson.loads(data)
  
     if "LEDScene" in localDict:
         load_scene(localDict["LEDScene"])
@@ -618,12 +700,10 @@ def on_sceneSelect_rx(data):
 #---
 #----------------------------------------------------------------
 def on_sceneSave_rx(data):
-    print("sceneSave Data received: ", data)  # Print the received data
+    print("sceneSave Data received: ", bytes(data))  # Print the received data
 
     #--- Get the scene data which is a scene number and a name.
-    localDict = {}
-    dataStr = data.decode('utf-8')
-    localDict = ujson.loads(dataStr)
+    localDict = ujson.loads(data)
  
     save_scene(localDict)
 
@@ -633,30 +713,14 @@ def on_sceneSave_rx(data):
 #--- on_setBright_rx
 #--- Define a callback function to handle a received command
 #--- to set the brightness of the LEDs.
-#--- The first key in the json string is the controller number.
-#--- Get the controller type and call the appropriate
-#--- brightness setting function.
-#--- duty_u16 is ratio of duty_cycle / 65535
-#--- So we have to convert 0 to 255 into 0 to 65535
+#--- The keys of the json string are the controller numbers.
+#--- The brightness of every controller in the message is 
+#--- staged and then all of the LEDs are set at once.
 #----------------------------------------------------------------
 def on_setBright_rx(data):
-    print("setBright Data received: ", data)  # Print the received data
+#    print("setBright Data received: ", bytes(data))  # Print the received data
 
-    #--- There should only be a message for a single controller
-    localDict = {}
-    dataStr = data.decode('utf-8')
-    localDict = ujson.loads(dataStr)
-    ctrlNum = next(iter(localDict))
-#    print("First key: ", ctrlNum)
-
-    if 'R' in localDict[ctrlNum]:
-        set_one_brightness(ctrlNum, 'R', localDict[ctrlNum]['R'])
-    if 'G' in localDict[ctrlNum]:
-        set_one_brightness(ctrlNum, 'G', localDict[ctrlNum]['G'])
-    if 'B' in localDict[ctrlNum]:
-        set_one_brightness(ctrlNum, 'B', localDict[ctrlNum]['B'])
-    if 'W' in localDict[ctrlNum]:
-        set_one_brightness(ctrlNum, 'W', localDict[ctrlNum]['W'])
+    commit_chans(stage_bright_msg(data))
 
 
 
@@ -670,13 +734,11 @@ def on_setBright_rx(data):
 #--- So we have to convert 0 to 255 into 0 to 65535
 #----------------------------------------------------------------
 def on_allOff_rx(data):
-    print("allOff Data received: ", data)  # Print the received data
+    print("allOff Data received: ", bytes(data))  # Print the received data
 
     #--- It doesn't matter what the message is, we are just
     #--- turning everything off.
-    localDict = {}
-    dataStr = data.decode('utf-8')
-    localDict = ujson.loads(dataStr)
+    localDict = ujson.loads(data)
     all_off()
 
 
@@ -684,36 +746,224 @@ def on_allOff_rx(data):
 #----------------------------------------------------------------
 #--- on_setLED_rx
 #--- Define a callback function to handle received data to set an LED.
-#--- The first key in the json string is the controller number.
-#--- Get the controller type and call the appropriate
-#--- LED setting function.
-#--- 
-#---
-#--- duty_u16 is ratio of duty_cycle / 65535
-#--- So we have to convert 0 to 255 into 0 to 65535
+#--- The keys of the json string are the controller numbers.
+#--- A batch message instead has the key "V" with the values and
+#--- "B" with the brightness of any number of controllers, e.g.
+#--- {"V": {"1": [255, 0, 67, 0], "2": [...]}, "B": {"1": [...]}}
+#--- Every channel in the message is staged and then all of the 
+#--- LEDs are set at once.
 #----------------------------------------------------------------
 def on_setLED_rx(data):
-    print("setLED Data received: ", data)  # Print the received data
+#    print("setLED Data received: ", bytes(data))  # Print the received data
 
-    #--- There should only be a message for a single controller
-    localDict = {}
-    dataStr = data.decode('utf-8')
-    localDict = ujson.loads(dataStr)
-    ctrlNum = next(iter(localDict))
-#    print("Controller: ", ctrlNum)
-
-    if 'R' in localDict[ctrlNum]:
-        set_one_value(ctrlNum, 'R', localDict[ctrlNum]['R'])
-    if 'G' in localDict[ctrlNum]:
-        set_one_value(ctrlNum, 'G', localDict[ctrlNum]['G'])
-    if 'B' in localDict[ctrlNum]:
-        set_one_value(ctrlNum, 'B', localDict[ctrlNum]['B'])
-    if 'W' in localDict[ctrlNum]:
-        set_one_value(ctrlNum, 'W', localDict[ctrlNum]['W'])
+    commit_chans(stage_led_msg(data))
 
     return
 
 
+#----------------------------------------------------------------
+#--- stage_led_msg
+#--- Stage a setLED message, either keyed by controller number or
+#--- a batch, and return the mask of the channels staged.  The
+#--- usual shape is read by command_codec.scan_chan_json without
+#--- building any objects; anything else goes through ujson, 
+#--- which builds a dictionary of each controller.
+#----------------------------------------------------------------
+def stage_led_msg(data):
+    chanMask = stage_scanned(data, stage_value)
+    if chanMask >= 0:
+        return chanMask
+    localDict = ujson.loads(data)
+    if ("V" in localDict) or ("B" in localDict):
+        chanMask = stage_json(localDict.get("V", {}), stage_value)
+        chanMask |= stage_json(localDict.get("B", {}), stage_brightness)
+        return chanMask
+    return stage_json(localDict, stage_value)
+
+
+#----------------------------------------------------------------
+#--- stage_bright_msg
+#--- Stage a setBright message and return the mask of the 
+#--- channels staged, like stage_led_msg.
+#----------------------------------------------------------------
+def stage_bright_msg(data):
+    chanMask = stage_scanned(data, stage_brightness)
+    if chanMask >= 0:
+        return chanMask
+    return stage_json(ujson.loads(data), stage_brightness)
+
+
+#----------------------------------------------------------------
+#--- stage_scanned
+#--- Stage the channels of a message that scan_chan_json can read
+#--- and return their mask, or -1 if it can't.
+#----------------------------------------------------------------
+def stage_scanned(data, stage):
+    chanMask = command_codec.scan_chan_json(data, scanVals)
+    if chanMask > 0:
+        for chanNdx in range(16):
+            if chanMask & (1 << chanNdx):
+                stage(chanNdx, scanVals[chanNdx])
+    return chanMask
+
+
+#----------------------------------------------------------------
+#--- on_binCmd_rx
+#--- Define a callback function to handle a write of packed binary
+#--- commands (see command_codec.py).  A write can hold several 
+#--- commands; they are all checked, then staged, then the LEDs
+#--- are set at once.  The commands are read straight out of the
+#--- message so it is never copied or parsed into objects.
+#----------------------------------------------------------------
+def on_binCmd_rx(data):
+    if not command_codec.check_batch(data):
+        print("Bad binary command: ", bytes(data))
+        return
+
+    chanMask = 0
+    offset = 0
+    while offset < len(data):
+        if data[offset] == command_codec.CMD_SET_VALUE:
+            stage = stage_value
+        else:
+            stage = stage_brightness
+        ctrlMask = data[offset + 1]
+        cmdChans = data[offset + 2]
+        for ctrlNdx in range(4):
+            if ctrlMask & (1 << ctrlNdx):
+                valNdx = offset + command_codec.CMD_HEADER_SIZE
+                for chanNdx in range(4):
+                    if cmdChans & (1 << chanNdx):
+                        stage(ctrlNdx * 4 + chanNdx, data[valNdx])
+                        chanMask |= 1 << (ctrlNdx * 4 + chanNdx)
+                        valNdx += 1
+        offset += command_codec.command_length(data, offset)
+    commit_chans(chanMask)
+
+
+#----------------------------------------------------------------
+#--- on_setLEDNoRsp_rx / on_setBrightNoRsp_rx
+#--- Define callback functions for the setLED and setBright 
+#--- messages that are written without response.  The channels 
+#--- are only staged here; render_pending sets them at the 
+#--- render rate so only the newest value of a burst is shown.
+#----------------------------------------------------------------
+def on_setLEDNoRsp_rx(data):
+    add_pending(stage_led_msg(data))
+
+
+def on_setBrightNoRsp_rx(data):
+    add_pending(stage_bright_msg(data))
+
+
+#----------------------------------------------------------------
+#--- add_pending
+#--- Add the staged channels of a write without response to the
+#--- ones waiting to be rendered.
+#----------------------------------------------------------------
+def add_pending(chanMask):
+    global pendingChans
+
+    renderStats[0] += 1
+    renderStats[2] += count_chans(pendingChans & chanMask)
+    pendingChans |= chanMask
+
+
+#----------------------------------------------------------------
+#--- count_chans
+#--- Return the number of channels set in a channel mask.
+#----------------------------------------------------------------
+def count_chans(chanMask):
+    numChans = 0
+    while chanMask:
+        chanMask &= chanMask - 1
+        numChans += 1
+    return numChans
+
+
+#----------------------------------------------------------------
+#--- render_pending
+#--- Called from the main loop.  Every RENDER_MS, set the LEDs of
+#--- the channels written without response since the last render.
+#----------------------------------------------------------------
+def render_pending():
+    global pendingChans, nextRenderMs
+
+    now = ticks_ms()
+    if pendingChans and ticks_diff(now, nextRenderMs) >= 0:
+        commit_chans(pendingChans)
+        pendingChans = 0
+        renderStats[1] += 1
+        nextRenderMs = ticks_add(now, RENDER_MS)
+
+
+#----------------------------------------------------------------
+#--- print_render_stats
+#--- Print and clear the counts of the writes without response.
+#----------------------------------------------------------------
+def print_render_stats():
+    print("No response writes: ", renderStats[0], " renders: ", renderStats[1],
+          " channel updates skipped: ", renderStats[2])
+    renderStats[0] = 0
+    renderStats[1] = 0
+    renderStats[2] = 0
+
+
+#----------------------------------------------------------------
+#--- on_stream_rx
+#--- Define a callback function to handle a streamed frame (see
+#--- led_stream.py).  The frame is only put in the jitter buffer;
+#--- render_stream plays it when it is due.
+#----------------------------------------------------------------
+def on_stream_rx(data):
+    if not streamBuf.push(data, ticks_ms()) and len(data) < led_stream.STREAM_FRAME_SIZE:
+        print("Short stream frame: ", bytes(data))
+
+
+#----------------------------------------------------------------
+#--- render_stream
+#--- Called from the main loop.  Set all 16 channels from the
+#--- streamed frame that is due, if any.
+#----------------------------------------------------------------
+def render_stream():
+    frameNdx = streamBuf.pop(ticks_ms())
+    if frameNdx < 0:
+        return
+    frame = streamBuf.frame(frameNdx)
+    for chanNdx in range(16):
+        stage_value(chanNdx, frame[chanNdx])
+    commit_chans(0xFFFF)
+
+
+#----------------------------------------------------------------
+#--- publish_state
+#--- Called from the main loop.  Once the wait since the last 
+#--- delta is over, send the live value and brightness of the 
+#--- channels that were set to every central (see led_state.py).
+#----------------------------------------------------------------
+def publish_state():
+    now = ticks_ms()
+    if not statePub.due(now):
+        return
+    for chanNdx in range(16):
+        if statePub.dirty & (1 << chanNdx):
+            chanKey = CHAN_KEYS[chanNdx]
+            statePub.set(chanNdx, int(saved_rgbw_values[chanKey]), int(rgbw_brightness[chanKey]))
+    ledPeripheral.send_state(statePub, now)
+    update_adv_summary()
+
+
+#----------------------------------------------------------------
+#--- update_adv_summary
+#--- Put the ID, config version, on/off, selected scene and state
+#--- hash of the box in its scan response so a central can tell
+#--- the boxes around it apart without connecting to each one.
+#----------------------------------------------------------------
+def update_adv_summary():
+    ledPeripheral.set_adv_summary(led_state.pack_adv_summary(boxID, cfgObj.version, statePub.is_on(),
+                                                             activeScene, statePub.state_hash()))
+
+
 #----------------------------------------------------------------
 #--- on_setCtrlType_rx
 #--- Define a callback function to handle the json message to set
@@ -724,18 +974,15 @@ def on_setLED_rx(data):
 #--- 
 #----------------------------------------------------------------
 def on_setCtrlType_rx(data):
-    print("setCtrlType Data received: ", data)  # Print the received data
+    print("setCtrlType Data received: ", bytes(data))  # Print the received data
 
     #--- There should only be a message for a single controller
-    localDict = {}
-    dataStr = data.decode('utf-8')
-    localDict = ujson.loads(dataStr)
+    localDict = ujson.loads(data)
     ctrlNum = next(iter(localDict))
     cfgObj.set_ctrl_type(ctrlNum, localDict[ctrlNum]['Type'])
     cfgObj.set_ctrl_name(ctrlNum, localDict[ctrlNum]['Name'])
     chanNames = localDict[ctrlNum]['ChanNames']
     set_channel_names(ctrlNum, chanNames)
-    refresh_config_bytes()
 
 
 #----------------------------------------------------------------
@@ -748,13 +995,11 @@ def on_setCtrlType_rx(data):
 #--- we might want to be able to set the ID from the app.
 #----------------------------------------------------------------
 def on_setID_rx(data):
-    print("setID Data received: ", data)  # Print the received data
+    print("setID Data received: ", bytes(data))  # Print the received data
 
     #--- It doesn't matter what the message is, we are just
     #--- turning everything off.
-    localDict = {}
-    dataStr = data.decode('utf-8')
-    localDict = ujson.loads(dataStr)
+    localDict = ujson.loads(data)
     #--- REMOVE BEFORE FLIGHT - Do something with the data.
 
 
@@ -767,6 +1012,7 @@ def on_setID_rx(data):
 #---
 #----------------------------------------------------------------
 def generate_id():
+    global boxID
 
     #--- Try to read the ID from a file. If the file doesn't exist, 
     #--- generate a random ID and write it to the file.
@@ -796,6 +1042,9 @@ def generate_id():
             if 'file' in locals():
                 file.close()
 
+    if idStr.isdigit():
+        boxID = int(idStr)
+
 
 
 #----------------------------------------------------------
@@ -825,15 +1074,16 @@ def main():
         #--- Generate a random integer of 1..9999 as zero-padded 4-char string
         generate_id()
 
-        #--- Read the config data from the file if it exists.
-        #--- If it doesn't, get the default data. Then write the config
-        #--- string to the read characteristic so the app can get it
-        #--- after appending a '\n' to the indicate the end of the string.
-        cfgStr = cfgObj.to_json()
+        #--- The config data was read from the file when cfgObj was
+        #--- created (or set to the default data). Hand the peripheral 
+        #--- the cache of encoded config messages so the app can get it
+        #--- in whichever format it asks for. The cache picks up any 
+        #--- later changes through the config version.
 #        cfgStr = ujson.dumps(cfgDict)
-        cfgBytes = cfgStr.encode('utf-8')
-        cfgBytes += b'\n'
-        ledPeripheral.set_long_string_data(cfgBytes)
+        ledPeripheral.set_config_cache(cfgCache)
+        cfgObj.set_change_callback(on_config_change)
+        #--- Put the starting state in the state characteristic.
+        statePub.mark(0xFFFF)
 #        numBytes = len(cfgBytes)
 #        ledPeripheral.set_local_config(numBytes)
 
@@ -848,7 +1098,29 @@ def main():
                     ledPeripheral.set_sceneSave_callback(on_sceneSave_rx)
                     ledPeripheral.set_sceneSelect_callback(on_sceneSelect_rx)
                     ledPeripheral.set_setCtrlType_callback(on_setCtrlType_rx)
-                sleep(1)
+                    ledPeripheral.set_binCmd_callback(on_binCmd_rx)
+                    ledPeripheral.set_setLEDNoRsp_callback(on_setLEDNoRsp_rx)
+                    ledPeripheral.set_setBrightNoRsp_callback(on_setBrightNoRsp_rx)
+                    ledPeripheral.set_stream_callback(on_stream_rx)
+            else:
+                if renderStats[0]:
+                    print_render_stats()
+                if streamBuf.received:
+                    print("Stream: ", streamBuf.stats())
+                    streamBuf.clear_stats()
+                if statePub.deltas:
+                    print("Live state: ", statePub.stats())
+                    statePub.clear_stats()
+
+            #--- Send queued config chunks outside of the BLE IRQ.
+            ledPeripheral.process()
+            render_pending()
+            render_stream()
+            publish_state()
+            if ledPeripheral.is_idle():
+                sleep_ms(IDLE_LOOP_MS)
+            else:
+                sleep_ms(MAIN_LOOP_MS)
 
     except KeyboardInterrupt:
         print("Finished.")
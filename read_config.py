@@ -9,8 +9,10 @@ import random
 import struct
 import time
 import micropython
+import json
 
-from ble_advertising import decode_services, decode_name
+from ble_advertising import decode_all, has_uuid128
+import config_codec
 
 from micropython import const
 
@@ -48,6 +50,7 @@ _TEMP_UUID = bluetooth.UUID(0x2A6E)
 
 #--- Define service and characteristics UUIDs to match peripheral
 SERVICE_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c50")
+_SERVICE_UUID_BYTES = bytes(SERVICE_UUID)
 CONFIG_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c51")
 SET_LED_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c52")
 SET_BRIGHT_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c53")
@@ -56,12 +59,27 @@ SELECT_SCENE_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c55")
 SAVE_SCENE_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c56")
 SET_CTRL_TYPE_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c57")
 SET_BOX_ID_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c58")
+CONFIG_CHANGE_CHAR_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c59")
 
 SCAN_DURATION_MS = const(5000)
 SCAN_INTERVAL_US = const(30000)
 SCAN_WINDOW_US = const(30000)
 
 
+#-----------------------------------------------------------------
+#--- apply_config_change
+#--- Merge the "Set" patch of a config change record into a cached
+#--- config dictionary.  The patch has the same shape as the config
+#--- json but only contains the keys that changed.
+#-----------------------------------------------------------------
+def apply_config_change(config, patch):
+    for key in patch:
+        if isinstance(patch[key], dict) and isinstance(config.get(key), dict):
+            apply_config_change(config[key], patch[key])
+        else:
+            config[key] = patch[key]
+    return config
+
 
 class BLEConfigReadCentral:
     def __init__(self, ble):
@@ -74,10 +92,16 @@ class BLEConfigReadCentral:
     def _reset(self):
         # Cached name and address from a successful scan.
         self.chunks = b''
+        self.change_chunks = b''
+        self._config = None
+        self._config_version = 0
         self._name = None
         self._addr_type = None
         self._addr = None
         self.config_complete = False
+        self._format = config_codec.FMT_JSON
+        #--- Collects the chunks when the format is framed.
+        self._frames = config_codec.FrameAssembler()
 
         # Cached value (if we have one)
         self._value = None
@@ -96,21 +120,25 @@ class BLEConfigReadCentral:
         self._start_handle = None
         self._end_handle = None
         self._value_handle = None
+        self._change_handle = None
         
         self._ble.config(mtu=244)
 
     def _irq(self, event, data):
         if event == _IRQ_SCAN_RESULT:
             addr_type, addr, adv_type, rssi, adv_data = data
-            if adv_type in (_ADV_IND, _ADV_DIRECT_IND) and SERVICE_UUID in decode_services(
-                adv_data
-            ):
+            # Most packets heard in a crowded place are not ours; only
+            # decode the ones that hold our service UUID bytes.
+            if adv_type not in (_ADV_IND, _ADV_DIRECT_IND) or not has_uuid128(adv_data, _SERVICE_UUID_BYTES):
+                return
+            name, services, _ = decode_all(adv_data)
+            if SERVICE_UUID in services:
                 # Found a potential device, remember it and stop scanning.
                 self._addr_type = addr_type
                 self._addr = bytes(
                     addr
                 )  # Note: addr buffer is owned by caller so need to copy it.
-                self._name = decode_name(adv_data) or "?"
+                self._name = name or "?"
                 self._ble.gap_scan(None)
 
         elif event == _IRQ_SCAN_DONE:
@@ -162,6 +190,8 @@ class BLEConfigReadCentral:
             if conn_handle == self._conn_handle and uuid == CONFIG_CHAR_UUID:
                 self._value_handle = value_handle
 #                self._ble.gatts_set_buffer(self._value_handle, 244)
+            elif conn_handle == self._conn_handle and uuid == CONFIG_CHANGE_CHAR_UUID:
+                self._change_handle = value_handle
 
         elif event == _IRQ_GATTC_CHARACTERISTIC_DONE:
             print("Characteristic Done")
@@ -178,8 +208,16 @@ class BLEConfigReadCentral:
             # A read completed successfully.
             conn_handle, value_handle, char_data = data
             if conn_handle == self._conn_handle and value_handle == self._value_handle:
-                #--- Don't need data from read
+                #--- Don't need data from read unless it is a long read
 #                self._update_value(char_data)
+                if self._format & config_codec.FMT_FLAG_LONG_READ:
+                    self.chunks = bytes(char_data)
+                    if config_codec.is_complete(self.chunks):
+                        self.config_complete = True
+                    else:
+                        #--- gattc_read only does a single read, so only
+                        #--- the first MTU's worth of a longer value comes.
+                        print("Only got the first {} bytes of the config".format(len(self.chunks)))
                 if self._read_callback:
                     self._read_callback(self._value)
                     self._read_callback = None
@@ -200,6 +238,8 @@ class BLEConfigReadCentral:
                 self._update_value(notify_data)
                 if self._notify_callback:
                     self._notify_callback(notify_data)
+            elif conn_handle == self._conn_handle and value_handle == self._change_handle:
+                self._update_change(notify_data)
 
     # Returns true if we've successfully connected and discovered characteristics.
     def is_connected(self):
@@ -241,11 +281,59 @@ class BLEConfigReadCentral:
         self._read_callback = callback
         self._ble.gattc_read(self._conn_handle, self._value_handle)
 
+    #--- Select the encoding of the config message by writing the
+    #--- format byte (see config_codec.py) to the config characteristic.
+    def set_format(self, fmt):
+        if not self.is_connected():
+            return
+        self._format = fmt
+        self._ble.gattc_write(self._conn_handle, self._value_handle, bytes([fmt]), 1)
+
+    #--- Ask for one section of the config (see config_codec.SECTION_xxx).
+    #--- The peripheral answers with notifies without needing a read.
+    def request_section(self, fmt, section, sceneNum=0):
+        if not self.is_connected():
+            return
+        self._format = fmt
+        self._ble.gattc_write(self._conn_handle, self._value_handle, bytes([fmt, section, sceneNum]), 1)
+
+    #--- Read a section of the config straight from the config
+    #--- characteristic's value instead of having it notified.
+    def read_long(self, fmt, section, sceneNum=0, callback=None):
+        if not self.is_connected():
+            return
+        self._format = fmt | config_codec.FMT_FLAG_LONG_READ
+        self._ble.gattc_write(self._conn_handle, self._value_handle, bytes([self._format, section, sceneNum]), 1)
+        time.sleep_ms(100)
+        self.read(callback)
+
+    #--- Ask the peripheral to resend a framed config from the first
+    #--- byte we are missing.
+    def resume(self):
+        if not self.is_connected() or self._frames.tid < 0:
+            return
+        print("Resuming config at", self._frames.received)
+        self._ble.gattc_write(self._conn_handle, self._value_handle, self._frames.resume_request(), 1)
+
+    #--- Clear out any previously received config so a new read
+    #--- starts from scratch.
+    def clear_config(self):
+        self.chunks = b''
+        self._config = None
+        self.config_complete = False
+        self._frames.reset()
+
     # Sets a callback to be invoked when the device notifies us.
     def on_notify(self, callback):
         self._notify_callback = callback
 
     def _update_value(self, data):
+        if self._format & config_codec.FMT_FLAG_FRAMED:
+            #--- The frames are put in place by the assembler and the
+            #--- message is only used once it is complete.
+            if self._frames.add(data):
+                self.chunks = bytes(self._frames.data)
+            return self._value
         # Data is part of a json string
         self.chunks += bytes(data)
         return self._value
@@ -254,13 +342,48 @@ class BLEConfigReadCentral:
         return self.chunks
 #        return self._value
 
+    #--- Returns the decoded config dictionary once all chunks have
+    #--- arrived, with any change records received since applied.
+    def config(self):
+        if self._config is None and self.config_complete:
+            self._config = config_codec.decode_message(self.chunks)
+        return self._config
+
+    def _update_change(self, data):
+        #--- Change records use the same '\n' terminated chunking
+        #--- as the full config.
+        self.change_chunks += bytes(data)
+        if self.change_chunks.count(b'\n') == 0:
+            return
+        record = json.loads(self.change_chunks.strip())
+        self.change_chunks = b''
+        print("Config change: ", record)
+        cfg = self.config()
+        if cfg is not None:
+            apply_config_change(cfg, record["Set"])
+        self._config_version = record["Ver"]
+
 
     def my_notify_callback(self, notifyData):
         #--- Look for the end of string (\n) and if found,
         #--- remove the end of string, and process the json.
         dataBytes = bytes(notifyData)
         print(dataBytes)
-        if dataBytes.count(b'\n') > 0:
+        if self._format & config_codec.FMT_FLAG_FRAMED:
+            #--- Frames say where they go, so a lost one is noticed
+            #--- when the next one arrives.
+            if self._frames.complete:
+                print("Received all {} bytes".format(len(self.chunks)))
+                self.config_complete = True
+            elif self._frames.resume_needed:
+                self.resume()
+        elif self._format != config_codec.FMT_JSON:
+            #--- Binary and deflated messages carry their length in 
+            #--- the header instead of ending with a '\n'.
+            if config_codec.is_complete(self.chunks):
+                print("Received all {} bytes".format(len(self.chunks)))
+                self.config_complete = True
+        elif dataBytes.count(b'\n') > 0:
             #--- take the json string, decode it into a structure
             #--- and apply the config settings.
             #--- For now, just print
@@ -308,12 +431,51 @@ def demo():
             while True:
 
                 idx = int(input("Select Operation: \n" +
-                                "20: Read Config \n"  ))
+                                "20: Read Config \n" +
+                                "21: Read Config (binary)\n" +
+                                "22: Read Config (deflated JSON)\n" +
+                                "23: Read Config (deflated binary)\n" +
+                                "24: Read Controllers (binary)\n" +
+                                "25: Read Scene List (binary)\n" +
+                                "26: Read Scene 1 (binary)\n" +
+                                "27: Read Config (framed binary)\n" +
+                                "28: Read Controllers (binary long read)\n" ))
 
                 if 20 == idx:
                     #--- This callback prints 148.82.  I don't know
                     #--- what that means but I think it is the
                     #--- numeric value of some characters.
+                    central.clear_config()
+                    central.set_format(config_codec.FMT_JSON)
+                    time.sleep_ms(100)
+                    central.read(callback=print)
+
+                elif 21 == idx:
+                    central.clear_config()
+                    central.set_format(config_codec.FMT_BINARY)
+                    time.sleep_ms(100)
+                    central.read(callback=print)
+
+                elif (22 == idx) or (23 == idx):
+                    fmt = config_codec.FMT_JSON if 22 == idx else config_codec.FMT_BINARY
+                    central.clear_config()
+                    central.set_format(fmt | config_codec.FMT_FLAG_DEFLATE)
+                    time.sleep_ms(100)
+                    central.read(callback=print)
+
+                elif (24 <= idx) and (idx <= 26):
+                    #--- Sections are answered straight away, no read needed.
+                    central.clear_config()
+                    central.request_section(config_codec.FMT_BINARY, idx - 23, 1)
+
+                elif 28 == idx:
+                    central.clear_config()
+                    central.read_long(config_codec.FMT_BINARY, config_codec.SECTION_CONTROLLERS, callback=print)
+
+                elif 27 == idx:
+                    central.clear_config()
+                    central.set_format(config_codec.FMT_BINARY | config_codec.FMT_FLAG_FRAMED)
+                    time.sleep_ms(100)
                     central.read(callback=print)
 
                 else:
@@ -322,9 +484,16 @@ def demo():
 
                 #--- Give it time to receive the chunks
                 time.sleep_ms(2000)
+
+                #--- If the last frames of a framed config were lost there
+                #--- is nothing left to show the gap, so ask for the rest.
+                if (central._format & config_codec.FMT_FLAG_FRAMED) and not central.is_config_complete():
+                    central.resume()
+                    time.sleep_ms(2000)
                 
                 if central.is_config_complete():
                     print("Final Config: ", central.value())
+                    print("Decoded Config: ", central.config())
                     
 
                 # Alternative to the above, just show the most recently notified value.
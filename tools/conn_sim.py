@@ -0,0 +1,142 @@
+#-------------------------------------------------------------------------------
+#--- conn_sim.py
+#--- Checks how the peripheral serves several centrals at once (see
+#--- _Connection in led_peripheral.py).  The centrals are played on a
+#--- FakeBLE (see fake_ble.py).  Run it on the pico with the peripheral's
+#--- files on it:
+#---
+#---    mpremote cp tools/fake_ble.py : + run tools/conn_sim.py
+#---
+#--- It checks that:
+#---    - the box keeps advertising until max_connections centrals are
+#---      connected, ignores one over the limit without advertising again,
+#---      and advertises once one of them leaves
+#---    - a central flooding writes only fills its own ring, and the
+#---      writes of the others are handled in the first round
+#---    - long strings to three centrals over a link that takes one notify
+#---      per connection event go out in turn, no central more than one
+#---      chunk ahead of another
+#--- It prints FAIL and exits with 1 if a check is missed.
+#-------------------------------------------------------------------------------
+
+import sys
+import time
+
+from micropython import const
+
+import led_peripheral
+from fake_ble import FakeBLE
+
+CENTRALS = const(3)         # The peripheral's max_connections
+FLOOD_WRITES = const(12)    # Writes the flooding central sends at once
+PAYLOAD_SIZE = const(2000)  # Bytes of each long string
+TIMEOUT_MS = const(10000)   # Give up on the long strings after this long
+
+
+def report(name, passed) -> bool:
+    print("{:<44} {}".format(name, "ok" if passed else "FAIL"))
+    return passed
+
+
+#----------------------------------------------------------------
+#--- check_advertising
+#--- Connect one central more than the limit, then let one go.
+#----------------------------------------------------------------
+def check_advertising() -> bool:
+    ble = FakeBLE()
+    periph = led_peripheral.LEDPeripheral(ble, max_connections=CENTRALS)
+    handled = []
+    periph.set_setBright_callback(lambda data: handled.append(data[0]))
+    passed = True
+    for connHandle in range(CENTRALS):
+        ble.connect(connHandle)
+        #--- Still discoverable until the last one is in.
+        passed = passed and ble.advertising == (connHandle < CENTRALS - 1)
+    #--- The one over the limit is disconnected, so its writes are
+    #--- not handled.
+    ble.connect(CENTRALS)
+    ble.write(CENTRALS, ble.handle(led_peripheral.CHAR_UUIDS[2]), bytes((CENTRALS,)))
+    periph.process()
+    passed = passed and not handled and not ble.advertising
+    ble.disconnect(1)
+    passed = passed and ble.advertising
+    for connHandle in (0, 2):
+        ble.disconnect(connHandle)
+    return report("advertising up to the limit", passed)
+
+
+#----------------------------------------------------------------
+#--- check_flood
+#--- Central 0 floods writes and centrals 1 and 2 write once.
+#----------------------------------------------------------------
+def check_flood() -> bool:
+    ble = FakeBLE()
+    periph = led_peripheral.LEDPeripheral(ble, max_connections=CENTRALS)
+    handled = []
+    periph.set_setBright_callback(lambda data: handled.append(data[0]))
+    valueHandle = ble.handle(led_peripheral.CHAR_UUIDS[2])
+    for connHandle in range(CENTRALS):
+        ble.connect(connHandle)
+    for writeNum in range(FLOOD_WRITES):
+        ble.write(0, valueHandle, bytes((0, writeNum)))
+    ble.write(1, valueHandle, bytes((1, 0)))
+    ble.write(2, valueHandle, bytes((2, 0)))
+    periph.process()
+    flooded = handled.count(0)
+    passed = (1 in handled[:CENTRALS] and 2 in handled[:CENTRALS]
+              and handled.count(1) == 1 and handled.count(2) == 1 and 0 < flooded < FLOOD_WRITES)
+    print("  {} of {} flooded writes fit in the ring, order {}".format(flooded, FLOOD_WRITES, handled[:CENTRALS]))
+    for connHandle in range(CENTRALS):
+        ble.disconnect(connHandle)
+    return report("a flood of writes doesn't hold up the others", passed)
+
+
+#----------------------------------------------------------------
+#--- check_tx_turns
+#--- Send a long string to each central over a slow link.
+#----------------------------------------------------------------
+def check_tx_turns() -> bool:
+    ble = FakeBLE(30, 3, 1)
+    periph = led_peripheral.LEDPeripheral(ble, max_connections=CENTRALS)
+    chunks = [0] * CENTRALS
+    received = [0] * CENTRALS
+    lead = [0]
+
+    #--- How far the central that was sent a chunk is ahead of the
+    #--- others that are still waiting for some.
+    def on_notify(conn_handle, value_handle, data):
+        chunks[conn_handle] += 1
+        received[conn_handle] += len(data)
+        for ndx in range(CENTRALS):
+            if received[ndx] < PAYLOAD_SIZE:
+                lead[0] = max(lead[0], chunks[conn_handle] - chunks[ndx])
+
+    ble.on_notify = on_notify
+    for connHandle in range(CENTRALS):
+        ble.connect(connHandle)
+    payload = bytes(PAYLOAD_SIZE)
+    valueHandle = ble.handle(led_peripheral.CHAR_UUIDS[0])
+    for connHandle in range(CENTRALS):
+        periph.send_long_string(payload, valueHandle, connHandle)
+    startMs = time.ticks_ms()
+    while min(received) < PAYLOAD_SIZE and time.ticks_diff(time.ticks_ms(), startMs) < TIMEOUT_MS:
+        periph.process()
+        time.sleep_ms(1)
+    passed = received == [PAYLOAD_SIZE] * CENTRALS and lead[0] <= 1
+    print("  {} chunks each, most chunks one central got ahead {}".format(chunks, lead[0]))
+    for connHandle in range(CENTRALS):
+        ble.disconnect(connHandle)
+    return report("long strings go out in turn", passed)
+
+
+def main():
+    allPassed = check_advertising()
+    allPassed = check_flood() and allPassed
+    allPassed = check_tx_turns() and allPassed
+    print("All checks ok" if allPassed else "Some checks failed")
+    if not allPassed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#-------------------------------------------------------------------------------
+#--- fake_ble.py
+#--- A stand in for bluetooth.BLE for the tools in this folder.  It is handed
+#--- to LEDPeripheral in place of the real one so the peripheral's receive
+#--- and transmit paths can be run and measured on a pico without a central.
+#--- The tools play the central with connect(), write() and read(), which
+#--- call the peripheral's IRQ the way the stack does.
+#---
+#--- Notifies go through a model of the link: the stack holds at most
+#--- stack_slots notifies and the radio sends per_event of them at each
+#--- connection event, every interval_ms.  A notify that doesn't fit fails
+#--- with ENOMEM like the real stack's.
+#---
+#--- Unlike the real stack, gatts_read returns the object that was written
+#--- instead of a new bytes object, and the IRQ data is one list that is
+#--- reused, so the fake itself allocates nothing per write.
+#--- Copy it to the pico along with the peripheral's files.
+#-------------------------------------------------------------------------------
+
+import errno
+import time
+
+from micropython import const
+
+_IRQ_CENTRAL_CONNECT = const(1)
+_IRQ_CENTRAL_DISCONNECT = const(2)
+_IRQ_GATTS_WRITE = const(3)
+_IRQ_GATTS_READ_REQUEST = const(4)
+_IRQ_MTU_EXCHANGED = const(21)
+_IRQ_CONNECTION_UPDATE = const(27)
+
+
+class FakeBLE:
+
+    def __init__(self, interval_ms=30, stack_slots=6, per_event=4):
+        self.interval_ms = interval_ms
+        self.stack_slots = stack_slots
+        self.per_event = per_event
+        self._irq = None
+        self._uuids = []
+        self._values = {}
+        self._irq_data = [0, 0]
+        self._queued = 0
+        self._event_ms = time.ticks_ms()
+        #--- Called with (conn_handle, value_handle, data) for every
+        #--- notify the stack takes.  data is only good until it returns.
+        self.on_notify = None
+        self.advertising = False
+        self.clear_stats()
+
+    #----------------------------------------------
+    #--- clear_stats
+    #--- Notifies taken and their bytes, and
+    #--- notifies refused because the stack was full.
+    #----------------------------------------------
+    def clear_stats(self):
+        self.notifies = 0
+        self.notify_bytes = 0
+        self.refused = 0
+
+    #----------------------------------------------
+    #--- handle
+    #--- The value handle of a characteristic.
+    #----------------------------------------------
+    def handle(self, uuid) -> int:
+        for ndx in range(len(self._uuids)):
+            if self._uuids[ndx] == uuid:
+                return ndx + 1
+        raise ValueError("Characteristic not registered")
+
+    #---------------------------------------------------------
+    #--- The bluetooth.BLE methods LEDPeripheral uses.
+    #---------------------------------------------------------
+    def active(self, *args):
+        return True
+
+    def irq(self, handler):
+        self._irq = handler
+
+    def config(self, *args, **kwargs):
+        return None
+
+    def gatts_register_services(self, services):
+        handles = []
+        for _, chars in services:
+            serviceHandles = []
+            for char in chars:
+                self._uuids.append(char[0])
+                serviceHandles.append(len(self._uuids))
+            handles.append(tuple(serviceHandles))
+        return tuple(handles)
+
+    def gatts_set_buffer(self, value_handle, size, append=False):
+        pass
+
+    def gap_advertise(self, interval_us, adv_data=None, resp_data=None, connectable=True):
+        self.advertising = interval_us is not None
+
+    def gap_disconnect(self, conn_handle):
+        self.disconnect(conn_handle)
+        return True
+
+    def gatts_write(self, value_handle, data, send_update=False):
+        self._values[value_handle] = data
+
+    def gatts_read(self, value_handle):
+        return self._values.get(value_handle, b'')
+
+    def gatts_notify(self, conn_handle, value_handle, data=None):
+        self._radio()
+        if self._queued >= self.stack_slots:
+            self.refused += 1
+            raise OSError(errno.ENOMEM)
+        self._queued += 1
+        self.notifies += 1
+        self.notify_bytes += len(data)
+        if self.on_notify:
+            self.on_notify(conn_handle, value_handle, data)
+        return True
+
+    #----------------------------------------------
+    #--- _radio
+    #--- Take out of the stack the notifies the
+    #--- radio sent since the last call.
+    #----------------------------------------------
+    def _radio(self):
+        events = time.ticks_diff(time.ticks_ms(), self._event_ms) // self.interval_ms
+        if events > 0:
+            self._event_ms = time.ticks_add(self._event_ms, events * self.interval_ms)
+            self._queued = max(0, self._queued - events * self.per_event)
+
+    #---------------------------------------------------------
+    #--- The central's side.
+    #---------------------------------------------------------
+    def connect(self, conn_handle=0, mtu=244):
+        #--- The stack stops advertising when a central connects.
+        self.advertising = False
+        self._irq(_IRQ_CENTRAL_CONNECT, (conn_handle, 0, bytes(6)))
+        self._irq(_IRQ_MTU_EXCHANGED, (conn_handle, mtu))
+        #--- The interval in units of 1.25 ms and a 4 s timeout.
+        self._irq(_IRQ_CONNECTION_UPDATE, (conn_handle, self.interval_ms * 4 // 5, 0, 400, 0))
+
+    def disconnect(self, conn_handle=0):
+        self._irq(_IRQ_CENTRAL_DISCONNECT, (conn_handle, 0, bytes(6)))
+
+    def write(self, conn_handle, value_handle, data):
+        self._values[value_handle] = data
+        self._irq_data[0] = conn_handle
+        self._irq_data[1] = value_handle
+        self._irq(_IRQ_GATTS_WRITE, self._irq_data)
+
+    #----------------------------------------------
+    #--- read
+    #--- Read a characteristic.  Returns its value,
+    #--- or None if the peripheral refused the read.
+    #----------------------------------------------
+    def read(self, conn_handle, value_handle):
+        if self._irq(_IRQ_GATTS_READ_REQUEST, (conn_handle, value_handle)):
+            return None
+        return self._values.get(value_handle, b'')
@@ -0,0 +1,143 @@
+#-------------------------------------------------------------------------------
+#--- idle_sim.py
+#--- Checks that the peripheral goes idle when nothing is happening and
+#--- that a write still gets handled straight away when it is (see
+#--- _Activity in led_peripheral.py).  It runs the main loop of
+#--- main_board.py, which polls every MAIN_LOOP_MS while active and every
+#--- IDLE_LOOP_MS while idle, with the writes of a central played on a
+#--- FakeBLE (see fake_ble.py) arriving during its sleeps like the IRQ
+#--- does.  It takes about 8 seconds.  Run it on the pico with the
+#--- peripheral's files on it:
+#---
+#---    mpremote cp tools/fake_ble.py : + run tools/idle_sim.py
+#---
+#--- It checks that:
+#---    - a write every 20 ms keeps the peripheral active
+#---    - it goes idle _IDLE_AFTER_MS (3 s) after the last write, and then
+#---      polls at most 1000 / IDLE_LOOP_MS times a second
+#---    - a write while idle is handled within MAIN_LOOP_MS, by the process()
+#---      it schedules rather than the next poll, and makes it active again
+#--- It prints FAIL and exits with 1 if a check is missed.
+#-------------------------------------------------------------------------------
+
+import sys
+import time
+
+from micropython import const
+
+import led_peripheral
+from fake_ble import FakeBLE
+
+#--- As in main_board.py.
+MAIN_LOOP_MS = const(5)
+IDLE_LOOP_MS = const(50)
+
+IDLE_AFTER_MS = const(3000)     # led_peripheral._IDLE_AFTER_MS
+BURST_MS = const(2000)          # Length of the burst of writes
+WRITE_EVERY_MS = const(20)      # Time between the writes of the burst
+QUIET_MS = const(5000)          # Time with no writes after the burst
+
+
+#----------------------------------------------------------------
+#--- Loop
+#--- The main loop and the central writing to it.
+#----------------------------------------------------------------
+class Loop:
+    __slots__ = ("ble", "periph", "value_handle", "polls", "idle_polls", "write_us", "latency_us")
+
+    def __init__(self):
+        self.ble = FakeBLE()
+        self.periph = led_peripheral.LEDPeripheral(self.ble)
+        self.periph.set_setBright_callback(self.on_write)
+        self.value_handle = self.ble.handle(led_peripheral.CHAR_UUIDS[2])
+        self.ble.connect()
+        #--- Polls of the main loop, and those that found it idle.
+        self.polls = 0
+        self.idle_polls = 0
+        self.write_us = 0
+        #--- Longest a write waited to be handled, -1 for none yet.
+        self.latency_us = -1
+
+    def on_write(self, data):
+        self.latency_us = max(self.latency_us, time.ticks_diff(time.ticks_us(), self.write_us))
+
+    def write(self):
+        self.write_us = time.ticks_us()
+        self.ble.write(0, self.value_handle, b'{"1": {"W": 10}}')
+
+    #----------------------------------------------
+    #--- run
+    #--- Run the main loop for ms, writing every
+    #--- writeEvery ms (0 for no writes) from
+    #--- firstWriteMs.  The sleeps are taken 1 ms
+    #--- at a time so the writes can land in them.
+    #----------------------------------------------
+    def run(self, ms, writeEvery=0, firstWriteMs=0):
+        startMs = time.ticks_ms()
+        nextWriteMs = time.ticks_add(startMs, firstWriteMs)
+        while time.ticks_diff(time.ticks_ms(), startMs) < ms:
+            self.periph.process()
+            self.polls += 1
+            if self.periph.is_idle():
+                self.idle_polls += 1
+            wakeMs = time.ticks_add(time.ticks_ms(), IDLE_LOOP_MS if self.periph.is_idle() else MAIN_LOOP_MS)
+            while time.ticks_diff(wakeMs, time.ticks_ms()) > 0:
+                if writeEvery and time.ticks_diff(time.ticks_ms(), nextWriteMs) >= 0:
+                    self.write()
+                    nextWriteMs = time.ticks_add(nextWriteMs, writeEvery)
+                time.sleep_ms(1)
+
+    #----------------------------------------------
+    #--- run_until_idle
+    #--- Run the main loop with no writes until the
+    #--- peripheral is idle and return how long it
+    #--- took.
+    #----------------------------------------------
+    def run_until_idle(self, ms) -> int:
+        startMs = time.ticks_ms()
+        while not self.periph.is_idle() and time.ticks_diff(time.ticks_ms(), startMs) < ms:
+            self.run(MAIN_LOOP_MS)
+        return time.ticks_diff(time.ticks_ms(), startMs)
+
+
+def report(name, passed) -> bool:
+    print("{:<44} {}".format(name, "ok" if passed else "FAIL"))
+    return passed
+
+
+def main():
+    loop = Loop()
+    allPassed = True
+
+    #--- It starts idle; the first write makes it active.
+    loop.write()
+    loop.run(BURST_MS, WRITE_EVERY_MS)
+    activePolls = loop.polls * 1000 // BURST_MS
+    print("  {} polls/s during the burst".format(activePolls))
+    allPassed &= report("active during the burst", loop.idle_polls == 0)
+
+    idleMs = loop.run_until_idle(QUIET_MS)
+    print("  idle {} ms after the burst".format(idleMs))
+    allPassed &= report("idle after the burst", IDLE_AFTER_MS - WRITE_EVERY_MS <= idleMs < IDLE_AFTER_MS + 100)
+
+    loop.polls = 0
+    loop.run(QUIET_MS - idleMs)
+    idlePolls = loop.polls * 1000 // (QUIET_MS - idleMs)
+    print("  {} polls/s while idle".format(idlePolls))
+    allPassed &= report("slow polling while idle",
+                        loop.periph.is_idle() and idlePolls <= 1000 // IDLE_LOOP_MS)
+
+    #--- The write lands in the middle of an idle sleep.
+    loop.latency_us = -1
+    loop.run(IDLE_LOOP_MS, QUIET_MS, IDLE_LOOP_MS // 4)
+    print("  a write while idle was handled in {} us".format(loop.latency_us))
+    allPassed &= report("a write while idle is handled at once",
+                        0 <= loop.latency_us < MAIN_LOOP_MS * 1000 and not loop.periph.is_idle())
+
+    print("All checks ok" if allPassed else "Some checks failed")
+    if not allPassed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#-------------------------------------------------------------------------------
+#--- link_sim.py
+#--- Measures how fast the peripheral sends a long string over links of
+#--- different speeds, to check the pacing of the chunks (see _TxPacer in
+#--- led_peripheral.py).  Each link is a FakeBLE (see fake_ble.py) whose stack
+#--- holds a few notifies and sends some of them at each connection event;
+#--- the pacer has to find how many chunks each interval takes without
+#--- losing any.  Run it on the pico with the peripheral's files on it:
+#---
+#---    mpremote cp tools/fake_ble.py : + run tools/link_sim.py
+#---
+#--- For each link it prints the bytes/s, the notifies the stack refused and
+#--- the bytes/s the old fixed 20 ms sleep between chunks would have given.
+#--- It checks that the payload arrives intact and at least as fast as with
+#--- the fixed sleep, and that sending a chunk allocates nothing: with the collector
+#--- off, the heap must not grow between the notifies of two full chunks in a
+#--- row (a refused notify raises an OSError, so those are left out).
+#--- It prints FAIL and exits with 1 if a check is missed.
+#-------------------------------------------------------------------------------
+
+import gc
+import sys
+import time
+
+from micropython import const
+
+import led_peripheral
+from fake_ble import FakeBLE
+
+PAYLOAD_SIZE = const(5120)     # Bytes sent over each link
+TIMEOUT_MS = const(10000)      # Give up on a link after this long
+
+#--- (connection interval in ms, notifies the stack holds, notifies sent
+#--- per connection event)
+LINKS = (
+    (7, 12, 6),
+    (15, 3, 1),
+    (30, 4, 2),
+    (50, 20, 8),
+)
+
+received = bytearray()
+
+
+#----------------------------------------------------------------
+#--- ChunkAllocs
+#--- Adds up the heap allocated between the notifies of two full
+#--- chunks in a row, leaving out what on_notify allocates.
+#----------------------------------------------------------------
+class ChunkAllocs:
+    __slots__ = ("ble", "last_len", "last_refused", "exit_alloc", "alloc_bytes", "chunks")
+
+    def __init__(self, ble):
+        self.ble = ble
+        self.last_len = -1
+        self.last_refused = 0
+        self.exit_alloc = 0
+        self.alloc_bytes = 0
+        self.chunks = 0
+
+    def on_notify(self, conn_handle, value_handle, data):
+        entryAlloc = gc.mem_alloc()
+        if len(data) == self.last_len and self.ble.refused == self.last_refused:
+            self.alloc_bytes += entryAlloc - self.exit_alloc
+            self.chunks += 1
+        self.last_len = len(data)
+        self.last_refused = self.ble.refused
+        received.extend(data)
+        self.exit_alloc = gc.mem_alloc()
+
+
+#----------------------------------------------------------------
+#--- run_link
+#--- Send the payload over one link and print how it went.
+#--- Returns True if it all arrived intact, no slower than the
+#--- fixed 20 ms sleep, and the chunks allocated nothing.
+#----------------------------------------------------------------
+def run_link(payload, interval_ms, stackSlots, perEvent):
+    ble = FakeBLE(interval_ms, stackSlots, perEvent)
+    allocs = ChunkAllocs(ble)
+    ble.on_notify = allocs.on_notify
+    periph = led_peripheral.LEDPeripheral(ble)
+    ble.connect()
+    received[:] = b''
+    ble.clear_stats()
+
+    startMs = time.ticks_ms()
+    periph.send_long_string(payload, ble.handle(led_peripheral.CHAR_UUIDS[0]))
+    gc.collect()
+    gc.disable()
+    while len(received) < len(payload) and time.ticks_diff(time.ticks_ms(), startMs) < TIMEOUT_MS:
+        periph.process()
+        time.sleep_ms(1)
+    gc.enable()
+    elapsedMs = max(1, time.ticks_diff(time.ticks_ms(), startMs))
+    ble.disconnect()
+
+    chunkSize = ble.notify_bytes // max(1, ble.notifies)
+    #--- The old code sent one chunk every 20 ms, but never more
+    #--- than the link carries.
+    fixedRate = min(chunkSize * 1000 // 20, chunkSize * perEvent * 1000 // interval_ms)
+    intact = received == payload
+    rate = len(received) * 1000 // elapsedMs
+    print("{:>3} ms interval, {:>2} slots, {} per event: {:>6} bytes/s, {:>3} refused, fixed 20 ms {:>6} bytes/s{}".format(
+        interval_ms, stackSlots, perEvent, rate, ble.refused, fixedRate,
+        "" if intact else ", DATA LOST"))
+    print("  {} bytes allocated over {} full chunks".format(allocs.alloc_bytes, allocs.chunks))
+    passed = intact and rate >= fixedRate and allocs.chunks > 0 and allocs.alloc_bytes == 0
+    print("  " + ("ok" if passed else "FAIL"))
+    return passed
+
+
+def main():
+    payload = bytes(ndx & 0xFF for ndx in range(PAYLOAD_SIZE))
+    allPassed = True
+    for interval_ms, stackSlots, perEvent in LINKS:
+        allPassed = run_link(payload, interval_ms, stackSlots, perEvent) and allPassed
+    print("All links ok" if allPassed else "Some links failed")
+    if not allPassed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
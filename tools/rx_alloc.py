@@ -0,0 +1,125 @@
+#-------------------------------------------------------------------------------
+#--- rx_alloc.py
+#--- Measures the heap the peripheral's receive path allocates for each kind
+#--- of write, from the write IRQ until its handler returns.  The peripheral
+#--- runs on a FakeBLE (see fake_ble.py), so no central is needed, and the
+#--- handlers stage the channels the way main_board.py does without setting
+#--- any LEDs.  Run it on the pico with the peripheral's files on it:
+#---
+#---    mpremote cp tools/fake_ble.py : + run tools/rx_alloc.py
+#---
+#--- The numbers leave out the bytes object gatts_read returns in the IRQ,
+#--- which the real stack allocates for every write (MicroPython can't read
+#--- a value into a buffer) and the fake does not.  What is left is
+#--- whatever the handler itself builds, e.g. the dictionaries of
+#--- ujson.loads, so the peripheral alone, binary commands and setLED json
+#--- on the fast path of command_codec.scan_chan_json must allocate nothing.
+#--- The ujson path is only reported.  It prints FAIL and exits with 1 if
+#--- one of the others allocates.
+#-------------------------------------------------------------------------------
+
+import gc
+import sys
+
+import ujson
+from micropython import const
+
+import command_codec
+import led_peripheral
+from fake_ble import FakeBLE
+
+WRITES = const(200)     # Writes of each kind measured
+
+values = bytearray(16)
+scanVals = bytearray(16)
+
+
+#----------------------------------------------------------------
+#--- on_setLED
+#--- Stage a setLED message like main_board.stage_led_msg.
+#----------------------------------------------------------------
+def on_setLED(data):
+    chanMask = command_codec.scan_chan_json(data, scanVals)
+    if chanMask >= 0:
+        for chanNdx in range(16):
+            if chanMask & (1 << chanNdx):
+                values[chanNdx] = scanVals[chanNdx]
+        return
+    for ctrlNum, chans in ujson.loads(data).items():
+        for chanName, chanValue in chans.items():
+            values[(int(ctrlNum) - 1) * 4 + "RGBW".index(chanName)] = int(chanValue)
+
+
+#----------------------------------------------------------------
+#--- on_binCmd
+#--- Stage binary commands like main_board.on_binCmd_rx.
+#----------------------------------------------------------------
+def on_binCmd(data):
+    if not command_codec.check_batch(data):
+        return
+    offset = 0
+    while offset < len(data):
+        ctrlMask = data[offset + 1]
+        cmdChans = data[offset + 2]
+        for ctrlNdx in range(4):
+            if ctrlMask & (1 << ctrlNdx):
+                valNdx = offset + command_codec.CMD_HEADER_SIZE
+                for chanNdx in range(4):
+                    if cmdChans & (1 << chanNdx):
+                        values[ctrlNdx * 4 + chanNdx] = data[valNdx]
+                        valNdx += 1
+        offset += command_codec.command_length(data, offset)
+
+
+#----------------------------------------------------------------
+#--- measure
+#--- Print the bytes allocated per write of data to value_handle.
+#--- The collector is off so that a collection can't hide any.
+#--- Returns True if it is within maxBytes (None for no limit).
+#----------------------------------------------------------------
+def measure(ble, periph, name, value_handle, data, maxBytes=0) -> bool:
+    #--- One write first so that anything made once is left out.
+    ble.write(0, value_handle, data)
+    periph.process()
+    gc.collect()
+    gc.disable()
+    allocStart = gc.mem_alloc()
+    for _ in range(WRITES):
+        ble.write(0, value_handle, data)
+        periph.process()
+    allocBytes = gc.mem_alloc() - allocStart
+    gc.enable()
+    passed = maxBytes is None or allocBytes <= maxBytes * WRITES
+    print("{:<28} {:>4} bytes/write{}".format(name, allocBytes // WRITES,
+                                             "" if maxBytes is None else " ok" if passed else " FAIL"))
+    return passed
+
+
+def main():
+    ble = FakeBLE()
+    periph = led_peripheral.LEDPeripheral(ble)
+    periph.set_setLED_callback(on_setLED)
+    periph.set_binCmd_callback(on_binCmd)
+    ble.connect()
+    setLED = ble.handle(led_peripheral.CHAR_UUIDS[1])
+    binCmd = ble.handle(led_peripheral.CHAR_UUIDS[9])
+
+    #--- A handler that does nothing measures the peripheral alone.
+    periph.set_setBright_callback(lambda data: None)
+    allPassed = measure(ble, periph, "peripheral only", ble.handle(led_peripheral.CHAR_UUIDS[2]),
+                        b'{"1": {"R": 255}}')
+    allPassed = measure(ble, periph, "binary command", binCmd,
+                        command_codec.pack_command(command_codec.CMD_SET_VALUE, 0x0F, 0x0F,
+                                                   (255, 128, 0, 10))) and allPassed
+    allPassed = measure(ble, periph, "setLED json, fast path", setLED,
+                        b'{"1": {"R": "255", "G": "0"}, "2": {"W": 10}}') and allPassed
+    measure(ble, periph, "setLED json, ujson", setLED, b'{"1": {"R": 255, "G": 0}, "2": {"W": 10.0}}', None)
+    print("On the stack, add the bytes object gatts_read returns for each write.")
+    periph.print_write_stats()
+    print("All writes ok" if allPassed else "Some writes allocated")
+    if not allPassed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#-------------------------------------------------------------------------------
+#--- scan_bench.py
+#--- Benchmarks the ways a central can pick our boxes out of the advertising
+#--- packets it hears (see ble_advertising.py):
+#---
+#---    old       - decode_services, then decode_name on a hit
+#---    one pass  - decode_all on every packet
+#---    prefilter - has_uuid128 on every packet, decode_all on a hit
+#---
+#--- It runs over a trace of packets.  "record" scans for real and saves
+#--- every packet heard to a trace file, e.g. in a crowded room:
+#---
+#---    mpremote run tools/scan_bench.py               (generated trace)
+#---    mpremote exec "import scan_bench; scan_bench.record('scan.trc', 10)"
+#---    mpremote exec "import scan_bench; scan_bench.main('scan.trc')"
+#---
+#--- (the last two need scan_bench.py copied to the pico).  Without a trace
+#--- file it makes one like a crowded room: phones, beacons, trackers and
+#--- watches with one of our boxes every 500 packets.
+#--- A trace file holds each packet as its length (u8) and its bytes.
+#-------------------------------------------------------------------------------
+
+import random
+import time
+
+import bluetooth
+from micropython import const
+
+from ble_advertising import (advertising_payload, decode_all, decode_name,
+                             decode_services, has_uuid128)
+
+SERVICE_UUID = bluetooth.UUID("b00d0c55-1111-2222-3333-0000b00d0c50")
+
+TRACE_PACKETS = const(5000)     # Packets in a generated trace
+OURS_EVERY = const(500)         # One of them is ours every this many
+
+_IRQ_SCAN_RESULT = const(5)
+_IRQ_SCAN_DONE = const(6)
+
+
+def _field(adv_type, value) -> bytes:
+    return bytes((len(value) + 1, adv_type)) + value
+
+
+def _random_bytes(count) -> bytes:
+    return bytes(random.getrandbits(8) for _ in range(count))
+
+
+#----------------------------------------------------------------
+#--- make_trace
+#--- Build a trace like a crowded scan.  The packets are what
+#--- common devices advertise: Apple nearby and iBeacon, Google
+#--- fast pair, exposure notification, Tile, Microsoft and a watch
+#--- with a random 128-bit UUID.
+#----------------------------------------------------------------
+def make_trace():
+    random.seed(5)
+    flags = _field(0x01, b'\x06')
+    ours = bytes(advertising_payload(name=b"BoonLED", services=[SERVICE_UUID]))
+    trace = []
+    for packetNum in range(TRACE_PACKETS):
+        if packetNum % OURS_EVERY == 0:
+            trace.append(ours)
+            continue
+        kind = random.getrandbits(3) % 7
+        if kind == 0:
+            packet = flags + _field(0xFF, b'\x4c\x00\x10\x05' + _random_bytes(5))
+        elif kind == 1:
+            packet = flags + _field(0xFF, b'\x4c\x00\x02\x15' + _random_bytes(21))
+        elif kind == 2:
+            packet = flags + _field(0x03, b'\x2c\xfe') + _field(0x16, b'\x2c\xfe' + bytes(3))
+        elif kind == 3:
+            packet = _field(0x03, b'\x6f\xfd') + _field(0x16, b'\x6f\xfd' + _random_bytes(20))
+        elif kind == 4:
+            packet = flags + _field(0x09, b'Tile') + _field(0x03, b'\xed\xfe')
+        elif kind == 5:
+            packet = flags + _field(0xFF, b'\x06\x00\x01\x09\x20\x02' + _random_bytes(18))
+        else:
+            packet = flags + _field(0x07, _random_bytes(16)) + _field(0x09, b'Watch')
+        trace.append(packet)
+    return trace
+
+
+#----------------------------------------------------------------
+#--- record
+#--- Scan for seconds and save every packet heard to path.
+#----------------------------------------------------------------
+def record(path, seconds=10):
+    ble = bluetooth.BLE()
+    ble.active(True)
+    packets = []
+    done = [False]
+
+    def on_irq(event, data):
+        if event == _IRQ_SCAN_RESULT:
+            packets.append(bytes(data[4]))
+        elif event == _IRQ_SCAN_DONE:
+            done[0] = True
+
+    ble.irq(on_irq)
+    ble.gap_scan(seconds * 1000, 30000, 30000)
+    while not done[0]:
+        time.sleep_ms(100)
+    with open(path, "wb") as traceFile:
+        for packet in packets:
+            traceFile.write(bytes((len(packet),)))
+            traceFile.write(packet)
+    print("Saved {} packets to {}".format(len(packets), path))
+
+
+#----------------------------------------------------------------
+#--- load_trace
+#--- Read a trace saved by record.
+#----------------------------------------------------------------
+def load_trace(path):
+    with open(path, "rb") as traceFile:
+        data = traceFile.read()
+    trace = []
+    pos = 0
+    while pos < len(data):
+        trace.append(data[pos + 1:pos + 1 + data[pos]])
+        pos += 1 + data[pos]
+    return trace
+
+
+def find_old(packet) -> bool:
+    if SERVICE_UUID in decode_services(packet):
+        decode_name(packet)
+        return True
+    return False
+
+
+def find_one_pass(packet) -> bool:
+    return SERVICE_UUID in decode_all(packet)[1]
+
+
+def find_prefiltered(packet, uuidBytes) -> bool:
+    return has_uuid128(packet, uuidBytes) and SERVICE_UUID in decode_all(packet)[1]
+
+
+#----------------------------------------------------------------
+#--- bench
+#--- Time one way of finding our boxes over the trace and print
+#--- the time per packet and the boxes found.
+#----------------------------------------------------------------
+def bench(name, trace, find, *args):
+    views = [memoryview(packet) for packet in trace]
+    startUs = time.ticks_us()
+    found = 0
+    for packet in views:
+        if find(packet, *args):
+            found += 1
+    elapsedUs = time.ticks_diff(time.ticks_us(), startUs)
+    print("{:<10} {:>6} us/1000 packets, {} found".format(name, elapsedUs * 1000 // len(trace), found))
+
+
+def main(path=None):
+    trace = load_trace(path) if path else make_trace()
+    print("{} packets in the trace".format(len(trace)))
+    bench("old", trace, find_old)
+    bench("one pass", trace, find_one_pass)
+    bench("prefilter", trace, find_prefiltered, bytes(SERVICE_UUID))
+
+
+if __name__ == "__main__":
+    main()
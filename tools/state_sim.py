@@ -0,0 +1,181 @@
+#-------------------------------------------------------------------------------
+#--- state_sim.py
+#--- Follows the live LED state the way the centrals do, to check the deltas
+#--- the peripheral notifies on the state characteristic (see led_state.py).
+#--- The LEDs are driven on a simulated clock by a color wheel written every
+#--- 10 ms and a change of every channel now and then, and the state is
+#--- published the way main_board.publish_state does.  The centrals are
+#--- observers on a FakeBLE (see fake_ble.py) that apply each delta to their
+#--- own copy of the state.  Run it on the pico with the peripheral's files:
+#---
+#---    mpremote cp tools/fake_ble.py : + run tools/state_sim.py
+#---
+#--- It runs with one central at the full MTU and then with a second one at
+#--- the default MTU, whose deltas have to be split to fit.  Each run prints
+#--- the updates, deltas and bytes and checks that:
+#---    - every observer matches the state sent after every delta, and the
+#---      LEDs at the end
+#---    - the sequence numbers run on with none missing
+#---    - the characteristic's value holds the whole state just sent
+#---    - no delta was dropped or sent within STATE_PERIOD_MS of the last
+#---    - there are fewer deltas than updates (a burst is coalesced)
+#--- and last that a channel that changes and changes back sends nothing.
+#--- It prints FAIL and exits with 1 if a check is missed.
+#-------------------------------------------------------------------------------
+
+import random
+import sys
+import time
+
+from micropython import const
+
+import led_peripheral
+from fake_ble import FakeBLE
+from led_state import StatePublisher, STATE_PERIOD_MS, apply_state
+
+STEP_MS = const(5)          # Main loop period on the simulated clock
+STEPS = const(2000)         # Steps in a run (10 s)
+WHEEL_EVERY = const(2)      # Steps between color wheel writes
+ALL_EVERY = const(300)      # Steps between changes of every channel
+
+#--- The LEDs as the board set them.
+values = bytearray(16)
+brightness = bytearray(100 for _ in range(16))
+
+
+#----------------------------------------------------------------
+#--- Observer
+#--- One central's copy of the state, built from the deltas it
+#--- is notified.
+#----------------------------------------------------------------
+class Observer:
+    __slots__ = ("values", "brightness", "seq", "gaps")
+
+    def __init__(self):
+        self.values = bytearray(16)
+        self.brightness = bytearray(100 for _ in range(16))
+        self.seq = -1
+        self.gaps = 0
+
+    def on_delta(self, data):
+        seq = apply_state(data, self.values, self.brightness)
+        if self.seq >= 0 and seq != (self.seq + 1) & 0xFF:
+            self.gaps += 1
+        self.seq = seq
+
+    def matches(self, pub) -> bool:
+        return self.values == pub.sent_values and self.brightness == pub.sent_brightness
+
+
+#----------------------------------------------------------------
+#--- publish
+#--- Hand the marked channels to the publisher and send the
+#--- deltas once it is due, like main_board.publish_state.
+#--- Returns True if a delta was sent.
+#----------------------------------------------------------------
+def publish(periph, pub, nowMs) -> bool:
+    if not pub.due(nowMs):
+        return False
+    for chanNdx in range(16):
+        if pub.dirty & (1 << chanNdx):
+            pub.set(chanNdx, values[chanNdx], brightness[chanNdx])
+    deltas = pub.deltas
+    periph.send_state(pub, nowMs)
+    return pub.deltas != deltas
+
+
+#----------------------------------------------------------------
+#--- run
+#--- Drive the LEDs for STEPS with a central connected at each of
+#--- the MTUs and check what they saw.
+#----------------------------------------------------------------
+def run(name, mtus):
+    random.seed(46)
+    #--- The link is not what is checked here, so its stack never fills.
+    ble = FakeBLE(7, 10000, 10000)
+    periph = led_peripheral.LEDPeripheral(ble)
+    stateHandle = ble.handle(led_peripheral.CHAR_UUIDS[13])
+    observers = {}
+    for connHandle in range(len(mtus)):
+        observers[connHandle] = Observer()
+        ble.connect(connHandle, mtus[connHandle])
+
+    def on_notify(conn_handle, value_handle, data):
+        if value_handle == stateHandle:
+            observers[conn_handle].on_delta(data)
+
+    ble.on_notify = on_notify
+    pub = StatePublisher()
+    values[:] = bytes(16)
+    brightness[:] = bytes(100 for _ in range(16))
+    nowMs = time.ticks_ms()
+    lastSentMs = None
+    passed = True
+    for step in range(STEPS + STATE_PERIOD_MS // STEP_MS + 1):
+        nowMs = time.ticks_add(nowMs, STEP_MS)
+        if step < STEPS and step % WHEEL_EVERY == 0:
+            for chanNdx in range(3):
+                values[chanNdx] = (step * 7 + chanNdx * 40) & 0xFF
+            pub.mark(0x0007)
+        if step < STEPS and step % ALL_EVERY == 0:
+            for chanNdx in range(16):
+                values[chanNdx] = random.getrandbits(8)
+                brightness[chanNdx] = random.getrandbits(7) % 101
+            pub.mark(0xFFFF)
+        if not publish(periph, pub, nowMs):
+            continue
+        if lastSentMs is not None and time.ticks_diff(nowMs, lastSentMs) < STATE_PERIOD_MS:
+            passed = False
+        lastSentMs = nowMs
+        wholeValues = bytearray(16)
+        wholeBrightness = bytearray(16)
+        wholeSeq = apply_state(ble.gatts_read(stateHandle), wholeValues, wholeBrightness)
+        if wholeSeq != pub.seq or wholeValues != pub.sent_values or wholeBrightness != pub.sent_brightness:
+            passed = False
+        for observer in observers.values():
+            if not observer.matches(pub):
+                passed = False
+
+    for observer in observers.values():
+        if observer.values != values or observer.brightness != brightness or observer.gaps:
+            passed = False
+    passed = passed and pub.drops == 0 and pub.deltas < pub.marks
+    print("{:<28} {}".format(name, pub.stats()))
+    print("  " + ("ok" if passed else "FAIL"))
+    for connHandle in observers:
+        ble.disconnect(connHandle)
+    return passed, periph, pub
+
+
+#----------------------------------------------------------------
+#--- run_no_change
+#--- A channel that changes and changes back before the next
+#--- delta is due must not be sent.
+#----------------------------------------------------------------
+def run_no_change(periph, pub):
+    nowMs = time.ticks_add(time.ticks_ms(), STATE_PERIOD_MS)
+    pub.sent(nowMs)
+    deltas = pub.deltas
+    values[5] ^= 1
+    pub.mark(1 << 5)
+    values[5] ^= 1
+    nowMs = time.ticks_add(nowMs, STATE_PERIOD_MS)
+    publish(periph, pub, nowMs)
+    passed = pub.deltas == deltas
+    print("{:<28} {} deltas".format("change and change back", pub.deltas - deltas))
+    print("  " + ("ok" if passed else "FAIL"))
+    return passed
+
+
+def main():
+    allPassed, _, _ = run("MTU 244", (244,))
+    passed, periph, pub = run("MTU 244 and default MTU", (244, 23))
+    allPassed = allPassed and passed
+    allPassed = run_no_change(periph, pub) and allPassed
+    print("All runs ok" if allPassed else "Some runs failed")
+    if not allPassed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#-------------------------------------------------------------------------------
+#--- stream_sim.py
+#--- Feeds the jitter buffer of led_stream.py with a simulated sender and
+#--- checks its stats.  The sender streams frames at a given rate over a link
+#--- that loses, repeats, reorders, bunches up or stalls them, and the buffer is
+#--- pushed and popped on a simulated clock the way main_board.py's render
+#--- task does.  Nothing is timed for real, so it runs in a moment on the
+#--- pico (or any MicroPython):
+#---
+#---    mpremote run tools/stream_sim.py
+#---
+#--- Each run prints the buffer's stats and whether they are what the link
+#--- should give.  The stream running dry after its last frame counts as
+#--- one underrun.
+#-------------------------------------------------------------------------------
+
+import random
+
+from micropython import const
+
+from led_stream import JitterBuffer, pack_stream_frame, STREAM_DELAY_MS
+
+LINK_MS = const(10)     # Time a frame takes to arrive on a perfect link
+SECONDS = const(5)      # Length of each stream
+
+played = []
+
+
+#----------------------------------------------------------------
+#--- make_arrivals
+#--- Return the (arrival ms, seq#, frame) of every frame the link
+#--- delivers, in the order they arrive, and the number of frames
+#--- lost and repeated.  burst frames are held back and arrive
+#--- together; with reorder every other frame arrives after the
+#--- one sent after it, and frames sent during a stall of the link
+#--- halfway through the stream arrive when it ends.
+#----------------------------------------------------------------
+def make_arrivals(fps, lossPct, dupPct, burst, reorder, stallMs):
+    periodMs = 1000 // fps
+    stallStart = SECONDS * 1000 // 2
+    arrivals = []
+    lost = 0
+    repeats = 0
+    for seq in range(fps * SECONDS):
+        sendMs = seq * 1000 // fps
+        if random.random() * 100 < lossPct:
+            lost += 1
+            continue
+        lastOfBurst = (seq // burst) * burst + burst - 1
+        arriveMs = lastOfBurst * 1000 // fps + LINK_MS
+        if reorder and seq % 2 == 1:
+            arriveMs += periodMs + 1
+        if stallStart <= arriveMs < stallStart + stallMs:
+            arriveMs = stallStart + stallMs
+        frame = pack_stream_frame(seq, sendMs, bytes([seq & 0xFF]) * 16)
+        arrivals.append((arriveMs, seq, frame))
+        if random.random() * 100 < dupPct:
+            repeats += 1
+            arrivals.append((arriveMs + 2, seq, frame))
+    arrivals.sort()
+    return arrivals, lost, repeats
+
+
+#----------------------------------------------------------------
+#--- run
+#--- Stream over one link and check the stats with check, which is
+#--- given the buffer, the frames sent, lost and repeated.
+#----------------------------------------------------------------
+def run(name, fps, check, lossPct=0, dupPct=0, burst=1, reorder=False, stallMs=0):
+    random.seed(fps + lossPct + dupPct + burst)
+    arrivals, lost, repeats = make_arrivals(fps, lossPct, dupPct, burst, reorder, stallMs)
+    numFrames = fps * SECONDS
+    jb = JitterBuffer()
+    played.clear()
+    inOrder = True
+    nextArrival = 0
+    endMs = arrivals[-1][0] + STREAM_DELAY_MS + 1000 // fps * burst + 50
+    for nowMs in range(endMs):
+        while nextArrival < len(arrivals) and arrivals[nextArrival][0] <= nowMs:
+            jb.push(arrivals[nextArrival][2], nowMs)
+            nextArrival += 1
+        ndx = jb.pop(nowMs)
+        if ndx >= 0:
+            seq = jb.frame(ndx)[0]
+            if played and seq <= played[-1] and played[-1] - seq < 128:
+                inOrder = False
+            played.append(seq)
+    passed = inOrder and check(jb, numFrames, lost, repeats)
+    print("{:<26} {} frames, {} lost, {} repeated by the link".format(name, numFrames, lost, repeats))
+    print("  " + jb.stats())
+    print("  " + ("ok" if passed else "FAIL"))
+    return passed
+
+
+def main():
+    allPassed = True
+    allPassed &= run("30 fps, perfect link", 30,
+                     lambda jb, n, lost, rep: jb.played == n and jb.lost == 0 and jb.underruns <= 1)
+    allPassed &= run("60 fps, 10% loss", 60,
+                     lambda jb, n, lost, rep: jb.played == n - lost and jb.lost <= lost and jb.late == 0,
+                     lossPct=10)
+    allPassed &= run("60 fps, 5% repeated", 60,
+                     lambda jb, n, lost, rep: jb.played == n and jb.duplicates == rep,
+                     dupPct=5)
+    allPassed &= run("60 fps, reordered pairs", 60,
+                     lambda jb, n, lost, rep: jb.played == n and jb.late == 0 and jb.lost == 0,
+                     reorder=True)
+    #--- Bursts are smoothed out; the first frame sets how far behind
+    #--- the sender the frames are played.
+    allPassed &= run("60 fps, bursts of 3", 60,
+                     lambda jb, n, lost, rep: jb.played == n and jb.underruns <= 1,
+                     burst=3)
+    #--- A stall longer than STREAM_DELAY_MS runs the buffer dry, and
+    #--- the frames that were due by the time it ends are skipped.
+    allPassed &= run("30 fps, 200 ms stall", 30,
+                     lambda jb, n, lost, rep: jb.underruns > 1 and jb.skipped > 0 and jb.played + jb.skipped == n,
+                     stallMs=200)
+    print("All runs ok" if allPassed else "Some runs failed")
+
+
+if __name__ == "__main__":
+    main()